@@ -1,26 +1,37 @@
 #!/usr/bin/env python3#!/usr/bin/env python3
 import os
+import re
 import sys
 import time
 import json
+import math
+import bisect
+import hashlib
+import random
+import sqlite3
+import logging
+import queue
+import atexit
 import threading
+import contextvars
+import pickle
+import cProfile
+import pstats
+import tracemalloc
 import requests
-from datetime import datetime, timedelta
+from array import array
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import date, datetime, timedelta
 import pytz
 import paho.mqtt.client as mqtt
 
-# Import conditionnel pour InfluxDB
-try:
-    from influxdb_client import InfluxDBClient
-    from influxdb_client.client.query_api import QueryApi
-    INFLUXDB_AVAILABLE = True
-except ImportError:
-    INFLUXDB_AVAILABLE = False
-    print("⚠️ influxdb-client non installé, seul VictoriaMetrics sera supporté")
-
-print("--- Début de l'exécution du script Linky multi-DB ---")
-time.sleep(1)
-print(f"Version Python: {sys.version}")
+# Bibliothèques optionnelles (influxdb-client, NumPy) importées à la première utilisation:
+# l'import du module reste rapide et sans effet de bord (ni réseau, ni thread, ni attente)
 
 # =======================
 # CONFIG via ENV
@@ -36,6 +47,10 @@ DB_TYPE = os.getenv("DB_TYPE", "victoriametrics").lower()  # "victoriametrics" o
 # VictoriaMetrics
 VM_HOST = os.getenv("VM_HOST", "127.0.0.1")
 VM_PORT = int(os.getenv("VM_PORT") or 8428)
+VM_TIMEOUT_RANGE = float(os.getenv("VM_TIMEOUT_RANGE") or 30)      # timeout (s) des requêtes de plage
+VM_TIMEOUT_INSTANT = float(os.getenv("VM_TIMEOUT_INSTANT") or 10)  # timeout (s) des requêtes instantanées
+VM_MAX_RETRIES = int(os.getenv("VM_MAX_RETRIES") or 3)             # nouvelles tentatives sur erreur 5xx / timeout
+VM_RETRY_BACKOFF = float(os.getenv("VM_RETRY_BACKOFF") or 0.5)     # délai de base (s), doublé à chaque tentative
 
 # InfluxDB v2
 INFLUXDB_URL = os.getenv("INFLUXDB_URL", "http://127.0.0.1:8086")
@@ -46,968 +61,2301 @@ INFLUXDB_BUCKET = os.getenv("INFLUXDB_BUCKET", "homeassistant")
 SENSOR_NAME = os.getenv("SENSOR_NAME", "linky_tic")
 PUBLISH_INTERVAL = int(os.getenv("PUBLISH_INTERVAL") or 300)
 
-# Noms des métriques (adaptés selon la DB)
-if DB_TYPE == "influxdb":
-    METRIC_NAMEhpjb = "linky_tempo_index_bbrhpjb"
-    METRIC_NAMEhcjb = "linky_tempo_index_bbrhcjb"
-    METRIC_NAMEhpjw = "linky_tempo_index_bbrhpjw"
-    METRIC_NAMEhcjw = "linky_tempo_index_bbrhcjw"
-    METRIC_NAMEhpjr = "linky_tempo_index_bbrhpjr"
-    METRIC_NAMEhcjr = "linky_tempo_index_bbrhcjr"
-    METRIC_NAMEpcons = "linky_puissance_consommee"
-else:
-    METRIC_NAMEhpjb = "sensor.linky_tempo_index_bbrhpjb_value"
-    METRIC_NAMEhcjb = "sensor.linky_tempo_index_bbrhcjb_value"
-    METRIC_NAMEhpjw = "sensor.linky_tempo_index_bbrhpjw_value"
-    METRIC_NAMEhcjw = "sensor.linky_tempo_index_bbrhcjw_value"
-    METRIC_NAMEhpjr = "sensor.linky_tempo_index_bbrhpjr_value"
-    METRIC_NAMEhcjr = "sensor.linky_tempo_index_bbrhcjr_value"
-    METRIC_NAMEpcons = "sensor.linky_puissance_consommee_value"
+# Agrégats journaliers calculés par la base (false = ancien scan minute par minute)
+DAILY_ROLLUP = os.getenv("DAILY_ROLLUP", "true").lower() == "true"
+# Scan minute par minute (DAILY_ROLLUP=false): points max par série et par requête, une plage
+# de plusieurs jours est découpée en conséquence (cf. -search.maxPointsPerTimeseries de VictoriaMetrics)
+SCAN_MAX_POINTS = max(2, int(os.getenv("SCAN_MAX_POINTS") or 10000))
+# Conso sur une période par premier/dernier point (false = ancien scan horaire de toute la période)
+BOUNDARY_QUERIES = os.getenv("BOUNDARY_QUERIES", "true").lower() == "true"
+
+# Exécution concurrente: requêtes simultanées max vers la base, et étapes du cycle en parallèle
+MAX_IN_FLIGHT = max(1, int(os.getenv("MAX_IN_FLIGHT") or 6))
+CYCLE_WORKERS = max(1, int(os.getenv("CYCLE_WORKERS") or 8))
+
+# Durée de validité (s) des tarifs Tempo en cache (ils ne changent que quelques fois par an)
+TARIFF_CACHE_TTL = int(os.getenv("TARIFF_CACHE_TTL") or 3600)
+
+# Stockage local des jours clos (volume persistant)
+STATE_DIR = os.getenv("STATE_DIR", "/data")
+DAILY_STORE = os.getenv("DAILY_STORE", "true").lower() == "true"
+STORE_SETTLE_LAG = int(os.getenv("STORE_SETTLE_LAG") or 900)  # délai (s) après minuit avant de figer un jour
+
+# Cache des résultats de requêtes: fenêtre terminée depuis plus de QUERY_CACHE_SETTLE_LAG s conservée sans limite
+# de durée (éviction LRU au-delà de QUERY_CACHE_MAX_MB), fenêtre touchant le présent QUERY_CACHE_RECENT_TTL s
+QUERY_CACHE = os.getenv("QUERY_CACHE", "true").lower() == "true"
+QUERY_CACHE_SETTLE_LAG = int(os.getenv("QUERY_CACHE_SETTLE_LAG") or STORE_SETTLE_LAG)
+QUERY_CACHE_RECENT_TTL = int(os.getenv("QUERY_CACHE_RECENT_TTL") or 30)
+QUERY_CACHE_MAX_MB = float(os.getenv("QUERY_CACHE_MAX_MB") or 64)
+QUERY_CACHE_PERSIST = os.getenv("QUERY_CACHE_PERSIST", "false").lower() == "true"  # fenêtres closes gardées dans STATE_DIR
+# Conso des périodes d'un minuit de Paris à un autre lue dans la table des index à minuit (sans requête de plage)
+MIDNIGHT_INDEX = os.getenv("MIDNIGHT_INDEX", "true").lower() == "true"
+# Dernier payload publié conservé dans STATE_DIR et republié dès le démarrage, avant le premier recalcul
+PAYLOAD_SNAPSHOT = os.getenv("PAYLOAD_SNAPSHOT", "true").lower() == "true"
+
+# Mode flux: chiffres du jour mis à jour à partir des trames TIC reçues en MQTT
+STREAM_MODE = os.getenv("STREAM_MODE", "false").lower() == "true"
+TELEINFO_TOPIC = os.getenv("TELEINFO_TOPIC", "teleinfo/#")                     # un ou plusieurs topics, séparés par des virgules
+TELEINFO_INDEX_SCALE = float(os.getenv("TELEINFO_INDEX_SCALE") or 0.001)       # index TIC (Wh) → unité de la base (kWh)
+STREAM_PUBLISH_INTERVAL = float(os.getenv("STREAM_PUBLISH_INTERVAL") or 10)    # intervalle min (s) entre deux publications du flux
+
+# Rafraîchissement par étage: jour en cours toutes les N s (échéances calées sur l'horloge),
+# historique à chaque minuit de Paris, tarifs toutes les N s
+TODAY_REFRESH_INTERVAL = max(1, int(os.getenv("TODAY_REFRESH_INTERVAL") or PUBLISH_INTERVAL))
+TARIFF_REFRESH_INTERVAL = max(1, int(os.getenv("TARIFF_REFRESH_INTERVAL") or 3600))
+
+# Publication: payload inchangé non republié, sauf rafraîchissement forcé (0 = publier à chaque cycle)
+PUBLISH_FORCE_INTERVAL = int(os.getenv("PUBLISH_FORCE_INTERVAL") or 3600)
+# Publication des valeurs scalaires sur leurs propres topics (avec discovery Home Assistant)
+PUBLISH_SCALAR_TOPICS = os.getenv("PUBLISH_SCALAR_TOPICS", "false").lower() == "true"
+
+# Réécriture des agrégats des jours clos (conso par compteur, puissance max, coûts) comme séries de la base
+ROLLUP_WRITEBACK = os.getenv("ROLLUP_WRITEBACK", "false").lower() == "true"
+ROLLUP_METRIC_PREFIX = os.getenv("ROLLUP_METRIC_PREFIX", "linky_daily")
+
+# Plusieurs compteurs dans un même process: fichier JSON décrivant chaque compteur
+# (sans lui, un seul compteur configuré par les variables ci-dessus)
+METERS_CONFIG = os.getenv("METERS_CONFIG", "")
+METER_WORKERS = max(1, int(os.getenv("METER_WORKERS") or 4))  # compteurs recalculés en parallèle
+
+# Port du endpoint Prometheus /metrics (0 = désactivé)
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 0)
+
+# Profilage d'un cycle sur PROFILE_EVERY par compteur (0 = désactivé): durée et requêtes par étape dans les logs,
+# et en option profil cProfile (.pstats) et principales allocations (tracemalloc) écrits dans PROFILE_DIR
+PROFILE_EVERY = max(0, int(os.getenv("PROFILE_EVERY") or 0))
+PROFILE_CPROFILE = os.getenv("PROFILE_CPROFILE", "false").lower() == "true"
+PROFILE_TRACEMALLOC = os.getenv("PROFILE_TRACEMALLOC", "false").lower() == "true"
+PROFILE_DIR = os.getenv("PROFILE_DIR") or os.path.join(STATE_DIR, "profiles")
+PROFILE_TOP = max(1, int(os.getenv("PROFILE_TOP") or 25))  # lignes des rapports d'allocations
+
+# Journalisation: LOG_LEVEL (DEBUG, INFO, WARNING, ERROR), DEBUG=true équivaut à LOG_LEVEL=DEBUG
+DEBUG = os.getenv("DEBUG", "false").lower() == "true"
+LOG_LEVEL = (os.getenv("LOG_LEVEL") or ("DEBUG" if DEBUG else "INFO")).upper()
+LOG_CYCLE_JSON = os.getenv("LOG_CYCLE_JSON", "false").lower() == "true"  # résumé d'une ligne JSON par cycle
+
+
+def default_metric_names(db_type):
+    """Noms des métriques (adaptés selon la DB)"""
+    if db_type == "influxdb":
+        return {
+            "hpjb": "linky_tempo_index_bbrhpjb",
+            "hcjb": "linky_tempo_index_bbrhcjb",
+            "hpjw": "linky_tempo_index_bbrhpjw",
+            "hcjw": "linky_tempo_index_bbrhcjw",
+            "hpjr": "linky_tempo_index_bbrhpjr",
+            "hcjr": "linky_tempo_index_bbrhcjr",
+            "pcons": "linky_puissance_consommee",
+        }
+    return {
+        "hpjb": "sensor.linky_tempo_index_bbrhpjb_value",
+        "hcjb": "sensor.linky_tempo_index_bbrhcjb_value",
+        "hpjw": "sensor.linky_tempo_index_bbrhpjw_value",
+        "hcjw": "sensor.linky_tempo_index_bbrhcjw_value",
+        "hpjr": "sensor.linky_tempo_index_bbrhpjr_value",
+        "hcjr": "sensor.linky_tempo_index_bbrhcjr_value",
+        "pcons": "sensor.linky_puissance_consommee_value",
+    }
+
+
+_default_metrics = default_metric_names(DB_TYPE)
+METRIC_NAMEhpjb = _default_metrics["hpjb"]
+METRIC_NAMEhcjb = _default_metrics["hcjb"]
+METRIC_NAMEhpjw = _default_metrics["hpjw"]
+METRIC_NAMEhcjw = _default_metrics["hcjw"]
+METRIC_NAMEhpjr = _default_metrics["hpjr"]
+METRIC_NAMEhcjr = _default_metrics["hcjr"]
+METRIC_NAMEpcons = _default_metrics["pcons"]
 
 MQTT_RETAIN = True
 
 # =======================
 # MQTT Topics
 # =======================
-LINKY_STATE_TOPIC = f"homeassistant/sensor/{SENSOR_NAME}/state"
-LINKY_DISCOVERY_TOPIC = f"homeassistant/sensor/{SENSOR_NAME}/config"
+def linky_state_topic(sensor):
+    return f"homeassistant/sensor/{sensor}/state"
 
-# =======================
-# Configuration client InfluxDB
-# =======================
-influx_client = None
-influx_query_api = None
 
-if DB_TYPE == "influxdb" and INFLUXDB_AVAILABLE:
-    if not INFLUXDB_TOKEN or not INFLUXDB_ORG:
-        print("❌ Configuration InfluxDB incomplète (TOKEN et ORG requis)")
-        sys.exit(1)
-    try:
-        influx_client = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
-        influx_query_api = influx_client.query_api()
-        print("✅ Client InfluxDB initialisé")
-    except Exception as e:
-        print(f"❌ Erreur initialisation InfluxDB: {e}")
-        sys.exit(1)
+def linky_discovery_topic(sensor):
+    return f"homeassistant/sensor/{sensor}/config"
+
 
 # =======================
-# Helper: requêtes vers VictoriaMetrics
+# Compteurs servis
 # =======================
-def vm_query_range(vm_host, vm_port, metric, start_ts, end_ts, step=3600, timeout=30):
-    url = f"http://{vm_host}:{vm_port}/api/v1/query_range"
-    params = {"query": metric, "start": int(start_ts), "end": int(end_ts), "step": int(step)}
-    try:
-        r = requests.get(url, params=params, timeout=timeout)
-        r.raise_for_status()
-        data = r.json()
-        res_list = data.get("data", {}).get("result", [])
-        if res_list and res_list[0].get("values"):
-            return res_list[0]["values"]
-        return []
-    except Exception as e:
-        print(f"❌ Erreur vm_query_range pour {metric}: {e}")
-        return []
+class MeterConfig:
+    """
+    Un compteur Linky servi par le process: nom du sensor (topics MQTT, stockage local),
+    métriques d'index et de puissance, base interrogée et topics TIC du mode flux.
+    label_filter: filtre de labels MetricsQL (ex: meter="garage") ajouté aux sélecteurs des
+    métriques du compteur, pour des compteurs partageant les mêmes noms de métriques (VictoriaMetrics).
+    """
 
+    def __init__(self, name, metrics=None, db_type=DB_TYPE, vm_host=VM_HOST, vm_port=VM_PORT,
+                 influx_bucket=INFLUXDB_BUCKET, label_filter="", teleinfo_topic=TELEINFO_TOPIC):
+        self.name = name
+        self.db_type = db_type.lower()
+        self.metrics = {**default_metric_names(self.db_type), **(metrics or {})}
+        self.vm_host = vm_host
+        self.vm_port = int(vm_port)
+        self.influx_bucket = influx_bucket
+        self.label_filter = label_filter.strip().strip("{}")
+        self.teleinfo_topics = [t.strip() for t in teleinfo_topic.split(",") if t.strip()]
+        self.state_topic = linky_state_topic(name)
+        self.discovery_topic = linky_discovery_topic(name)
+
+    @classmethod
+    def from_dict(cls, entry):
+        known = ("name", "metrics", "db_type", "vm_host", "vm_port", "influx_bucket", "label_filter", "teleinfo_topic")
+        unknown = set(entry) - set(known)
+        if unknown:
+            raise ValueError(f"clés inconnues pour le compteur {entry.get('name')}: {', '.join(sorted(unknown))}")
+        return cls(**entry)
+
+    def tempo_metrics(self):
+        m = self.metrics
+        return [m["hpjb"], m["hcjb"], m["hpjw"], m["hcjw"], m["hpjr"], m["hcjr"]]
+
+    def backend(self):
+        """Identifiant de la base interrogée (clé des caches partagés entre compteurs)"""
+        if self.db_type == "influxdb":
+            return ("influxdb", self.influx_bucket)
+        return ("victoriametrics", self.vm_host, self.vm_port)
+
+    def series_filter(self, metrics):
+        """Filtre de labels à appliquer, uniquement pour les métriques propres au compteur (pas les tarifs)"""
+        if self.label_filter and set(metrics) <= set(self.metrics.values()):
+            return self.label_filter
+        return ""
+
+    def store_key(self, metric):
+        """
+        Clé d'une métrique dans le stockage local, unique même si plusieurs compteurs partagent son nom:
+        base interrogée (comme les clés du cache des requêtes), nom et filtre de labels,
+        ex. victoriametrics://192.168.0.10:8428/sensor.linky_tempo_index_bbrhpjb_value{meter="garage"}
+        """
+        db_type, *location = self.backend()
+        key = f"{db_type}://{':'.join(map(str, location))}/{metric}"
+        return f"{key}{{{self.label_filter}}}" if self.label_filter else key
 
-def vm_query_instant(vm_host, vm_port, metric, timeout=10):
-    url = f"http://{vm_host}:{vm_port}/api/v1/query"
-    params = {"query": metric}
-    try:
-        r = requests.get(url, params=params, timeout=timeout)
-        r.raise_for_status()
-        data = r.json()
-        res_list = data.get("data", {}).get("result", [])
-        if res_list and res_list[0].get("value"):
-            return res_list[0]["value"][1]
-        return None
-    except Exception as e:
-        print(f"❌ Erreur vm_query_instant pour {metric}: {e}")
-        return None
 
 # =======================
-# Helper: requêtes vers InfluxDB v2
+# Journalisation
 # =======================
-def influx_query_range(entity_id, start_time, end_time, step="1h"):
-    """Requête de plage pour InfluxDB v2"""
-    try:
-        # Conversion des timestamps en format RFC3339
-        start_rfc = datetime.fromtimestamp(start_time, tz=pytz.UTC).isoformat()
-        end_rfc = datetime.fromtimestamp(end_time, tz=pytz.UTC).isoformat()
-        
-        query = f'''
-        from(bucket: "{INFLUXDB_BUCKET}")
-        |> range(start: {start_rfc}, stop: {end_rfc})
-        |> filter(fn: (r) => r["entity_id"] == "{entity_id}")
-        |> filter(fn: (r) => r["_field"] == "value")
-        |> aggregateWindow(every: {step}, fn: last, createEmpty: false)
-        |> yield(name: "last")
-        '''
-        
-        result = influx_query_api.query(query=query)
-        values = []
-        for table in result:
-            for record in table.records:
-                timestamp = int(record.get_time().timestamp())
-                value = record.get_value()
-                if value is not None:
-                    values.append([timestamp, str(value)])
-        return values
-    except Exception as e:
-        print(f"❌ Erreur influx_query_range pour {entity_id}: {e}")
-        return []
+logger = logging.getLogger("linky")
+# Lignes de suivi de chaque cycle (étages, durée, publication, prochaine échéance):
+# reléguées en DEBUG quand le résumé JSON d'une ligne les remplace
+CYCLE_LOG_LEVEL = logging.DEBUG if LOG_CYCLE_JSON else logging.INFO
 
 
-def influx_query_instant(entity_id):
-    """Requête instantanée pour InfluxDB v2"""
+def setup_logging():
+    """
+    Le logger ne fait que déposer les enregistrements dans une file: un thread dédié
+    (QueueListener) les formate et les écrit sur stdout, hors du chemin de calcul.
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s %(message)s", "%Y-%m-%d %H:%M:%S"))
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, handler)
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    logger.propagate = False
+    listener.start()
+    # Vide la file avant la sortie (y compris sur sys.exit)
+    atexit.register(listener.stop)
+
+
+
+def load_meters():
+    """Compteurs servis: METERS_CONFIG (liste JSON, ou {"meters": [...]}) ou le compteur unique des variables d'env"""
+    if not METERS_CONFIG:
+        return [MeterConfig(SENSOR_NAME)]
     try:
-        query = f'''
-        from(bucket: "{INFLUXDB_BUCKET}")
-        |> range(start: -1h)
-        |> filter(fn: (r) => r["entity_id"] == "{entity_id}")
-        |> filter(fn: (r) => r["_field"] == "value")
-        |> last()
-        '''
-        
-        result = influx_query_api.query(query=query)
-        for table in result:
-            for record in table.records:
-                return str(record.get_value())
-        return None
+        with open(METERS_CONFIG, encoding="utf-8") as f:
+            data = json.load(f)
+        entries = data.get("meters", []) if isinstance(data, dict) else data
+        meters = [MeterConfig.from_dict(entry) for entry in entries]
     except Exception as e:
-        print(f"❌ Erreur influx_query_instant pour {entity_id}: {e}")
-        return None
+        logger.error("❌ Configuration des compteurs invalide (%s): %s", METERS_CONFIG, e)
+        sys.exit(1)
+    names = [meter.name for meter in meters]
+    if not meters or len(set(names)) != len(names):
+        logger.error("❌ Configuration des compteurs invalide (%s): liste vide ou noms en double", METERS_CONFIG)
+        sys.exit(1)
+    return meters
 
-# =======================
-# Wrapper unifié pour les requêtes
-# =======================
-def db_query_range(metric, start_ts, end_ts, step=3600, timeout=30):
-    """Wrapper unifié pour requêtes de plage"""
-    if DB_TYPE == "influxdb" and influx_query_api:
-        # Conversion du step en format InfluxDB
-        if step <= 60:
-            influx_step = f"{step}s"
-        elif step <= 3600:
-            influx_step = f"{step//60}m"
-        else:
-            influx_step = f"{step//3600}h"
-        return influx_query_range(metric, start_ts, end_ts, influx_step)
-    else:
-        return vm_query_range(VM_HOST, VM_PORT, metric, start_ts, end_ts, step, timeout)
 
+served_meters = None
+_meters_lock = threading.Lock()
+
+
+def get_meters():
+    """Compteurs servis, chargés à la première utilisation (main(), ou premier calcul hors compteur)"""
+    global served_meters
+    with _meters_lock:
+        if served_meters is None:
+            served_meters = load_meters()
+    return served_meters
+
+
+# Compteur en cours de calcul (propagé aux threads via submit_in_context / parallel_map)
+current_meter = contextvars.ContextVar("current_meter", default=None)
 
-def db_query_instant(metric, timeout=10):
-    """Wrapper unifié pour requêtes instantanées"""
-    if DB_TYPE == "influxdb" and influx_query_api:
-        return influx_query_instant(metric)
-    else:
-        return vm_query_instant(VM_HOST, VM_PORT, metric, timeout)
+
+def active_meter():
+    """Compteur en cours, le premier compteur configuré hors run_for_meter"""
+    return current_meter.get() or get_meters()[0]
+
+
+def run_for_meter(meter, func, *args):
+    """Exécute func(*args) avec `meter` comme compteur en cours, dans un contexte dédié"""
+    ctx = contextvars.copy_context()
+    ctx.run(current_meter.set, meter)
+    return ctx.run(func, *args)
 
 # =======================
-# Calculs de conso réutilisables (adaptés)
+# Client InfluxDB (créé à la première utilisation)
 # =======================
-def compute_consumption_for_period(metrics, start_dt, end_dt, step=3600, label=""):
-    """
-    Pour chaque metric dans metrics:
-      - récupère la série (start_dt -> end_dt)
-      - calcule last - first (clamp >= 0)
-      - somme sur metrics
-    """
-    total = 0.0
-    start_ts = int(start_dt.timestamp())
-    end_ts = int(end_dt.timestamp())
-    for metric in metrics:
-        values = db_query_range(metric, start_ts, end_ts, step=step)
-        if not values or len(values) < 2:
-            print(f"⚠️ Données insuffisantes pour {metric} ({label})")
-            continue
-        try:
-            first_val = float(values[0][1])
-            last_val = float(values[-1][1])
-            consumption = max(0.0, last_val - first_val)
-            total += consumption
-            print(f"📊 {metric}: {first_val:.2f} → {last_val:.2f} = {consumption:.2f} kWh")
-        except Exception as e:
-            print(f"❌ Erreur lors du parsing pour {metric} ({label}): {e}")
-            continue
-    return round(total, 2)
+influx_client = None
+influx_query_api = None
+_influx_lock = threading.Lock()
 
 
-def compute_daily_diffs(metric_name, days=7, step=60):
+def get_influx_client():
     """
-    Retourne une liste [jour0, jour1, ...] avec jour0 = aujourd'hui (ou 0 si pas de données),
-    chaque valeur = last - first sur la journée.
-    step par défaut = 60s (comme dans le script original).
+    Importe influxdb-client et crée le client partagé à la première utilisation.
+    Lève RuntimeError si la bibliothèque est absente ou la configuration incomplète.
     """
-    tz = pytz.timezone("Europe/Paris")
-    now = datetime.now(tz)
-    today = now.date()
-    results = []
+    global influx_client, influx_query_api
+    if influx_client is not None:
+        return influx_client
+    with _influx_lock:
+        if influx_client is None:
+            try:
+                from influxdb_client import InfluxDBClient
+            except ImportError:
+                raise RuntimeError("bibliothèque influxdb-client non disponible")
+            if not INFLUXDB_TOKEN or not INFLUXDB_ORG:
+                raise RuntimeError("configuration InfluxDB incomplète (TOKEN et ORG requis)")
+            client = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
+            influx_query_api = client.query_api()
+            influx_client = client
+            logger.info("✅ Client InfluxDB initialisé")
+    return influx_client
 
-    for i in range(days):
-        day = today - timedelta(days=i)
-        start_dt = datetime(year=day.year, month=day.month, day=day.day, hour=0, minute=0, second=0, tzinfo=tz)
-        end_dt = now if day == today else (start_dt + timedelta(days=1))
-        start_ts = int(start_dt.timestamp())
-        end_ts = int(end_dt.timestamp())
 
-        values = db_query_range(metric_name, start_ts, end_ts, step=step)
-        if not values:
-            results.append(0.0)
-            continue
-        try:
-            first_val = float(values[0][1])
-            last_val = float(values[-1][1])
-            diff = last_val - first_val
-            if diff < 0:
-                diff = 0.0
-            results.append(round(diff, 2))
-        except Exception as e:
-            print(f"❌ Erreur compute_daily_diffs pour {metric_name} {day}: {e}")
-            results.append(0.0)
+# =======================
+# Exécution concurrente
+# =======================
+# Limite globale des requêtes en vol vers la base, quel que soit le thread appelant.
+# Seuls les appels réseau la prennent (jamais en attendant un autre thread), ce qui évite tout interblocage.
+query_slots = threading.BoundedSemaphore(MAX_IN_FLIGHT)
 
-    return results
 
+def parallel_map(func, items):
+    """
+    Équivalent de list(map(func, items)) exécuté en parallèle.
+    Un pool dédié par appel permet l'imbrication (étape → sous-requêtes) sans interblocage,
+    la concurrence réelle vers la base restant bornée par query_slots.
+    """
+    items = list(items)
+    if len(items) <= 1 or MAX_IN_FLIGHT == 1:
+        return [func(item) for item in items]
+    # Chaque élément s'exécute dans une copie du contexte appelant (compteur en cours)
+    contexts = [contextvars.copy_context() for _ in items]
+    with ThreadPoolExecutor(max_workers=min(len(items), MAX_IN_FLIGHT)) as executor:
+        return list(executor.map(lambda ctx, item: ctx.run(profiled_call, func, item), contexts, items))
 
-# =======================
-# Fonctions métier (adaptées)
-# =======================
-def fetch_yearly_consumption_data(metric_names):
-    tz = pytz.timezone("Europe/Paris")
-    now = datetime.now(tz)
-    current_year = now.year
 
-    current_year_start = datetime(current_year, 1, 1, tzinfo=tz)
-    current_year_end = now
+def submit_in_context(executor, func, *args):
+    """executor.submit exécutant func dans une copie du contexte appelant (compteur en cours)"""
+    return executor.submit(contextvars.copy_context().run, profiled_call, func, *args)
 
-    last_year = current_year - 1
-    last_year_start = datetime(last_year, 1, 1, tzinfo=tz)
-    try:
-        last_year_end = datetime(last_year, now.month, now.day, now.hour, now.minute, tzinfo=tz)
-    except ValueError:
-        # Cas 29/02
-        last_year_end = datetime(last_year, now.month, 28, now.hour, now.minute, tzinfo=tz)
 
-    current_year_consumption = compute_consumption_for_period(metric_names, current_year_start, current_year_end, step=3600, label="année en cours")
-    last_year_consumption = compute_consumption_for_period(metric_names, last_year_start, last_year_end, step=3600, label="année précédente")
+def profiled_call(func, *args):
+    """func(*args), sous cProfile dans ce thread si le cycle en cours est profilé (CycleProfile)"""
+    profile = _cycle_profile.get()
+    return profile.call(func, *args) if profile is not None else func(*args)
 
-    if last_year_consumption > 0:
-        yearly_evolution = ((current_year_consumption - last_year_consumption) / last_year_consumption) * 100
-    else:
-        yearly_evolution = 0.0
 
-    yearly_evolution = round(yearly_evolution, 2)
-    print(f"📊 Consommation année en cours ({current_year_start.date()} → {current_year_end.date()}): {current_year_consumption} kWh")
-    print(f"📊 Consommation année précédente ({last_year_start.date()} → {last_year_end.date()}): {last_year_consumption} kWh")
-    print(f"📊 Évolution annuelle: {yearly_evolution}%")
+# =======================
+# Métriques internes (format Prometheus)
+# =======================
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
 
-    return current_year_consumption, last_year_consumption, yearly_evolution
 
+class MetricsRegistry:
+    """
+    Compteurs, jauges et histogrammes en mémoire, rendus au format texte Prometheus.
+    Chaque métrique est déclarée une fois (type, aide, seuils) puis alimentée par étiquettes.
+    """
 
-def fetch_monthly_consumption_data(metric_names):
-    tz = pytz.timezone("Europe/Paris")
-    now = datetime.now(tz)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.meta = {}
+        self.values = {}
+
+    def declare(self, name, kind, help_text, buckets=None):
+        self.meta[name] = (kind, help_text, buckets)
+        self.values[name] = {}
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels=None, value=1.0):
+        key = self._key(labels)
+        with self.lock:
+            series = self.values[name]
+            series[key] = series.get(key, 0.0) + value
+
+    def set(self, name, value, labels=None):
+        with self.lock:
+            self.values[name][self._key(labels)] = float(value)
+
+    def observe(self, name, value, labels=None):
+        key = self._key(labels)
+        buckets = self.meta[name][2]
+        with self.lock:
+            series = self.values[name]
+            if key not in series:
+                series[key] = [[0] * len(buckets), 0.0, 0]
+            counts, _, _ = state = series[key]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+            state[1] += value
+            state[2] += 1
+
+    @staticmethod
+    def _labels(pairs):
+        if not pairs:
+            return ""
+        escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+    @staticmethod
+    def _number(value):
+        return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (kind, help_text, buckets) in self.meta.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(self.values[name].items()):
+                    if kind != "histogram":
+                        lines.append(f"{name}{self._labels(key)} {self._number(value)}")
+                        continue
+                    counts, total, count = value
+                    for bound, bucket_count in zip(buckets, counts):
+                        lines.append(f"{name}_bucket{self._labels(key + (('le', f'{bound:g}'),))} {bucket_count}")
+                    lines.append(f"{name}_bucket{self._labels(key + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{self._labels(key)} {self._number(total)}")
+                    lines.append(f"{name}_count{self._labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+metrics.declare("linky_stage_duration_seconds", "histogram", "Durée des étapes du cycle", DURATION_BUCKETS)
+metrics.declare("linky_backend_queries_total", "counter", "Requêtes vers la base par type et résultat")
+metrics.declare("linky_backend_query_duration_seconds", "histogram", "Latence des requêtes vers la base", DURATION_BUCKETS)
+metrics.declare("linky_backend_query_points", "histogram", "Points retournés par requête", SIZE_BUCKETS)
+metrics.declare("linky_backend_query_bytes", "histogram", "Octets retournés par requête", SIZE_BUCKETS)
+metrics.declare("linky_mqtt_publish_duration_seconds", "histogram", "Latence des publications MQTT (jusqu'à l'accusé QoS 1)", DURATION_BUCKETS)
+metrics.declare("linky_mqtt_publish_failures_total", "counter", "Publications MQTT en échec")
+metrics.declare("linky_last_successful_cycle_timestamp_seconds", "gauge", "Horodatage du dernier cycle réussi par compteur")
+metrics.declare("linky_cycle_failures_total", "counter", "Cycles en échec par compteur")
+metrics.declare("linky_http_connections_opened_total", "counter", "Connexions HTTP ouvertes vers la base")
+metrics.declare("linky_http_retries_total", "counter", "Nouvelles tentatives HTTP vers la base")
+metrics.declare("linky_query_cache_requests_total", "counter", "Consultations du cache des requêtes par type et résultat (hit, miss)")
+metrics.declare("linky_query_cache_entries", "gauge", "Résultats de requêtes en cache")
+metrics.declare("linky_query_cache_bytes", "gauge", "Taille estimée des résultats de requêtes en cache")
+metrics.declare("linky_query_coalesced_total", "counter", "Requêtes identiques servies par une requête déjà en vol, par type")
+metrics.set("linky_mqtt_publish_failures_total", 0)
+
+# Requêtes en échec pendant un calcul mis en cache (liste partagée par les contextes copiés de
+# parallel_map / submit_in_context): un résultat partiel n'est jamais conservé
+_query_failures = contextvars.ContextVar("query_failures", default=None)
+# Cycle profilé en cours (PROFILE_EVERY) et requêtes de l'étape en cours, partagés de la même façon
+_cycle_profile = contextvars.ContextVar("cycle_profile", default=None)
+_stage_queries = contextvars.ContextVar("stage_queries", default=None)
+
+
+def run_tracking_failures(func, *args):
+    """
+    (func(*args), True si une requête vers la base a échoué pendant l'appel, y compris dans ses sous-threads).
+    L'échec est aussi signalé à un éventuel appel englobant, qui ne doit pas non plus conserver son résultat.
+    """
+    outer = _query_failures.get()
+    failures = []
+    token = _query_failures.set(failures)
+    try:
+        result = func(*args)
+    finally:
+        _query_failures.reset(token)
+    if failures and outer is not None:
+        outer.extend(failures)
+    return result, bool(failures)
+
+
+def record_query(backend, kind, duration, points, size=None, ok=True, retried=False):
+    """retried: tentative en échec qui sera retentée, comptée dans les métriques mais pas comme requête en échec"""
+    labels = {"backend": backend, "kind": kind}
+    metrics.inc("linky_backend_queries_total", {**labels, "status": "ok" if ok else "error"})
+    if not ok and not retried:
+        failures = _query_failures.get()
+        if failures is not None:
+            failures.append(kind)
+    queries = _stage_queries.get()
+    if queries is not None:
+        queries.append((duration, points, size or 0, ok))
+    metrics.observe("linky_backend_query_duration_seconds", duration, labels)
+    if ok:
+        metrics.observe("linky_backend_query_points", points, labels)
+        if size is not None:
+            metrics.observe("linky_backend_query_bytes", size, labels)
+
+
+def timed_stage(stage, func, *args):
+    """
+    Exécute func(*args) en mesurant sa durée dans linky_stage_duration_seconds{stage}
+    et, pour un cycle profilé, sa durée et ses requêtes dans le profil du cycle.
+    """
+    profile = _cycle_profile.get()
+    if profile is not None:
+        queries = []
+        token = _stage_queries.set(queries)
+    t0 = time.time()
+    try:
+        return func(*args)
+    finally:
+        elapsed = time.time() - t0
+        metrics.observe("linky_stage_duration_seconds", elapsed, {"stage": stage})
+        if profile is not None:
+            _stage_queries.reset(token)
+            profile.add_stage(stage, elapsed, queries)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        stats = http_client_stats()
+        metrics.set("linky_http_connections_opened_total", stats["connections_opened"])
+        metrics.set("linky_http_retries_total", stats["retries"])
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_metrics_server(port):
+    """Sert /metrics sur `port` dans un thread de fond"""
+    server = ThreadingHTTPServer(("", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("📈 Métriques Prometheus exposées sur :%d/metrics", port)
+    return server
 
-    # mois précédent
-    if now.month == 1:
-        last_month_year = now.year - 1
-        last_month_month = 12
-    else:
-        last_month_year = now.year
-        last_month_month = now.month - 1
 
-    last_month_start = datetime(last_month_year, last_month_month, 1, tzinfo=tz)
-    if last_month_month == 12:
-        next_month = datetime(last_month_year + 1, 1, 1, tzinfo=tz)
-    else:
-        next_month = datetime(last_month_year, last_month_month + 1, 1, tzinfo=tz)
-    last_month_end = next_month - timedelta(seconds=1)
+# =======================
+# Décodage en flux des séries (query_range)
+# =======================
+# Réponse query_range de VictoriaMetrics (JSON compact):
+#   {"status":"success","data":{"resultType":"matrix","result":[{"metric":{...},"values":[[1700000000,"123.4"],...]},...]}}
+_MATRIX_METRIC = re.compile(rb'"metric"\s*:\s*')
+_MATRIX_VALUES = re.compile(rb'\s*,?\s*"values"\s*:\s*\[')
+_MATRIX_VALUES_END = re.compile(rb'\]\s*\]')
+_MATRIX_EMPTY = re.compile(rb'\s*\]')
+# Fin du tableau "result" (après la dernière série ou tableau vide), puis de l'objet "data"
+_MATRIX_RESULT_END = re.compile(rb'[\}\[]\s*\]\s*\}')
+_MATRIX_POINT = re.compile(rb'\[\s*([^,\]\s]+)\s*,\s*"([^"]*)"\s*\]')
+STREAM_CHUNK_SIZE = 65536
 
-    # même mois année précédente
-    last_year_month_year = last_month_year - 1
-    last_year_month_start = datetime(last_year_month_year, last_month_month, 1, tzinfo=tz)
-    if last_month_month == 12:
-        next_month_last_year = datetime(last_year_month_year + 1, 1, 1, tzinfo=tz)
-    else:
-        next_month_last_year = datetime(last_year_month_year, last_month_month + 1, 1, tzinfo=tz)
-    last_year_month_end = next_month_last_year - timedelta(seconds=1)
 
-    def _compute(start_dt, end_dt, label):
-        return compute_consumption_for_period(metric_names, start_dt, end_dt, step=3600, label=label)
+class TruncatedResponseError(ValueError):
+    """Réponse query_range interrompue avant la fin du JSON (connexion coupée en cours de lecture)"""
 
-    print("📅 Calcul mois précédent et même mois année précédente...")
-    last_month_consumption = _compute(last_month_start, last_month_end, f"mois précédent ({last_month_start.strftime('%B %Y')})")
-    last_month_last_year_consumption = _compute(last_year_month_start, last_year_month_end, f"même mois année précédente ({last_year_month_start.strftime('%B %Y')})")
 
-    if last_month_last_year_consumption > 0:
-        monthly_evolution = ((last_month_consumption - last_month_last_year_consumption) / last_month_last_year_consumption) * 100
-    else:
-        monthly_evolution = 0.0
-    monthly_evolution = round(monthly_evolution, 2)
+class SeriesReducer:
+    """Série complète en tableaux compacts de flottants (8 octets par valeur): (horodatages, valeurs)"""
 
-    print(f"📊 Consommation mois précédent: {last_month_consumption} kWh")
-    print(f"📊 Consommation même mois année précédente: {last_month_last_year_consumption} kWh")
-    print(f"📊 Évolution mensuelle: {monthly_evolution}%")
+    def __init__(self):
+        self.ts = array("d")
+        self.values = array("d")
 
-    return last_month_consumption, last_month_last_year_consumption, monthly_evolution
+    def extend(self, ts, values):
+        self.ts.extend(ts)
+        self.values.extend(values)
 
+    def result(self):
+        return (self.ts, self.values) if self.ts else None
 
-def fetch_current_month_consumption_data(metric_names):
-    tz = pytz.timezone("Europe/Paris")
-    now = datetime.now(tz)
 
-    current_month_start = datetime(now.year, now.month, 1, tzinfo=tz)
-    current_month_end = now
+class FirstLastReducer:
+    """Premier et dernier point seulement, en mémoire constante: (first, last, nombre de points)"""
 
-    last_year = now.year - 1
-    last_year_month_start = datetime(last_year, now.month, 1, tzinfo=tz)
-    try:
-        last_year_month_end = datetime(last_year, now.month, now.day, now.hour, now.minute, tzinfo=tz)
-    except ValueError:
-        last_year_month_end = datetime(last_year, now.month, 28, now.hour, now.minute, tzinfo=tz)
+    def __init__(self):
+        self.first = self.last = None
+        self.count = 0
 
-    current_month_consumption = compute_consumption_for_period(metric_names, current_month_start, current_month_end, step=3600, label=f"mois en cours ({current_month_start.strftime('%B %Y')})")
-    current_month_last_year_consumption = compute_consumption_for_period(metric_names, last_year_month_start, last_year_month_end, step=3600, label=f"même période année précédente ({last_year_month_start.strftime('%B %Y')})")
+    def extend(self, ts, values):
+        if not values:
+            return
+        if self.first is None:
+            self.first = values[0]
+        self.last = values[-1]
+        self.count += len(values)
 
-    if current_month_last_year_consumption > 0:
-        current_month_evolution = ((current_month_consumption - current_month_last_year_consumption) / current_month_last_year_consumption) * 100
-    else:
-        current_month_evolution = 0.0
-    current_month_evolution = round(current_month_evolution, 2)
+    def result(self):
+        return (self.first, self.last, self.count) if self.count else None
 
-    print(f"📊 Consommation mois en cours: {current_month_consumption} kWh")
-    print(f"📊 Consommation même période année précédente: {current_month_last_year_consumption} kWh")
-    print(f"📊 Évolution mois en cours: {current_month_evolution}%")
 
-    return current_month_consumption, current_month_last_year_consumption, current_month_evolution
+def _reduce_matrix_points(acc, segment):
+    """Ajoute les points [ts,"valeur"] complets de `segment` au reducer, retourne leur nombre"""
+    pairs = _MATRIX_POINT.findall(segment)
+    if pairs:
+        acc.extend(array("d", [float(ts) for ts, _ in pairs]), array("d", [float(val) for _, val in pairs]))
+    return len(pairs)
 
 
-def fetch_daily_consumption_data(metric_names):
+def stream_vm_matrix(chunks, reducer):
     """
-    Retourne: (yesterday, day_2, yesterday_evolution)
-    où yesterday = conso hier (jour complet), day_2 = avant-hier (jour complet)
+    Décode au fil de l'eau le corps d'une réponse query_range (itérable de blocs d'octets), sans
+    construire l'objet JSON: les points de chaque série sont convertis en flottants et passés à
+    une instance de `reducer` à mesure de la lecture. La mémoire utilisée ne dépend que de la
+    taille d'un bloc et de ce que le reducer conserve.
+    Retourne ([(labels, résultat du reducer), ...], nombre de points, octets lus).
     """
-    tz = pytz.timezone("Europe/Paris")
-    now = datetime.now(tz)
-    today = now.date()
+    series = []
+    points = size = 0
+    buf = b""
+    labels = acc = None
+    complete = False
+    for chunk in chunks:
+        size += len(chunk)
+        buf += chunk
+        pos = 0
+        while True:
+            if acc is None:
+                # Série suivante: labels complets, puis début du tableau "values"
+                m = _MATRIX_METRIC.search(buf, pos)
+                if not m:
+                    complete = complete or _MATRIX_RESULT_END.search(buf, pos) is not None
+                    pos = max(pos, len(buf) - 16)
+                    break
+                v = _MATRIX_VALUES.search(buf, m.end())
+                if not v:
+                    pos = m.start()
+                    break
+                labels = json.loads(buf[m.end():v.start()])
+                acc = reducer()
+                pos = v.end()
+                continue
+            end = _MATRIX_EMPTY.match(buf, pos) or _MATRIX_VALUES_END.search(buf, pos)
+            if end:
+                points += _reduce_matrix_points(acc, buf[pos:end.end()])
+                series.append((labels, acc.result()))
+                labels = acc = None
+                pos = end.end()
+                continue
+            # Tableau incomplet: points entiers reçus jusqu'ici, le reste attend le bloc suivant
+            last = buf.rfind(b"]", pos)
+            if last >= 0:
+                points += _reduce_matrix_points(acc, buf[pos:last + 1])
+                pos = last + 1
+            break
+        buf = buf[pos:]
+    if acc is not None or not complete:
+        raise TruncatedResponseError("réponse query_range tronquée")
+    return series, points, size
 
-    yesterday = today - timedelta(days=1)
-    yesterday_start = datetime(yesterday.year, yesterday.month, yesterday.day, tzinfo=tz)
-    yesterday_end = yesterday_start + timedelta(days=1) - timedelta(seconds=1)
 
-    day_before_yesterday = today - timedelta(days=2)
-    day_before_start = datetime(day_before_yesterday.year, day_before_yesterday.month, day_before_yesterday.day, tzinfo=tz)
-    day_before_end = day_before_start + timedelta(days=1) - timedelta(seconds=1)
+# =======================
+# Helper: requêtes vers VictoriaMetrics
+# =======================
+# Compteurs du client HTTP partagé
+http_stats = {"requests": 0, "attempts": 0, "retries": 0, "connections_opened": 0}
+_http_stats_lock = threading.Lock()
 
-    def _compute(start_dt, end_dt, label):
-        return compute_consumption_for_period(metric_names, start_dt, end_dt, step=3600, label=label)
 
-    print("📅 Calcul consommation hier et avant-hier...")
-    yesterday_consumption = _compute(yesterday_start, yesterday_end, f"hier ({yesterday.strftime('%d/%m/%Y')})")
-    day_2_consumption = _compute(day_before_start, day_before_end, f"avant-hier ({day_before_yesterday.strftime('%d/%m/%Y')})")
+def _count_http(key, n=1):
+    with _http_stats_lock:
+        http_stats[key] += n
 
-    if day_2_consumption > 0:
-        yesterday_evolution = ((yesterday_consumption - day_2_consumption) / day_2_consumption) * 100
-    else:
-        yesterday_evolution = 0.0
-    yesterday_evolution = round(yesterday_evolution, 2)
 
-    print(f"📊 Consommation hier: {yesterday_consumption} kWh")
-    print(f"📊 Consommation avant-hier: {day_2_consumption} kWh")
-    print(f"📊 Évolution quotidienne: {yesterday_evolution}%")
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    """Pool urllib3 qui compte les connexions ouvertes (les autres requêtes réutilisent une connexion)"""
 
-    return yesterday_consumption, day_2_consumption, yesterday_evolution
+    def _new_conn(self):
+        _count_http("connections_opened")
+        return super()._new_conn()
 
 
-def fetch_tempo_tariffs_and_calculate_costs(dailyweek_HP, dailyweek_HC, dailyweek_Tempo):
-    tz = pytz.timezone("Europe/Paris")
-    now = datetime.now(tz)
-    today = now.date()
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        _count_http("connections_opened")
+        return super()._new_conn()
 
-    # Adaptation des noms de métriques selon le type de DB
-    if DB_TYPE == "influxdb":
-        tariff_metrics = {
-            "BLUE": {"HP": "tarif_bleu_tempo_heures_pleines_ttc", "HC": "sensor.tarif_bleu_tempo_heures_creuses_ttc"},
-            "WHITE": {"HP": "tarif_blanc_tempo_heures_pleines_ttc", "HC": "sensor.tarif_blanc_tempo_heures_creuses_ttc"},
-            "RED": {"HP": "tarif_rouge_tempo_heures_pleines_ttc", "HC": "sensor.tarif_rouge_tempo_heures_creuses_ttc"},
-        }
-    else:
-        tariff_metrics = {
-            "BLUE": {"HP": "sensor.tarif_bleu_tempo_heures_pleines_ttc_value", "HC": "sensor.tarif_bleu_tempo_heures_creuses_ttc_value"},
-            "WHITE": {"HP": "sensor.tarif_blanc_tempo_heures_pleines_ttc_value", "HC": "sensor.tarif_blanc_tempo_heures_creuses_ttc_value"},
-            "RED": {"HP": "sensor.tarif_rouge_tempo_heures_pleines_ttc_value", "HC": "sensor.tarif_rouge_tempo_heures_creuses_ttc_value"},
+
+class _PooledHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
         }
 
-    def get_current_tariff(metric_name):
-        val = db_query_instant(metric_name, timeout=10)
-        if val is None:
-            print(f"⚠️ Pas de données tarifaires pour {metric_name}")
-            return 0.0
-        try:
-            return float(val)
-        except Exception as e:
-            print(f"❌ Erreur parsing tarif {metric_name}: {e}")
-            return 0.0
 
-    dailyweek_cost = []
-    dailyweek_costHP = []
-    dailyweek_costHC = []
+http_session = None
+_http_session_lock = threading.Lock()
 
-    print("💰 Calcul des coûts journaliers avec tarifs Tempo...")
-    for i in range(7):
-        day = today - timedelta(days=i)
-        color = dailyweek_Tempo[i] if i < len(dailyweek_Tempo) else "BLUE"
-        hp_consumption = dailyweek_HP[i] if i < len(dailyweek_HP) else 0.0
-        hc_consumption = dailyweek_HC[i] if i < len(dailyweek_HC) else 0.0
 
-        if color in tariff_metrics:
-            hp_tariff = get_current_tariff(tariff_metrics[color]["HP"])
-            hc_tariff = get_current_tariff(tariff_metrics[color]["HC"])
-        else:
-            print(f"⚠️ Couleur inconnue {color} pour le {day.strftime('%d/%m/%Y')}, utilisation tarif BLEU par défaut")
-            hp_tariff = get_current_tariff(tariff_metrics["BLUE"]["HP"])
-            hc_tariff = get_current_tariff(tariff_metrics["BLUE"]["HC"])
+def get_http_session():
+    """Session HTTP partagée (keep-alive, pool dimensionné sur MAX_IN_FLIGHT, gzip)"""
+    global http_session
+    with _http_session_lock:
+        if http_session is None:
+            session = requests.Session()
+            adapter = _PooledHTTPAdapter(pool_connections=4, pool_maxsize=MAX_IN_FLIGHT, max_retries=0)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+            http_session = session
+    return http_session
 
-        cost_hp = round(hp_consumption * hp_tariff, 2)
-        cost_hc = round(hc_consumption * hc_tariff, 2)
-        total_cost = round(cost_hp + cost_hc, 2)
 
-        dailyweek_costHP.append(cost_hp)
-        dailyweek_costHC.append(cost_hc)
-        dailyweek_cost.append(total_cost)
+def http_client_stats():
+    """Instantané des compteurs HTTP, avec le nombre de connexions réutilisées"""
+    with _http_stats_lock:
+        stats = dict(http_stats)
+    stats["connections_reused"] = max(0, stats["attempts"] - stats["connections_opened"])
+    return stats
 
-        print(f"💰 {day.strftime('%d/%m/%Y')} ({color}): HP={hp_consumption}kWh×{hp_tariff/100:.4f}€ + HC={hc_consumption}kWh×{hc_tariff/100:.4f}€ = {total_cost}€")
 
-    print(f"💰 Coûts totaux journaliers: {dailyweek_cost}")
-    print(f"💰 Coûts HP journaliers: {dailyweek_costHP}")
-    print(f"💰 Coûts HC journaliers: {dailyweek_costHC}")
+def vm_get(url, params, timeout, reducer=None):
+    """
+    GET vers VictoriaMetrics via la session partagée, dans la limite de MAX_IN_FLIGHT requêtes simultanées.
+    Les erreurs 5xx, timeouts et coupures réseau (y compris pendant la lecture du corps) sont retentés VM_MAX_RETRIES fois
+    avec un délai exponentiel aléatoire; l'erreur finale est propagée à l'appelant.
+    reducer: réponse query_range décodée en flux (stream_vm_matrix), retourne alors [(labels, résultat)].
+    """
+    session = get_http_session()
+    kind = "range" if url.endswith("/query_range") else "instant"
+    _count_http("requests")
+    for attempt in range(VM_MAX_RETRIES + 1):
+        t0 = time.time()
+        try:
+            _count_http("attempts")
+            with query_slots:
+                r = session.get(url, params=params, timeout=timeout, stream=reducer is not None)
+                # Fermée dans tous les cas: connexion rendue au pool si le corps a été lu, libérée sinon
+                try:
+                    if r.status_code < 500 or attempt == VM_MAX_RETRIES:
+                        r.raise_for_status()
+                        if reducer is not None:
+                            # Corps lu et réduit dans la limite des requêtes en vol, comme une lecture complète
+                            data, points, size = stream_vm_matrix(r.iter_content(STREAM_CHUNK_SIZE), reducer)
+                        else:
+                            data = r.json()
+                            result = data.get("data", {}).get("result", [])
+                            points = sum(len(res.get("values", ())) or 1 for res in result) if isinstance(result, list) else 0
+                            size = len(r.content)
+                        record_query("victoriametrics", kind, time.time() - t0, points, size)
+                        return data
+                finally:
+                    r.close()
+            error = f"HTTP {r.status_code}"
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                TruncatedResponseError) as e:
+            # Coupure réseau, y compris en cours de lecture du corps: retentée
+            record_query("victoriametrics", kind, time.time() - t0, 0, ok=False, retried=attempt < VM_MAX_RETRIES)
+            if attempt == VM_MAX_RETRIES:
+                raise
+            error = e
+        except requests.HTTPError:
+            record_query("victoriametrics", kind, time.time() - t0, 0, ok=False)
+            raise
+        except Exception:
+            # Réponse illisible: comptée en échec, jamais retentée
+            record_query("victoriametrics", kind, time.time() - t0, 0, ok=False)
+            raise
+        record_query("victoriametrics", kind, time.time() - t0, 0, ok=False, retried=True)
+        # Backoff exponentiel avec jitter, hors du sémaphore pour ne pas bloquer les autres requêtes
+        delay = VM_RETRY_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5)
+        _count_http("retries")
+        logger.warning("🔁 Nouvelle tentative %d/%d dans %.1fs (%s)", attempt + 1, VM_MAX_RETRIES, delay, error)
+        time.sleep(delay)
+
+
+def vm_query_range(vm_host, vm_port, metric, start_ts, end_ts, step=3600, timeout=VM_TIMEOUT_RANGE, reducer=None):
+    """Requête de plage d'une métrique: résultat du reducer (SeriesReducer par défaut), None sans donnée"""
+    url = f"http://{vm_host}:{vm_port}/api/v1/query_range"
+    params = {"query": vm_series_selector(metric), "start": int(start_ts), "end": int(end_ts), "step": int(step)}
+    try:
+        series = vm_get(url, params, timeout, reducer=reducer or SeriesReducer)
+        return series[0][1] if series else None
+    except Exception as e:
+        logger.error("❌ Erreur vm_query_range pour %s: %s", metric, e)
+        return None
 
-    return dailyweek_cost, dailyweek_costHP, dailyweek_costHC
 
+def vm_query_instant(vm_host, vm_port, metric, timeout=VM_TIMEOUT_INSTANT):
+    url = f"http://{vm_host}:{vm_port}/api/v1/query"
+    params = {"query": vm_series_selector(metric)}
+    try:
+        data = vm_get(url, params, timeout)
+        res_list = data.get("data", {}).get("result", [])
+        if res_list and res_list[0].get("value"):
+            return res_list[0]["value"][1]
+        return None
+    except Exception as e:
+        logger.error("❌ Erreur vm_query_instant pour %s: %s", metric, e)
+        return None
 
-def fetch_daily_max_power(metric_name, days=7):
-    tz = pytz.timezone("Europe/Paris")
-    now = datetime.now(tz)
-    today = now.date()
 
-    max_values = []
-    max_times = []
+def vm_series_selector(metric):
+    """Sélecteur d'une métrique, avec le filtre de labels du compteur en cours s'il en a un"""
+    label_filter = active_meter().series_filter([metric])
+    return f"{metric}{{{label_filter}}}" if label_filter else metric
 
-    for i in range(days):
-        day = today - timedelta(days=i)
-        start_dt = datetime(year=day.year, month=day.month, day=day.day, tzinfo=tz)
-        end_dt = now if day == today else (start_dt + timedelta(days=1))
 
-        start_ts = int(start_dt.timestamp())
-        end_ts = int(end_dt.timestamp())
+def vm_name_selector(metrics):
+    """Sélecteur MetricsQL couvrant plusieurs noms de métriques en une seule requête"""
+    pattern = "|".join(re.escape(m) for m in metrics)
+    label_filter = active_meter().series_filter(metrics)
+    # Les backslashes du regex doivent être échappés dans la chaîne MetricsQL
+    return '{__name__=~"%s"%s}' % (pattern.replace("\\", "\\\\"), f",{label_filter}" if label_filter else "")
 
-        values = db_query_range(metric_name, start_ts, end_ts, step=60)
-        if not values:
-            max_values.append(0)
-            max_times.append(start_dt.strftime("%Y-%m-%d 00:00:00"))
-            continue
 
-        max_val = -1.0
-        max_ts = start_ts
-        for ts, val in values:
-            try:
-                v = float(val) / 1000.0  # conversion VA → kVA
-                tss = int(float(ts))
-                if v > max_val:
-                    max_val = v
-                    max_ts = tss
-            except Exception:
-                continue
+def vm_query_range_multi(vm_host, vm_port, metrics, start_ts, end_ts, step=3600, timeout=VM_TIMEOUT_RANGE,
+                         rollup=None, window=None, reducer=None):
+    """
+    Requête de plage pour plusieurs métriques en un seul appel, décodée en flux.
+    Retourne {metric: résultat du reducer}, par défaut (horodatages, valeurs) en tableaux compacts
+    (SeriesReducer); une métrique sans donnée est absente.
+    rollup/window: fonction MetricsQL appliquée sur la fenêtre [window] secondes, ex. max_over_time.
+    """
+    url = f"http://{vm_host}:{vm_port}/api/v1/query_range"
+    query = vm_name_selector(metrics)
+    if rollup:
+        query = f"{rollup}({query}[{int(window)}s]) keep_metric_names"
+    params = {"query": query, "start": int(start_ts), "end": int(end_ts), "step": int(step)}
+    results = {}
+    try:
+        for labels, reduced in vm_get(url, params, timeout, reducer=reducer or SeriesReducer):
+            name = labels.get("__name__")
+            # Comme vm_query_range: on garde la première série trouvée pour chaque métrique
+            if name in metrics and name not in results and reduced is not None:
+                results[name] = reduced
+    except Exception as e:
+        logger.error("❌ Erreur vm_query_range_multi pour %d métriques: %s", len(metrics), e)
+    return results
 
-        if max_val < 0:
-            max_values.append(0)
-            max_times.append(start_dt.strftime("%Y-%m-%d 00:00:00"))
-        else:
-            max_values.append(round(max_val, 2))
-            max_times.append(datetime.fromtimestamp(max_ts, tz=tz).strftime("%Y-%m-%d %H:%M:%S"))
 
-    return max_values, max_times
+def vm_query_instant_multi(vm_host, vm_port, metrics, eval_ts=None, timeout=VM_TIMEOUT_INSTANT, rollup=None, window=None):
+    """
+    Requête instantanée pour plusieurs métriques (à eval_ts, ou maintenant), résultat indexé par métrique.
+    rollup/window: fonction MetricsQL appliquée sur la fenêtre [window] secondes, ex. last_over_time.
+    """
+    url = f"http://{vm_host}:{vm_port}/api/v1/query"
+    query = vm_name_selector(metrics)
+    if rollup:
+        # keep_metric_names: sans lui les fonctions *_over_time suppriment __name__
+        query = f"{rollup}({query}[{int(window)}s]) keep_metric_names"
+    params = {"query": query}
+    if eval_ts is not None:
+        params["time"] = int(eval_ts)
+    results = {}
+    try:
+        data = vm_get(url, params, timeout)
+        for res in data.get("data", {}).get("result", []):
+            name = res.get("metric", {}).get("__name__")
+            if name in metrics and name not in results and res.get("value"):
+                results[name] = res["value"][1]
+    except Exception as e:
+        logger.error("❌ Erreur vm_query_instant_multi pour %d métriques: %s", len(metrics), e)
+    return results
 
 
-def fetch_daily_tempo_colors(days=7):
-    tz = pytz.timezone("Europe/Paris")
-    now = datetime.now(tz)
-    today = now.date()
-    colors = []
+def vm_query_boundaries(vm_host, vm_port, metrics, start_ts, end_ts, timeout=VM_TIMEOUT_RANGE):
+    """
+    Premier point à partir de start_ts et dernier point jusqu'à end_ts pour plusieurs métriques,
+    en deux requêtes instantanées (first_over_time / last_over_time) dont la taille ne dépend pas de la période.
+    Retourne {metric: (first, last)}, une métrique sans donnée est absente.
+    """
+    window = int(end_ts) - int(start_ts) + 1
+    firsts, lasts = parallel_map(
+        lambda rollup: vm_query_instant_multi(vm_host, vm_port, metrics, eval_ts=end_ts, timeout=timeout,
+                                              rollup=rollup, window=window),
+        ["first_over_time", "last_over_time"])
+    return {metric: (firsts[metric], lasts[metric]) for metric in metrics if metric in firsts and metric in lasts}
 
-    # Adaptation des noms de métriques selon le type de DB
-    if DB_TYPE == "influxdb":
-        tempo_metrics = {
-            "BLUE": [METRIC_NAMEhpjb, METRIC_NAMEhcjb],
-            "WHITE": [METRIC_NAMEhpjw, METRIC_NAMEhcjw],
-            "RED": [METRIC_NAMEhpjr, METRIC_NAMEhcjr],
-        }
-    else:
-        tempo_metrics = {
-            "BLUE": [METRIC_NAMEhpjb, METRIC_NAMEhcjb],
-            "WHITE": [METRIC_NAMEhpjw, METRIC_NAMEhcjw],
-            "RED": [METRIC_NAMEhpjr, METRIC_NAMEhcjr],
-        }
 
-    for i in range(days):
-        day = today - timedelta(days=i)
-        start_dt = datetime(year=day.year, month=day.month, day=day.day, hour=0, tzinfo=tz)
-        end_dt = start_dt + timedelta(days=1)
-
-        detected_color = "UNKNOWN"
-        for color, metrics in tempo_metrics.items():
-            stop = False
-            for metric in metrics:
-                values = db_query_range(metric, int(start_dt.timestamp()), int(end_dt.timestamp()), step=300)
-                if not values:
-                    continue
-                for _, v in values:
-                    try:
-                        if float(v) > 0:
-                            detected_color = color
-                            stop = True
-                            break
-                    except Exception:
-                        continue
-                if stop:
-                    break
-            if detected_color != "UNKNOWN":
-                break
-        colors.append(detected_color)
-
-    return colors
+def vm_query_daily_max(vm_host, vm_port, metric, day_bounds, timeout=VM_TIMEOUT_RANGE):
+    """
+    Maximum journalier et son horodatage, calculés par VictoriaMetrics (max_over_time / tmax_over_time):
+      - jours complets: maxima horaires sur toute la plage en deux requêtes, réduits par jour
+        (le pas horaire tombe sur chaque minuit de Paris, contrairement à un pas de 86400 aux changements d'heure)
+      - jour en cours: deux requêtes instantanées sur la fenêtre minuit → maintenant
+    Retourne {jour: (max, ts)}, un jour sans donnée est absent.
+    """
+    results = {}
+    full_days = [b for b in day_bounds if b[2] % 3600 == 0]
+    partial_days = [b for b in day_bounds if b[2] % 3600 != 0]
+
+    jobs = []
+    if full_days:
+        range_start = min(b[1] for b in full_days) + 3600
+        range_end = max(b[2] for b in full_days)
+        for rollup in ("max_over_time", "tmax_over_time"):
+            jobs.append(lambda rollup=rollup: vm_query_range_multi(
+                vm_host, vm_port, [metric], range_start, range_end, step=3600, timeout=timeout,
+                rollup=rollup, window=3600).get(metric, ((), ())))
+    def partial_day(rollup, start_ts, end_ts):
+        # Une seule fenêtre minuit → maintenant, au même format que les séries de plage
+        val = vm_query_instant_multi(vm_host, vm_port, [metric], eval_ts=end_ts, timeout=timeout,
+                                     rollup=rollup, window=end_ts - start_ts + 1).get(metric)
+        return ((end_ts,), (float(val),)) if val is not None else ((), ())
+
+    for _, start_ts, end_ts in partial_days:
+        for rollup in ("max_over_time", "tmax_over_time"):
+            jobs.append(lambda rollup=rollup, start_ts=start_ts, end_ts=end_ts: partial_day(rollup, start_ts, end_ts))
+    answers = parallel_map(lambda job: job(), jobs)
+
+    # Couples (fin de fenêtre, max, ts du max), chaque fenêtre couvrant ]fin - durée, fin]
+    windows = []
+    for (ts_max, maxima), (ts_tmax, tmaxima) in zip(answers[0::2], answers[1::2]):
+        tmax_by_ts = {int(ts): val for ts, val in zip(ts_tmax, tmaxima)}
+        for ts, val in zip(ts_max, maxima):
+            end = int(ts)
+            windows.append((end, val, int(tmax_by_ts.get(end, end))))
+
+    for day, start_ts, end_ts in day_bounds:
+        best = None
+        for end, val, max_ts in sorted(windows):
+            if start_ts < end <= end_ts and (best is None or val > best[0]):
+                best = (val, max_ts)
+        if best is not None:
+            results[day] = best
+    return results
 
 
-def compute_weekly_consumption(daily_14):
+def vm_query_daily_increase(vm_host, vm_port, metrics, day_bounds, timeout=VM_TIMEOUT_RANGE):
     """
-    daily_14 : liste des 14 derniers jours (0 = aujourd'hui, 13 = 13 jours avant)
+    Consommation par jour (last - first) pour plusieurs métriques en deux requêtes:
+      - une requête de plage au pas horaire, dont les points tombent sur chaque minuit de Paris
+        (décalage UTC toujours entier, y compris aux changements d'heure, ce qu'un pas de 86400 ne garantit pas)
+      - une requête instantanée pour la dernière valeur du jour en cours
+    day_bounds: liste de (jour, start_ts, end_ts).
+    Retourne {metric: {jour: (first, last, diff)}}, un jour sans donnée est absent.
     """
-    current_week = sum(daily_14[:7])
-    last_week = sum(daily_14[7:14])
-    current_week_evolution = ((current_week - last_week) / last_week * 100) if last_week else 0.0
+    results = {metric: {} for metric in metrics}
+    if not day_bounds:
+        return results
+    range_start = min(start_ts for _, start_ts, _ in day_bounds)
+    range_end = max(end_ts for _, _, end_ts in day_bounds)
+    series, latest = parallel_map(lambda query: query(), [
+        lambda: vm_query_range_multi(vm_host, vm_port, metrics, range_start, range_end, step=3600, timeout=timeout),
+        lambda: vm_query_instant_multi(vm_host, vm_port, metrics, eval_ts=range_end, timeout=timeout),
+    ])
 
-    print(f"🗓️ Current week: {current_week} kWh")
-    print(f"🗓️ Last week:    {last_week} kWh")
-    print(f"📊 Evolution:    {current_week_evolution:.2f} %")
+    for metric in metrics:
+        points = list(zip(*series.get(metric, ((), ()))))
+        try:
+            if metric in latest:
+                points.append((range_end, float(latest[metric])))
+        except Exception:
+            pass
+        for day, start_ts, end_ts in day_bounds:
+            # Même logique que le scan minute: premier et dernier point disponibles sur la journée
+            day_points = [val for ts, val in points if start_ts <= ts <= end_ts]
+            if day_points:
+                results[metric][day] = (day_points[0], day_points[-1], day_points[-1] - day_points[0])
+    return results
 
-    return current_week, last_week, round(current_week_evolution, 2)
 
+def vm_import(vm_host, vm_port, points, timeout=VM_TIMEOUT_RANGE):
+    """
+    Écrit des points [(nom, labels, ts, valeur)] via /api/v1/import en une seule requête
+    (une ligne JSON par série). Une erreur est propagée: les points seront réécrits au cycle suivant.
+    """
+    series = {}
+    for name, labels, ts, value in points:
+        key = (name, tuple(sorted(labels.items())))
+        line = series.setdefault(key, {"metric": {"__name__": name, **labels}, "values": [], "timestamps": []})
+        line["values"].append(value)
+        line["timestamps"].append(int(ts) * 1000)
+    body = "\n".join(json.dumps(line) for line in series.values()).encode()
+    t0 = time.time()
+    try:
+        with query_slots:
+            r = get_http_session().post(f"http://{vm_host}:{vm_port}/api/v1/import", data=body, timeout=timeout)
+        r.raise_for_status()
+    except Exception:
+        record_query("victoriametrics", "write", time.time() - t0, 0, ok=False)
+        raise
+    record_query("victoriametrics", "write", time.time() - t0, len(points), len(body))
 
 # =======================
-# Build payload (identique au script original)
+# Helper: requêtes vers InfluxDB v2
 # =======================
-def build_linky_payload_exact(dailyweek_HP=None, dailyweek_HC=None,
-                              dailyweek_MP=None, dailyweek_MP_time=None,
-                              dailyweek_Tempo=None, current_week=0, last_week=0, current_week_evolution=0,
-                              current_year=0, current_year_last_year=0, yearly_evolution=0,
-                              last_month=0, last_month_last_year=0, monthly_evolution=0,
-                              current_month=0, current_month_last_year=0, current_month_evolution=0,
-                              yesterday=0, day_2=0, yesterday_evolution=0,
-                              dailyweek_cost=None, dailyweek_costHP=None, dailyweek_costHC=None):
-    tz = pytz.timezone("Europe/Paris")
-    today = datetime.now(tz).date()
+def influx_query_rows(query, kind="range"):
+    """
+    Exécute une requête Flux et parcourt le résultat en flux via l'API CSV du client,
+    sans matérialiser de FluxTable/FluxRecord: chaque ligne est un dict {colonne: texte}.
+    La requête reste dans la limite de MAX_IN_FLIGHT requêtes simultanées jusqu'à la fin de la lecture.
+    kind: "range" ou "instant", pour les métriques internes (octets estimés depuis les cellules CSV).
+    """
+    from influxdb_client import Dialect
 
-    dailyweek_dates = [(today - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(7)]
-    hp = dailyweek_HP if dailyweek_HP else [0.0]*7
-    hc = dailyweek_HC if dailyweek_HC else [0.0]*7
-    mp = dailyweek_MP if dailyweek_MP else [0]*7
-    mp_time = dailyweek_MP_time if dailyweek_MP_time else [today.strftime("%Y-%m-%d 00:00:00")]*7
-    tempo = dailyweek_Tempo if dailyweek_Tempo else ["UNKNOWN"]*7
-    daily = [round(hp[i] + hc[i], 2) for i in range(7)]
+    get_influx_client()
+    dialect = Dialect(header=True, annotations=[], date_time_format="RFC3339")
+    t0 = time.time()
+    rows = size = 0
+    ok = False
+    try:
+        with query_slots:
+            header = None
+            for row in influx_query_api.query_csv(query, dialect=dialect):
+                size += sum(len(cell) + 1 for cell in row)
+                if not any(row):
+                    # Ligne vide: nouvelle table, nouvel en-tête
+                    header = None
+                    continue
+                if header is None or ("result" in row and "table" in row):
+                    header = row
+                    continue
+                rows += 1
+                yield dict(zip(header, row))
+        ok = True
+    finally:
+        record_query("influxdb", kind, time.time() - t0, rows, size, ok=ok)
 
-    # Utilisation des coûts calculés ou valeurs par défaut
-    cost = dailyweek_cost if dailyweek_cost else [1.2,1.3,1.1,1.4,1.3,1.2,1.3]
-    cost_hp = dailyweek_costHP if dailyweek_costHP else [0.7,0.7,0.6,0.8,0.8,0.6,0.8]
-    cost_hc = dailyweek_costHC if dailyweek_costHC else [0.5,0.6,0.5,0.6,0.5,0.6,0.5]
 
-    payload = {
-        "serviceEnedis": "myElectricalData",
-        "typeCompteur": "consommation",
-        "unit_of_measurement": "kWh",
-        "current_year": current_year,
-        "current_year_last_year": current_year_last_year,
-        "yearly_evolution": yearly_evolution,
-        "last_month": last_month,
-        "last_month_last_year": last_month_last_year,
-        "monthly_evolution": monthly_evolution,
-        "current_month": current_month,
-        "current_month_last_year": current_month_last_year,
-        "current_month_evolution": current_month_evolution,
-        "current_week": current_week,
-        "last_week": last_week,
-        "current_week_evolution": current_week_evolution,
-        "yesterday": yesterday,
-        "day_2": day_2,
-        "yesterday_evolution": yesterday_evolution,
-        "daily": daily,
-        "dailyweek": dailyweek_dates,
-        "dailyweek_cost": cost,
-        "dailyweek_costHC": cost_hc,
-        "dailyweek_costHP": cost_hp,
-        "dailyweek_HC": hc,
-        "daily_cost": cost[0] if cost else 0.0,
-        "yesterday_HP": hp[1] if len(hp) > 1 else 0,
-        "yesterday_HC": hc[1] if len(hc) > 1 else 0,
-        "dailyweek_HP": hp,
-        "dailyweek_MP": mp,
-        "dailyweek_MP_over": [val > 7 for val in mp],
-        "dailyweek_MP_time": mp_time,
-        "dailyweek_Tempo": tempo,
-        "errorLastCall": "",
-        "versionUpdateAvailable": False,
-        "versionGit": "1.0.0",
-        "peak_offpeak_percent": 45
-    }
-    return payload
+def influx_ts(value):
+    """Horodatage RFC3339 du CSV Flux → timestamp unix"""
+    return int(datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp())
 
 
-# =======================
-# SCRIPT PRINCIPAL
-# =======================
-def main():
-    print(f"📊 Base de données configurée: {DB_TYPE.upper()}")
-    if DB_TYPE == "influxdb":
-        if not INFLUXDB_AVAILABLE:
-            print("❌ InfluxDB sélectionné mais bibliothèque non disponible")
-            sys.exit(1)
-        print(f"📊 InfluxDB - URL: {INFLUXDB_URL}, ORG: {INFLUXDB_ORG}, BUCKET: {INFLUXDB_BUCKET}")
-    else:
-        print(f"📊 VictoriaMetrics - Host: {VM_HOST}:{VM_PORT}")
+def influx_rfc(ts):
+    """Timestamp unix → RFC3339 pour range()"""
+    return datetime.fromtimestamp(ts, tz=pytz.UTC).isoformat()
 
-    client = mqtt.Client(protocol=mqtt.MQTTv5)
-    evt = threading.Event()
 
-    def on_connect(c, u, flags, rc, props=None):
-        if rc == 0:
-            print("✅ MQTT connecté")
-            evt.set()
-        else:
-            print(f"❌ MQTT échec (rc={rc})")
+def influx_entity_filter(entity_ids):
+    """Filtre Flux sur un ensemble d'entity_id (une seule requête pour toutes les entités)"""
+    entity_set = ", ".join(f'"{entity_id}"' for entity_id in entity_ids)
+    return f'filter(fn: (r) => contains(value: r["entity_id"], set: [{entity_set}]))'
 
-    client.on_connect = on_connect
-    if LOGIN and PASSWORD:
-        client.username_pw_set(LOGIN, PASSWORD)
 
-    client.loop_start()
+def influx_pivot_query(entity_ids, start_time, end_time, every, fn, time_src="_stop"):
+    """
+    Requête Flux multi-entités pivotée: une ligne par fenêtre, une colonne par entity_id.
+    Les fenêtres sont alignées sur Europe/Paris (utile pour every: 1d).
+    """
+    return f'''
+        import "timezone"
+        option location = timezone.location(name: "Europe/Paris")
+        from(bucket: "{active_meter().influx_bucket}")
+        |> range(start: {influx_rfc(start_time)}, stop: {influx_rfc(end_time)})
+        |> {influx_entity_filter(entity_ids)}
+        |> filter(fn: (r) => r["_field"] == "value")
+        |> aggregateWindow(every: {every}, fn: {fn}, createEmpty: false, timeSrc: "{time_src}")
+        |> keep(columns: ["_time", "_value", "entity_id"])
+        |> group()
+        |> pivot(rowKey: ["_time"], columnKey: ["entity_id"], valueColumn: "_value")
+        '''
+
+
+def influx_query_range(entity_id, start_time, end_time, step="1h", reducer=None):
+    """Requête de plage pour InfluxDB v2 (même résultat que vm_query_range)"""
+    return influx_query_range_multi([entity_id], start_time, end_time, step, reducer).get(entity_id)
+
+
+def influx_query_instant(entity_id):
+    """Requête instantanée pour InfluxDB v2"""
+    return influx_query_instant_multi([entity_id]).get(entity_id)
+
+
+def influx_query_instant_multi(entity_ids):
+    """Requête instantanée InfluxDB v2 pour plusieurs entity_id en une seule requête Flux"""
+    results = {}
     try:
-        client.connect(MQTT_HOST, MQTT_PORT, 60)
+        query = f'''
+        from(bucket: "{active_meter().influx_bucket}")
+        |> range(start: -1h)
+        |> {influx_entity_filter(entity_ids)}
+        |> filter(fn: (r) => r["_field"] == "value")
+        |> last()
+        '''
+
+        for row in influx_query_rows(query, kind="instant"):
+            entity_id = row.get("entity_id")
+            if entity_id in entity_ids and entity_id not in results and row.get("_value"):
+                results[entity_id] = row["_value"]
     except Exception as e:
-        print(f"❌ Connexion MQTT impossible: {e}")
-        sys.exit(1)
+        logger.error("❌ Erreur influx_query_instant_multi pour %d entités: %s", len(entity_ids), e)
+    return results
 
-    if not evt.wait(timeout=10):
-        print("⛔ Timeout MQTT")
-        sys.exit(1)
 
-    # Discovery Linky
-    linky_discovery_payload = {
-        "name": SENSOR_NAME.replace("_", " ").title(),
-        "state_topic": LINKY_STATE_TOPIC,
-        "value_template": "{{ value_json.current_year }}",
-        "json_attributes_topic": LINKY_STATE_TOPIC,
-        "unit_of_measurement": "kWh",
-        "device_class": "energy",
-        "icon": "mdi:counter",
-        "unique_id": f"{SENSOR_NAME}_sensor",
-        "device": {
-            "identifiers": [SENSOR_NAME],
-            "name": f"Compteur {SENSOR_NAME.replace('_', ' ').title()}",
-            "manufacturer": "Enedis",
-            "model": "Linky"
-        }
-    }
-    client.publish(LINKY_DISCOVERY_TOPIC, json.dumps(linky_discovery_payload), qos=1, retain=True)
+def influx_query_range_multi(entity_ids, start_time, end_time, step="1h", reducer=None):
+    """
+    Requête de plage InfluxDB v2 pour plusieurs entity_id en une seule requête Flux pivotée.
+    Lignes réduites à mesure de la lecture, même résultat que vm_query_range_multi.
+    """
+    accs = {}
+    try:
+        query = influx_pivot_query(entity_ids, start_time, end_time, every=step, fn="last")
+        for row in influx_query_rows(query):
+            timestamp = influx_ts(row["_time"])
+            for entity_id in entity_ids:
+                if row.get(entity_id):
+                    if entity_id not in accs:
+                        accs[entity_id] = (reducer or SeriesReducer)()
+                    accs[entity_id].extend((timestamp,), (float(row[entity_id]),))
+    except Exception as e:
+        logger.error("❌ Erreur influx_query_range_multi pour %d entités: %s", len(entity_ids), e)
+    return {entity_id: acc.result() for entity_id, acc in accs.items()}
 
-    print("\n--- Boucle MQTT démarrée ---")
-    current_day = datetime.now(pytz.timezone("Europe/Paris")).date()
 
-    tempo_metrics = [METRIC_NAMEhpjb, METRIC_NAMEhcjb, METRIC_NAMEhpjw,
-                     METRIC_NAMEhcjw, METRIC_NAMEhpjr, METRIC_NAMEhcjr]
+def influx_query_boundaries(entity_ids, start_time, end_time):
+    """
+    Premier et dernier point de la période pour plusieurs entity_id en une requête Flux (first() / last()).
+    Retourne {entity_id: (first, last)}.
+    """
+    firsts, lasts = {}, {}
+    try:
+        query = f'''
+        data = from(bucket: "{active_meter().influx_bucket}")
+        |> range(start: {influx_rfc(start_time)}, stop: {influx_rfc(end_time + 1)})
+        |> {influx_entity_filter(entity_ids)}
+        |> filter(fn: (r) => r["_field"] == "value")
+        data |> first() |> yield(name: "first")
+        data |> last() |> yield(name: "last")
+        '''
 
-    while True:
-        now_dt = datetime.now(pytz.timezone("Europe/Paris"))
-        today = now_dt.date()
-        if today != current_day:
-            print("🔄 Changement de jour détecté, rafraîchissement complet")
-            current_day = today
-
-        # HP / HC pour 14 derniers jours (chaque metric séparément)
-        hpjb_14 = compute_daily_diffs(METRIC_NAMEhpjb, days=14)
-        hpjw_14 = compute_daily_diffs(METRIC_NAMEhpjw, days=14)
-        hpjr_14 = compute_daily_diffs(METRIC_NAMEhpjr, days=14)
-        hcjb_14 = compute_daily_diffs(METRIC_NAMEhcjb, days=14)
-        hcjw_14 = compute_daily_diffs(METRIC_NAMEhcjw, days=14)
-        hcjr_14 = compute_daily_diffs(METRIC_NAMEhcjr, days=14)
+        for row in influx_query_rows(query):
+            entity_id = row.get("entity_id")
+            value = row.get("_value")
+            if entity_id not in entity_ids or not value:
+                continue
+            if row.get("result") == "first":
+                firsts.setdefault(entity_id, value)
+            else:
+                lasts[entity_id] = value
+    except Exception as e:
+        logger.error("❌ Erreur influx_query_boundaries pour %d entités: %s", len(entity_ids), e)
+    return {entity_id: (firsts[entity_id], lasts[entity_id]) for entity_id in entity_ids
+            if entity_id in firsts and entity_id in lasts}
 
-        daily_14 = [round(hpjb_14[i] + hpjw_14[i] + hpjr_14[i] + hcjb_14[i] + hcjw_14[i] + hcjr_14[i], 2) for i in range(14)]
 
-        # Calcul des semaines
-        current_week, last_week, current_week_evolution = compute_weekly_consumption(daily_14)
+def influx_query_daily_max(entity_id, day_bounds):
+    """
+    Maximum journalier et son horodatage en une requête Flux:
+    fenêtres d'un jour alignées sur minuit Europe/Paris, max() conservant le _time du point maximal.
+    Retourne {jour: (max, ts)}.
+    """
+    tz = pytz.timezone("Europe/Paris")
+    results = {}
+    if not day_bounds:
+        return results
+    try:
+        wanted_days = {b[0] for b in day_bounds}
+        query = f'''
+        import "timezone"
+        from(bucket: "{active_meter().influx_bucket}")
+        |> range(start: {influx_rfc(min(b[1] for b in day_bounds))}, stop: {influx_rfc(max(b[2] for b in day_bounds) + 1)})
+        |> filter(fn: (r) => r["entity_id"] == "{entity_id}")
+        |> filter(fn: (r) => r["_field"] == "value")
+        |> window(every: 1d, location: timezone.location(name: "Europe/Paris"))
+        |> max()
+        |> keep(columns: ["_start", "_time", "_value"])
+        '''
 
-        # Calcul des données annuelles
-        print("\n📊 Calcul des données annuelles...")
-        current_year, current_year_last_year, yearly_evolution = fetch_yearly_consumption_data(tempo_metrics)
+        for row in influx_query_rows(query):
+            if not row.get("_value"):
+                continue
+            day = datetime.fromtimestamp(influx_ts(row["_start"]), tz=tz).date()
+            value = float(row["_value"])
+            if day in wanted_days and (day not in results or value > results[day][0]):
+                results[day] = (value, influx_ts(row["_time"]))
+    except Exception as e:
+        logger.error("❌ Erreur influx_query_daily_max pour %s: %s", entity_id, e)
+    return results
+
+
+def influx_query_daily_increase(entity_ids, day_bounds):
+    """
+    Consommation par jour pour plusieurs entity_id en une requête Flux pivotée, avec les mêmes bornes
+    que vm_query_daily_increase: index à minuit (dernière valeur reçue jusqu'à minuit inclus) soustrait
+    de l'index au minuit suivant (ou à la fin de la plage pour le jour en cours).
+    Fenêtres d'un jour alignées sur minuit Europe/Paris et décalées d'1 ns, soit ]minuit, minuit suivant]:
+    last() d'une fenêtre est l'index au minuit qui la termine, first() sert d'index de départ
+    quand la veille n'a aucune donnée (comme le premier point disponible côté VictoriaMetrics).
+    Seul écart: avec un pas de 3600 s, l'index à minuit de VictoriaMetrics est la dernière valeur de l'heure
+    précédant minuit (fenêtre de lookback d'un pas), celui-ci la dernière valeur de toute la veille;
+    les deux bases ne diffèrent donc qu'après plus d'une heure sans mesure avant minuit.
+    Retourne {entity_id: {jour: (first, last, diff)}}, un jour sans donnée est absent.
+    """
+    tz = pytz.timezone("Europe/Paris")
+    results = {entity_id: {} for entity_id in entity_ids}
+    if not day_bounds:
+        return results
+    try:
+        wanted_days = {b[0] for b in day_bounds}
+        # La veille du premier jour donne son index de départ
+        start_ts = paris_midnight(min(wanted_days) - timedelta(days=1)).timestamp()
+        query = f'''
+        import "timezone"
+        option location = timezone.location(name: "Europe/Paris")
+        data = from(bucket: "{active_meter().influx_bucket}")
+        |> range(start: {influx_rfc(start_ts)}, stop: {influx_rfc(max(b[2] for b in day_bounds) + 1)})
+        |> {influx_entity_filter(entity_ids)}
+        |> filter(fn: (r) => r["_field"] == "value")
+        union(tables: [
+            data |> aggregateWindow(every: 1d, offset: 1ns, fn: first, createEmpty: false, timeSrc: "_start")
+                 |> set(key: "_fn", value: "first"),
+            data |> aggregateWindow(every: 1d, offset: 1ns, fn: last, createEmpty: false, timeSrc: "_start")
+                 |> set(key: "_fn", value: "last"),
+        ])
+        |> keep(columns: ["_time", "_value", "entity_id", "_fn"])
+        |> group()
+        |> pivot(rowKey: ["_time", "_fn"], columnKey: ["entity_id"], valueColumn: "_value")
+        '''
+        firsts = {entity_id: {} for entity_id in entity_ids}
+        lasts = {entity_id: {} for entity_id in entity_ids}
+        for row in influx_query_rows(query):
+            # _start de la fenêtre: minuit (+1 ns) du jour qu'elle couvre
+            day = datetime.fromtimestamp(influx_ts(row["_time"]), tz=tz).date()
+            values = lasts if row.get("_fn") == "last" else firsts
+            for entity_id in entity_ids:
+                if row.get(entity_id):
+                    values[entity_id][day] = float(row[entity_id])
+        for entity_id in entity_ids:
+            last, first = lasts[entity_id], firsts[entity_id]
+            for day in wanted_days:
+                if day not in last:
+                    continue
+                start = last.get(day - timedelta(days=1), first.get(day))
+                results[entity_id][day] = (start, last[day], last[day] - start)
+    except Exception as e:
+        logger.error("❌ Erreur influx_query_daily_increase pour %d entités: %s", len(entity_ids), e)
+    return results
 
-        # Calcul des données mensuelles
-        print("\n📊 Calcul des données mensuelles...")
-        last_month, last_month_last_year, monthly_evolution = fetch_monthly_consumption_data(tempo_metrics)
 
-        # Calcul des données du mois en cours
-        print("\n📊 Calcul des données du mois en cours...")
-        current_month, current_month_last_year, current_month_evolution = fetch_current_month_consumption_data(tempo_metrics)
+def influx_tag(value):
+    """Échappement d'une clé ou valeur de tag en line protocol"""
+    return re.sub(r"([,= ])", r"\\\1", str(value))
 
-        # Calcul des données quotidiennes
-        print("\n📊 Calcul des données quotidiennes...")
-        yesterday, day_2, yesterday_evolution = fetch_daily_consumption_data(tempo_metrics)
 
-        # HP / HC pour les 7 derniers jours
-        dailyweek_HP = [round(hpjb_14[i] + hpjw_14[i] + hpjr_14[i], 2) for i in range(7)]
-        dailyweek_HC = [round(hcjb_14[i] + hcjw_14[i] + hcjr_14[i], 2) for i in range(7)]
+def influx_write(points):
+    """Écrit des points [(nom, labels, ts, valeur)] dans le bucket du compteur en cours, en une seule requête"""
+    from influxdb_client import WritePrecision
+    from influxdb_client.client.write_api import SYNCHRONOUS
 
-        # Puissance max
-        dailyweek_MP, dailyweek_MP_time = fetch_daily_max_power(METRIC_NAMEpcons, days=7)
+    lines = [
+        f"{influx_tag(name)},{','.join(f'{influx_tag(k)}={influx_tag(v)}' for k, v in sorted(labels.items()))} "
+        f"value={float(value)} {int(ts)}"
+        for name, labels, ts, value in points
+    ]
+    t0 = time.time()
+    try:
+        with query_slots:
+            get_influx_client().write_api(write_options=SYNCHRONOUS).write(
+                bucket=active_meter().influx_bucket, record=lines, write_precision=WritePrecision.S)
+    except Exception:
+        record_query("influxdb", "write", time.time() - t0, 0, ok=False)
+        raise
+    record_query("influxdb", "write", time.time() - t0, len(points), sum(len(line) + 1 for line in lines))
 
-        # Couleurs tempo
-        dailyweek_Tempo = fetch_daily_tempo_colors(days=7)
+# =======================
+# Cache des résultats de requêtes
+# =======================
+def result_size(value):
+    """Taille approximative en mémoire (octets) d'un résultat de requête"""
+    if isinstance(value, array):
+        return 64 + value.itemsize * len(value)
+    if isinstance(value, dict):
+        return 64 + sum(result_size(k) + result_size(v) for k, v in value.items())
+    if isinstance(value, (tuple, list)):
+        return 56 + sum(result_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class QueryCache:
+    """
+    Résultats des requêtes vers la base, par (base, filtre du compteur, type, métriques, fenêtre, pas).
+    Une fenêtre terminée depuis plus de QUERY_CACHE_SETTLE_LAG s ne change plus: son résultat est gardé
+    sans limite de durée et, si `path`, dans un fichier SQLite relu après un redémarrage. Une fenêtre
+    touchant le présent n'est gardée que QUERY_CACHE_RECENT_TTL s. Au-delà de `max_bytes`, les résultats
+    les moins récemment utilisés sont évincés (en mémoire comme sur disque).
+    Les résultats sont partagés entre appelants: ils ne doivent pas être modifiés.
+    """
 
-        # Calcul des coûts avec les tarifs Tempo
-        print("\n💰 Calcul des coûts journaliers...")
-        dailyweek_cost, dailyweek_costHP, dailyweek_costHC = fetch_tempo_tariffs_and_calculate_costs(
-            dailyweek_HP, dailyweek_HC, dailyweek_Tempo
-        )
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS query_cache (
+        key TEXT PRIMARY KEY, value BLOB NOT NULL, used_at REAL NOT NULL);
+    """
 
-        # JSON
-        linky_payload = build_linky_payload_exact(
-            dailyweek_HP, dailyweek_HC, dailyweek_MP, dailyweek_MP_time, dailyweek_Tempo,
-            current_week, last_week, current_week_evolution,
-            current_year, current_year_last_year, yearly_evolution,
-            last_month, last_month_last_year, monthly_evolution,
-            current_month, current_month_last_year, current_month_evolution,
-            yesterday, day_2, yesterday_evolution,
-            dailyweek_cost, dailyweek_costHP, dailyweek_costHC
-        )
-        now_iso = now_dt.isoformat()
-        linky_payload["lastUpdate"] = now_iso
-        linky_payload["timeLastCall"] = now_iso
-
-        # === LOG DES VARIABLES CALCULEES ===
-        print("\n📑 Variables calculées pour ce cycle:")
-        print(f"  Base de données: {DB_TYPE.upper()}")
-        print(f"  Dates:          {linky_payload['dailyweek']}")
-        print(f"  HP (7j):        {dailyweek_HP}")
-        print(f"  HC (7j):        {dailyweek_HC}")
-        print(f"  Daily (HP+HC):  {linky_payload['daily']}")
-        print(f"  MP (7j):        {dailyweek_MP}")
-        print(f"  MP times:       {dailyweek_MP_time}")
-        print(f"  Tempo couleurs: {dailyweek_Tempo}")
-        print(f"  Yesterday HP:   {linky_payload['yesterday_HP']}")
-        print(f"  Yesterday HC:   {linky_payload['yesterday_HC']}")
-        print(f"  Current week:   {linky_payload['current_week']} kWh")
-        print(f"  Last week:      {linky_payload['last_week']} kWh")
-        print(f"  Week evolution: {linky_payload['current_week_evolution']}%")
-        print(f"  Current year:   {linky_payload['current_year']} kWh")
-        print(f"  Last year:      {linky_payload['current_year_last_year']} kWh")
-        print(f"  Year evolution: {linky_payload['yearly_evolution']}%")
-        print(f"  Last month:     {linky_payload['last_month']} kWh")
-        print(f"  Last month LY:  {linky_payload['last_month_last_year']} kWh")
-        print(f"  Month evolution: {linky_payload['monthly_evolution']}%")
-        print(f"  Current month:  {linky_payload['current_month']} kWh")
-        print(f"  Current month LY: {linky_payload['current_month_last_year']} kWh")
-        print(f"  Current month evo: {linky_payload['current_month_evolution']}%")
-        print(f"  Yesterday:      {linky_payload['yesterday']} kWh")
-        print(f"  Day before:     {linky_payload['day_2']} kWh")
-        print(f"  Daily evolution: {linky_payload['yesterday_evolution']}%")
-        print(f"  Coûts journaliers: {linky_payload['dailyweek_cost']}")
-        print(f"  Coûts HP:       {linky_payload['dailyweek_costHP']}")
-        print(f"  Coûts HC:       {linky_payload['dailyweek_costHC']}")
-        print(f"  Last update:    {linky_payload['lastUpdate']}")
-
-        # Publication
-        result = client.publish(LINKY_STATE_TOPIC, json.dumps(linky_payload), qos=1, retain=MQTT_RETAIN)
+    def __init__(self, max_bytes, path=None):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # clé -> (résultat, expiration ou None si figé, taille)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.conn = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.executescript(self.SCHEMA)
+
+    def _lookup(self, key, now):
+        """(True, résultat) si la clé est en cache et valide, (False, None) sinon"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires, _ = entry
+                if expires is None or expires > now:
+                    self.entries.move_to_end(key)
+                    return True, value
+                self._drop(key)
+            if self.conn is None:
+                return False, None
+            row = self.conn.execute("SELECT value FROM query_cache WHERE key = ?", (repr(key),)).fetchone()
+            if row is not None:
+                with self.conn:
+                    self.conn.execute("UPDATE query_cache SET used_at = ? WHERE key = ?", (now, repr(key)))
+        if row is None:
+            return False, None
         try:
-            result.wait_for_publish()
+            value = pickle.loads(row[0])
         except Exception:
-            # selon implementation paho, wait_for_publish peut échouer sur certains clients; on ignore
-            pass
-        print(f"📡 JSON complet publié sur {LINKY_STATE_TOPIC}")
+            return False, None
+        self._store(key, value, None, persist=False)
+        return True, value
+
+    def _drop(self, key):
+        _, _, size = self.entries.pop(key)
+        self.size -= size
+
+    def _store(self, key, value, expires, persist=True):
+        size = result_size(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (value, expires, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+            metrics.set("linky_query_cache_entries", len(self.entries))
+            metrics.set("linky_query_cache_bytes", self.size)
+            if persist and expires is None and self.conn is not None:
+                self._persist(key, value)
+
+    def _persist(self, key, value):
+        """Écrit un résultat figé sur disque puis évince les plus anciens au-delà de max_bytes"""
+        try:
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO query_cache VALUES (?, ?, ?)",
+                                  (repr(key), pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.time()))
+                rows = self.conn.execute(
+                    "SELECT key, LENGTH(value) FROM query_cache ORDER BY used_at DESC").fetchall()
+                total, stale = 0, []
+                for stored_key, length in rows:
+                    total += length
+                    if total > self.max_bytes:
+                        stale.append((stored_key,))
+                self.conn.executemany("DELETE FROM query_cache WHERE key = ?", stale)
+        except sqlite3.Error as e:
+            logger.warning("⚠️ Cache des requêtes: écriture sur disque impossible: %s", e)
+
+    def get_or_query(self, key, end_ts, query):
+        """
+        Résultat en cache pour `key`, sinon query() mis en cache s'il n'a subi aucune requête en échec.
+        end_ts: fin de la fenêtre interrogée (None: maintenant, ex. requête instantanée).
+        """
+        now = time.time()
+        kind = key[2]
+        found, value = self._lookup(key, now)
+        with self.lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        metrics.inc("linky_query_cache_requests_total", {"kind": kind, "result": "hit" if found else "miss"})
+        if found:
+            return value
+
+        value, failed = run_tracking_failures(query)
+        if failed:
+            return value
+        if end_ts is not None and end_ts <= now - QUERY_CACHE_SETTLE_LAG:
+            self._store(key, value, None)
+        elif QUERY_CACHE_RECENT_TTL > 0:
+            self._store(key, value, now + QUERY_CACHE_RECENT_TTL)
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.size}
+
+
+query_cache = None
+_query_cache_lock = threading.Lock()
+_query_cache_failed = False
+
+
+def get_query_cache():
+    """Cache des requêtes, créé à la première utilisation (None si désactivé ou indisponible)"""
+    global query_cache, _query_cache_failed
+    if not QUERY_CACHE or _query_cache_failed:
+        return None
+    with _query_cache_lock:
+        if query_cache is None and not _query_cache_failed:
+            path = os.path.join(STATE_DIR, "linky_query_cache.db") if QUERY_CACHE_PERSIST else None
+            try:
+                query_cache = QueryCache(int(QUERY_CACHE_MAX_MB * 1024 * 1024), path)
+                if path:
+                    logger.info("✅ Cache des requêtes persistant: %s", path)
+            except Exception as e:
+                _query_cache_failed = True
+                logger.warning("⚠️ Cache des requêtes indisponible (%s): %s", path, e)
+    return query_cache
 
-        # Pause
-        time.sleep(PUBLISH_INTERVAL)
 
-    # Nettoyage InfluxDB
-    if influx_client:
-        influx_client.close()
+class _InflightQuery:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+        self.error = None
 
 
-if __name__ == "__main__":
-    main()
-import os
-import sys
-import time
-import json
-import threading
-import requests
-from datetime import datetime, timedelta
-import pytz
-import paho.mqtt.client as mqtt
+class QueryCoalescer:
+    """
+    Regroupement des requêtes identiques en vol: le premier appelant d'une clé exécute la requête,
+    les suivants attendent et reçoivent le même résultat (ou la même exception).
+    Couvre ce que le cache ne voit pas encore: étapes d'un même cycle, compteurs en parallèle sur la même base.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.shared = 0
+
+    def run(self, key, query):
+        with self.lock:
+            entry = self.inflight.get(key)
+            leader = entry is None
+            if leader:
+                entry = self.inflight[key] = _InflightQuery()
+            else:
+                self.shared += 1
+        if not leader:
+            metrics.inc("linky_query_coalesced_total", {"kind": key[2]})
+            entry.done.wait()
+            if entry.error is not None:
+                raise entry.error
+            if entry.failed:
+                # Résultat partiel: l'appel englobant ne doit pas non plus le mettre en cache
+                failures = _query_failures.get()
+                if failures is not None:
+                    failures.append(key[2])
+            return entry.result
+        try:
+            entry.result, entry.failed = run_tracking_failures(query)
+            return entry.result
+        except Exception as e:
+            entry.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            entry.done.set()
+
+
+query_coalescer = QueryCoalescer()
+
+
+def cached_query(kind, metrics, params, end_ts, query):
+    """
+    query() via le cache des requêtes, sous la clé (base, filtre du compteur, kind, métriques, params).
+    end_ts: fin de la fenêtre interrogée, None pour une requête à l'instant présent.
+    Une requête identique déjà en vol est attendue plutôt que relancée (query_coalescer).
+    """
+    meter = active_meter()
+    key = (meter.backend(), meter.series_filter(metrics), kind, tuple(metrics), params)
+    cache = get_query_cache()
+    if cache is None:
+        return query_coalescer.run(key, query)
+    return query_coalescer.run(key, lambda: cache.get_or_query(key, end_ts, query))
+
+
+def reducer_name(reducer):
+    return reducer.__name__ if reducer is not None else SeriesReducer.__name__
 
-print("--- Début de l'exécution du script Linky + VictoriaMetrics ---")
-time.sleep(1)
-print(f"Version Python: {sys.version}")
 
 # =======================
-# CONFIG via ENV
+# Wrapper unifié pour les requêtes
 # =======================
-LOGIN = os.getenv("LOGIN")
-PASSWORD = os.getenv("PASSWORD")
-MQTT_HOST = os.getenv("MQTT_HOST", "127.0.0.1")
-MQTT_PORT = int(os.getenv("MQTT_PORT") or 1883)
+def influx_step(step):
+    """Conversion d'un step en secondes vers une durée Flux"""
+    if step <= 60:
+        return f"{step}s"
+    elif step <= 3600:
+        return f"{step//60}m"
+    else:
+        return f"{step//3600}h"
 
-VM_HOST = os.getenv("VM_HOST", "127.0.0.1")
-VM_PORT = int(os.getenv("VM_PORT") or 8428)
 
-SENSOR_NAME = os.getenv("SENSOR_NAME", "linky_tic")
+def db_query_range(metric, start_ts, end_ts, step=3600, timeout=VM_TIMEOUT_RANGE, reducer=None):
+    """Wrapper unifié pour requêtes de plage"""
+    meter = active_meter()
+    if meter.db_type == "influxdb":
+        query = lambda: influx_query_range(metric, start_ts, end_ts, influx_step(step), reducer)
+    else:
+        query = lambda: vm_query_range(meter.vm_host, meter.vm_port, metric, start_ts, end_ts, step, timeout, reducer)
+    return cached_query("range", [metric], (int(start_ts), int(end_ts), step, reducer_name(reducer)), end_ts, query)
 
-PUBLISH_INTERVAL = int(os.getenv("PUBLISH_INTERVAL") or 300)  # toutes les 5 min par défaut
 
-METRIC_NAMEhpjb = "sensor.linky_tempo_index_bbrhpjb_value"
-METRIC_NAMEhcjb = "sensor.linky_tempo_index_bbrhcjb_value"
-METRIC_NAMEhpjw = "sensor.linky_tempo_index_bbrhpjw_value"
-METRIC_NAMEhcjw = "sensor.linky_tempo_index_bbrhcjw_value"
-METRIC_NAMEhpjr = "sensor.linky_tempo_index_bbrhpjr_value"
-METRIC_NAMEhcjr = "sensor.linky_tempo_index_bbrhcjr_value"
-METRIC_NAMEpcons = "sensor.linky_puissance_consommee_value"
+def db_query_range_multi(metrics, start_ts, end_ts, step=3600, timeout=VM_TIMEOUT_RANGE, reducer=None):
+    """
+    Wrapper unifié pour requêtes de plage multi-séries.
+    Retourne {metric: résultat du reducer} avec une seule requête vers la base pour toutes les métriques:
+    (horodatages, valeurs) par défaut, (first, last, nombre de points) avec FirstLastReducer.
+    """
+    metrics = list(dict.fromkeys(metrics))
+    meter = active_meter()
+    if meter.db_type == "influxdb":
+        # Chaque fenêtre est horodatée à sa fin (timeSrc: "_stop"): la plage commence un pas plus tôt pour avoir,
+        # comme VictoriaMetrics, un point à start_ts (ex. le premier minuit demandé) et un point même si start = end
+        query = lambda: influx_query_range_multi(metrics, start_ts - step, end_ts, influx_step(step), reducer)
+    else:
+        query = lambda: vm_query_range_multi(meter.vm_host, meter.vm_port, metrics, start_ts, end_ts, step, timeout,
+                                             reducer=reducer)
+    return cached_query("range", metrics, (int(start_ts), int(end_ts), step, reducer_name(reducer)), end_ts, query)
 
-MQTT_RETAIN = True
+
+def db_query_boundaries(metrics, start_ts, end_ts, timeout=VM_TIMEOUT_RANGE):
+    """
+    Wrapper unifié: premier point à partir de start_ts et dernier point jusqu'à end_ts.
+    Retourne {metric: (first, last)}.
+    """
+    metrics = list(dict.fromkeys(metrics))
+    meter = active_meter()
+    if meter.db_type == "influxdb":
+        query = lambda: influx_query_boundaries(metrics, start_ts, end_ts)
+    else:
+        query = lambda: vm_query_boundaries(meter.vm_host, meter.vm_port, metrics, start_ts, end_ts, timeout)
+    return cached_query("boundaries", metrics, (int(start_ts), int(end_ts)), end_ts, query)
+
+
+def db_query_daily_increase(metrics, day_bounds, timeout=VM_TIMEOUT_RANGE):
+    """
+    Wrapper unifié pour les agrégats journaliers côté serveur.
+    day_bounds: liste de (jour, start_ts, end_ts) alignés sur minuit Europe/Paris.
+    Retourne {metric: {jour: (first, last, diff)}}, avec les mêmes bornes de jour sur les deux bases.
+    """
+    metrics = list(dict.fromkeys(metrics))
+    meter = active_meter()
+    if meter.db_type == "influxdb":
+        query = lambda: influx_query_daily_increase(metrics, day_bounds)
+    else:
+        query = lambda: vm_query_daily_increase(meter.vm_host, meter.vm_port, metrics, day_bounds, timeout)
+    return cached_query("daily_increase", metrics, tuple(map(tuple, day_bounds)),
+                        max(b[2] for b in day_bounds), query)
+
+
+def db_query_daily_max(metric, day_bounds, timeout=VM_TIMEOUT_RANGE):
+    """
+    Wrapper unifié: maximum journalier et son horodatage calculés par la base.
+    Retourne {jour: (max, ts)}.
+    """
+    if not day_bounds:
+        return {}
+    meter = active_meter()
+    if meter.db_type == "influxdb":
+        query = lambda: influx_query_daily_max(metric, day_bounds)
+    else:
+        query = lambda: vm_query_daily_max(meter.vm_host, meter.vm_port, metric, day_bounds, timeout)
+    return cached_query("daily_max", [metric], tuple(map(tuple, day_bounds)), max(b[2] for b in day_bounds), query)
+
+
+def db_query_instant(metric, timeout=VM_TIMEOUT_INSTANT):
+    """Wrapper unifié pour requêtes instantanées"""
+    meter = active_meter()
+    if meter.db_type == "influxdb":
+        query = lambda: influx_query_instant(metric)
+    else:
+        query = lambda: vm_query_instant(meter.vm_host, meter.vm_port, metric, timeout)
+    return cached_query("instant", [metric], (), None, query)
+
+
+def db_query_instant_multi(metrics, timeout=VM_TIMEOUT_INSTANT):
+    """Wrapper unifié pour requêtes instantanées multi-séries, retourne {metric: valeur}"""
+    metrics = list(dict.fromkeys(metrics))
+    meter = active_meter()
+    if meter.db_type == "influxdb":
+        query = lambda: influx_query_instant_multi(metrics)
+    else:
+        query = lambda: vm_query_instant_multi(meter.vm_host, meter.vm_port, metrics, timeout=timeout)
+    return cached_query("instant", metrics, (), None, query)
+
+
+def db_write_points(points):
+    """Wrapper unifié pour l'écriture de points [(nom, labels, ts, valeur)] en une requête"""
+    meter = active_meter()
+    if meter.db_type == "influxdb":
+        influx_write(points)
+    else:
+        vm_import(meter.vm_host, meter.vm_port, points)
 
 # =======================
-# MQTT Topics
+# Stockage local des jours clos
 # =======================
-LINKY_STATE_TOPIC = f"homeassistant/sensor/{SENSOR_NAME}/state"
-LINKY_DISCOVERY_TOPIC = f"homeassistant/sensor/{SENSOR_NAME}/config"
+class DailySummaryStore:
+    """
+    Résumés des jours terminés (SQLite): index first/last par compteur,
+    puissance max et son horodatage, couleur Tempo détectée, index à minuit (MidnightIndexTable),
+    jours dont les agrégats ont été écrits dans la base (ROLLUP_WRITEBACK).
+    Un jour clos ne change plus, il n'est donc jamais redemandé à la base.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS daily_index (
+        day TEXT NOT NULL, metric TEXT NOT NULL,
+        first_value REAL, last_value REAL, diff REAL NOT NULL,
+        PRIMARY KEY (day, metric));
+    CREATE TABLE IF NOT EXISTS daily_max_power (
+        day TEXT NOT NULL, metric TEXT NOT NULL,
+        max_value REAL NOT NULL, max_time TEXT NOT NULL,
+        PRIMARY KEY (day, metric));
+    CREATE TABLE IF NOT EXISTS daily_color (
+        day TEXT NOT NULL, sensor TEXT NOT NULL, color TEXT NOT NULL,
+        PRIMARY KEY (day, sensor));
+    CREATE TABLE IF NOT EXISTS midnight_index (
+        metric TEXT PRIMARY KEY, first_day TEXT NOT NULL, data BLOB NOT NULL);
+    CREATE TABLE IF NOT EXISTS daily_rollup (
+        day TEXT NOT NULL, target TEXT NOT NULL,
+        PRIMARY KEY (day, target));
+    """
+
+    SCHEMA_VERSION = 3
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(self.SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < 2:
+            # Couleurs stockées par l'ancienne détection (première couleur ayant des données): à recalculer
+            self.conn.execute("DELETE FROM daily_color")
+        if version < 3:
+            # Clés sans la base interrogée, partagées à tort entre compteurs de bases différentes: à relire
+            for table in ("daily_index", "daily_max_power", "midnight_index"):
+                self.conn.execute(f"DELETE FROM {table} WHERE metric NOT LIKE '%://%'")
+        self.conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        self.conn.commit()
+
+    def get_index_days(self, metrics, days):
+        """Retourne {metric: {jour: (first, last, diff)}} pour les jours déjà stockés"""
+        results = {metric: {} for metric in metrics}
+        if not metrics or not days:
+            return results
+        wanted = {day.isoformat(): day for day in days}
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT day, metric, first_value, last_value, diff FROM daily_index "
+                f"WHERE metric IN ({','.join('?' * len(metrics))}) AND day >= ?",
+                (*metrics, min(wanted))).fetchall()
+        for day, metric, first_val, last_val, diff in rows:
+            if day in wanted:
+                results[metric][wanted[day]] = (first_val, last_val, diff)
+        return results
+
+    def put_index_days(self, values):
+        """values: {metric: {jour: (first, last, diff)}}"""
+        rows = [(day.isoformat(), metric, first_val, last_val, diff)
+                for metric, per_day in values.items()
+                for day, (first_val, last_val, diff) in per_day.items()]
+        if rows:
+            with self.lock, self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO daily_index VALUES (?, ?, ?, ?, ?)", rows)
+
+    def get_midnight_index(self, metrics):
+        """Retourne {metric: (premier jour, array('d') des index à minuit)} pour les métriques stockées"""
+        if not metrics:
+            return {}
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT metric, first_day, data FROM midnight_index WHERE metric IN ({','.join('?' * len(metrics))})",
+                tuple(metrics)).fetchall()
+        results = {}
+        for metric, first_day, data in rows:
+            values = array("d")
+            values.frombytes(data)
+            results[metric] = (datetime.strptime(first_day, "%Y-%m-%d").date(), values)
+        return results
+
+    def put_midnight_index(self, values):
+        """values: {metric: (premier jour, array('d'))}, remplace la série de chaque métrique"""
+        rows = [(metric, first_day.isoformat(), series.tobytes()) for metric, (first_day, series) in values.items()]
+        if rows:
+            with self.lock, self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO midnight_index VALUES (?, ?, ?)", rows)
+
+    def get_max_power(self, metric, days):
+        """Retourne {jour: (max_value, max_time)}"""
+        wanted = {day.isoformat(): day for day in days}
+        if not wanted:
+            return {}
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT day, max_value, max_time FROM daily_max_power WHERE metric = ? AND day >= ?",
+                (metric, min(wanted))).fetchall()
+        return {wanted[day]: (max_value, max_time) for day, max_value, max_time in rows if day in wanted}
+
+    def put_max_power(self, metric, values):
+        """values: {jour: (max_value, max_time)}"""
+        rows = [(day.isoformat(), metric, max_value, max_time) for day, (max_value, max_time) in values.items()]
+        if rows:
+            with self.lock, self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO daily_max_power VALUES (?, ?, ?, ?)", rows)
+
+    def get_colors(self, sensor, days):
+        """Retourne {jour: couleur}"""
+        wanted = {day.isoformat(): day for day in days}
+        if not wanted:
+            return {}
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT day, color FROM daily_color WHERE sensor = ? AND day >= ?",
+                (sensor, min(wanted))).fetchall()
+        return {wanted[day]: color for day, color in rows if day in wanted}
+
+    def put_colors(self, sensor, values):
+        """values: {jour: couleur}"""
+        rows = [(day.isoformat(), sensor, color) for day, color in values.items()]
+        if rows:
+            with self.lock, self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO daily_color VALUES (?, ?, ?)", rows)
+
+    def get_rollup_days(self, target, days):
+        """Retourne l'ensemble des jours de `days` dont les agrégats sont déjà écrits pour `target`"""
+        wanted = {day.isoformat(): day for day in days}
+        if not wanted:
+            return set()
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT day FROM daily_rollup WHERE target = ? AND day >= ?", (target, min(wanted))).fetchall()
+        return {wanted[day] for day, in rows if day in wanted}
+
+    def put_rollup_days(self, target, days):
+        """days: jours dont les agrégats viennent d'être écrits pour `target`"""
+        rows = [(day.isoformat(), target) for day in days]
+        if rows:
+            with self.lock, self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO daily_rollup VALUES (?, ?)", rows)
+
+
+daily_store = None
+_daily_store_lock = threading.Lock()
+_daily_store_failed = False
+
+
+def get_daily_store():
+    """Ouvre le stockage des jours clos à la première utilisation (None si désactivé ou indisponible)"""
+    global daily_store, _daily_store_failed
+    if not DAILY_STORE or _daily_store_failed:
+        return None
+    with _daily_store_lock:
+        if daily_store is None and not _daily_store_failed:
+            path = os.path.join(STATE_DIR, "linky_daily.db")
+            try:
+                daily_store = DailySummaryStore(path)
+                logger.info("✅ Stockage des jours clos: %s", path)
+            except Exception as e:
+                _daily_store_failed = True
+                logger.warning("⚠️ Stockage des jours clos indisponible (%s): %s", path, e)
+    return daily_store
+
+
+def is_closed_day(day_bound, now_ts=None):
+    """Un jour est clos quand il est terminé depuis au moins STORE_SETTLE_LAG secondes"""
+    _, _, end_ts = day_bound
+    now_ts = now_ts if now_ts is not None else cycle_clock().now_ts
+    return end_ts <= now_ts - max(STORE_SETTLE_LAG, 1)
 
 
 # =======================
-# Helper: requêtes vers VictoriaMetrics
+# Index des compteurs à minuit
 # =======================
-def vm_query_range(vm_host, vm_port, metric, start_ts, end_ts, step=3600, timeout=30):
-    url = f"http://{vm_host}:{vm_port}/api/v1/query_range"
-    params = {"query": metric, "start": int(start_ts), "end": int(end_ts), "step": int(step)}
-    try:
-        r = requests.get(url, params=params, timeout=timeout)
-        r.raise_for_status()
-        data = r.json()
-        res_list = data.get("data", {}).get("result", [])
-        if res_list and res_list[0].get("values"):
-            return res_list[0]["values"]
-        return []
-    except Exception as e:
-        print(f"❌ Erreur vm_query_range pour {metric}: {e}")
-        return []
+def is_settled_midnight(day, now_ts=None):
+    """L'index à minuit du jour `day` est figé une fois minuit passé d'au moins STORE_SETTLE_LAG secondes"""
+    now_ts = now_ts if now_ts is not None else cycle_clock().now_ts
+    return paris_midnight(day).timestamp() <= now_ts - max(STORE_SETTLE_LAG, 1)
 
 
-def vm_query_instant(vm_host, vm_port, metric, timeout=10):
-    url = f"http://{vm_host}:{vm_port}/api/v1/query"
-    params = {"query": metric}
-    try:
-        r = requests.get(url, params=params, timeout=timeout)
-        r.raise_for_status()
-        data = r.json()
-        res_list = data.get("data", {}).get("result", [])
-        if res_list and res_list[0].get("value"):
-            return res_list[0]["value"][1]
+def fetch_midnight_indexes(metric_names, first_day, last_day):
+    """
+    Index de chaque métrique à chaque minuit de Paris de first_day à last_day inclus, depuis une série
+    au pas horaire (un point tombe sur chaque minuit, changements d'heure compris).
+    Retourne {metric: {jour: index}}, un minuit sans donnée est absent.
+    """
+    start_ts = int(paris_midnight(first_day).timestamp())
+    end_ts = int(paris_midnight(last_day).timestamp())
+    series = fetch_scan_series(metric_names, [(first_day, start_ts, end_ts)], step=3600)
+    results = {metric: {} for metric in metric_names}
+    for metric, (ts, values) in series.items():
+        by_ts = dict(zip(map(int, ts), map(float, values)))
+        day = first_day
+        while day <= last_day:
+            value = by_ts.get(int(paris_midnight(day).timestamp()))
+            if value is not None:
+                results[metric][day] = value
+            day += timedelta(days=1)
+    return results
+
+
+class MidnightIndexTable:
+    """
+    Index de chaque compteur Tempo à chaque minuit de Paris: un tableau compact par métrique
+    (8 octets par jour, NaN pour un minuit sans donnée) depuis le 1er janvier de l'année précédente.
+    Rempli une fois depuis la base puis complété d'une case par jour, dès que le minuit est figé
+    (is_settled_midnight), et conservé dans le stockage local des jours clos.
+    La conso d'une période d'un minuit à un autre est la différence de deux cases.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series = {}  # clé de stockage -> (premier jour, array('d'))
+        self.loaded = set()
+        # Un verrou de remplissage par jeu de métriques (un compteur): les compteurs se remplissent en parallèle
+        self.fill_locks = {}
+
+    def _fill_lock(self, keys):
+        with self.lock:
+            return self.fill_locks.setdefault(frozenset(keys), threading.Lock())
+
+    def _value(self, key, day):
+        entry = self.series.get(key)
+        if entry is None:
+            return None
+        first_day, values = entry
+        i = (day - first_day).days
+        if 0 <= i < len(values) and not math.isnan(values[i]):
+            return values[i]
         return None
-    except Exception as e:
-        print(f"❌ Erreur vm_query_instant pour {metric}: {e}")
+
+    def _missing_spans(self, keys, days, today):
+        """
+        Plages [(premier, dernier jour)] à lire dans la base pour couvrir `days`: extension de la table
+        (et l'historique depuis le 1er janvier N-1), puis jours demandés restés sans valeur après le premier
+        minuit connu, relus à chaque demande (un minuit absent de la base au remplissage peut y être arrivé depuis).
+        """
+        span = self._edge_span(keys, days, today)
+        spans = [span] if span is not None else []
+        known = {key: self._first_known_day(key) for key in keys if key in self.series}
+        holes = [day for day in sorted(days) if (span is None or not span[0] <= day <= span[1])
+                 and any(first is not None and first < day and self._value(key, day) is None
+                         for key, first in known.items())]
+        for day in holes:
+            if spans and spans[-1][1] == day - timedelta(days=1) and spans[-1] is not span:
+                spans[-1] = (spans[-1][0], day)
+            else:
+                spans.append((day, day))
+        return spans
+
+    def _first_known_day(self, key):
+        """Premier minuit connu de `key` (avant, la base n'a pas encore d'historique), ou None"""
+        first_day, values = self.series[key]
+        known = next((i for i, v in enumerate(values) if not math.isnan(v)), None)
+        return first_day + timedelta(days=known) if known is not None else None
+
+    def _edge_span(self, keys, days, today):
+        """Plage (premier, dernier jour) qui étend la table pour couvrir `days` (et l'historique depuis le 1er janvier N-1)"""
+        start = min(min(days), datetime(today.year - 1, 1, 1).date())
+        end = max(days)
+        span = None
+        for key in keys:
+            entry = self.series.get(key)
+            if entry is None:
+                gaps = [(start, end)]
+            else:
+                first_day, values = entry
+                last_day = first_day + timedelta(days=len(values) - 1)
+                gaps = [(start, first_day - timedelta(days=1)), (last_day + timedelta(days=1), end)]
+            for gap_start, gap_end in gaps:
+                if gap_start <= gap_end:
+                    span = (gap_start, gap_end) if span is None else (min(span[0], gap_start), max(span[1], gap_end))
+        return span
+
+    def _merge(self, key, span, fetched):
+        """Étend la série de `key` à la plage lue (cases lues dans la base prioritaires)"""
+        first_day, values = self.series.get(key, (span[0], array("d")))
+        known = {first_day + timedelta(days=i): v for i, v in enumerate(values)}
+        day = span[0]
+        while day <= span[1]:
+            known[day] = fetched.get(day, math.nan)
+            day += timedelta(days=1)
+        first_day = min(known)
+        count = (max(known) - first_day).days + 1
+        merged = array("d", (known.get(first_day + timedelta(days=i), math.nan) for i in range(count)))
+        self.series[key] = (first_day, merged)
+
+    def lookup(self, metric_names, days, now_ts=None):
+        """
+        {metric: {jour: index à minuit, ou None sans donnée}} pour le compteur en cours.
+        Les minuits pas encore figés sont lus dans la base à chaque appel, sans être conservés.
+        Si la lecture échoue, les jours concernés valent None et seront relus au prochain appel.
+        """
+        now_ts = now_ts if now_ts is not None else cycle_clock().now_ts
+        meter = active_meter()
+        keys = {meter.store_key(m): m for m in metric_names}
+        settled = sorted({d for d in days if is_settled_midnight(d, now_ts)})
+        pending = sorted(set(days) - set(settled))
+        results = {metric: {} for metric in metric_names}
+
+        if settled:
+            today = datetime.fromtimestamp(now_ts, pytz.timezone("Europe/Paris")).date()
+            store = get_daily_store()
+            # Les étages du compteur lancés en parallèle attendent ce remplissage au lieu de le refaire;
+            # la table n'est verrouillée que le temps de la consulter ou de la compléter, pas pendant la lecture
+            with self._fill_lock(keys):
+                with self.lock:
+                    new_keys = [key for key in keys if key not in self.loaded]
+                if store and new_keys:
+                    stored = store.get_midnight_index(new_keys)
+                    with self.lock:
+                        self.series.update(stored)
+                with self.lock:
+                    self.loaded.update(new_keys)
+                    spans = self._missing_spans(keys, settled, today)
+                merged = {}
+                for span in spans:
+                    fetched, failed = run_tracking_failures(fetch_midnight_indexes, metric_names, *span)
+                    if failed:
+                        logger.warning("⚠️ Index à minuit du %s au %s non lus, nouvelle tentative au prochain cycle",
+                                       span[0], span[1])
+                        continue
+                    with self.lock:
+                        for key, metric in keys.items():
+                            self._merge(key, span, fetched[metric])
+                        merged = {key: self.series[key] for key in keys}
+                    logger.log(logging.INFO if span[0] != span[1] else logging.DEBUG,
+                               "🗓️ [%s] Index à minuit lus du %s au %s (%d jours)", meter.name, span[0], span[1],
+                               (span[1] - span[0]).days + 1)
+                if store and merged:
+                    store.put_midnight_index(merged)
+            with self.lock:
+                for key, metric in keys.items():
+                    results[metric].update({day: self._value(key, day) for day in settled})
+
+        if pending:
+            fetched = fetch_midnight_indexes(metric_names, pending[0], pending[-1])
+            for metric in metric_names:
+                results[metric].update({day: fetched[metric].get(day) for day in pending})
+        return results
+
+
+midnight_index = None
+_midnight_index_lock = threading.Lock()
+
+
+def get_midnight_index():
+    """Table des index à minuit, créée à la première utilisation (None si MIDNIGHT_INDEX est désactivé)"""
+    global midnight_index
+    if not MIDNIGHT_INDEX:
+        return None
+    with _midnight_index_lock:
+        if midnight_index is None:
+            midnight_index = MidnightIndexTable()
+    return midnight_index
+
+
+def period_midnight_days(start_dt, end_dt):
+    """
+    (jour de début, jour de fin) si la période va d'un minuit de Paris à un autre, la fin étant
+    à minuit ou à 23:59:59; jour de fin à None si la période se termine maintenant; sinon None.
+    """
+    def midnight_day(dt):
+        return dt.date() if (dt.hour, dt.minute, dt.second, dt.microsecond) == (0, 0, 0, 0) else None
+
+    start_day = midnight_day(start_dt)
+    if start_day is None:
         return None
+    end_day = midnight_day(end_dt) or midnight_day(end_dt + timedelta(seconds=1))
+    if end_day is not None:
+        return start_day, end_day
+    # Période en cours: index actuel à la place de l'index de fin
+    return (start_day, None) if abs(end_dt.timestamp() - cycle_clock().now_ts) < 60 else None
+
+
+def consumption_from_midnight_index(metrics, start_day, end_day, label=""):
+    """
+    Conso d'un minuit à un autre (ou à maintenant si end_day est None) par différence des index de la
+    table, somme des métriques. None si un index manque: la période est alors calculée par requêtes.
+    """
+    table = get_midnight_index()
+    indexes = table.lookup(metrics, [start_day] + ([end_day] if end_day is not None else []))
+    if end_day is None:
+        current = db_query_instant_multi(metrics)
+    total = 0.0
+    for metric in metrics:
+        first_val = indexes[metric].get(start_day)
+        last_val = indexes[metric].get(end_day) if end_day is not None else current.get(metric)
+        if first_val is None or last_val is None:
+            logger.debug("⚠️ Index à minuit manquant pour %s (%s), calcul par requêtes", metric, label)
+            return None
+        consumption = max(0.0, float(last_val) - first_val)
+        total += consumption
+        logger.debug("📊 %s: %.2f → %.2f = %.2f kWh", metric, first_val, float(last_val), consumption)
+    return round(total, 2)
 
 
 # =======================
-# Calculs de conso réutilisables
+# Calculs de conso réutilisables (adaptés)
 # =======================
-def compute_consumption_for_period(vm_host, vm_port, metrics, start_dt, end_dt, step=3600, label=""):
+def compute_consumption_for_period(metrics, start_dt, end_dt, step=3600, label=""):
     """
     Pour chaque metric dans metrics:
-      - récupère la série (start_dt -> end_dt)
+      - récupère le premier et le dernier point (start_dt -> end_dt),
+        ou toute la série au pas `step` si BOUNDARY_QUERIES est désactivé
       - calcule last - first (clamp >= 0)
       - somme sur metrics
+    D'un minuit de Paris à un autre (ou à maintenant), la table des index à minuit suffit (MIDNIGHT_INDEX).
     """
     total = 0.0
     start_ts = int(start_dt.timestamp())
     end_ts = int(end_dt.timestamp())
+    if end_ts <= start_ts:
+        # Période vide (ex: cumul arrêté à minuit le 1er du mois)
+        return total
+    days = period_midnight_days(start_dt, end_dt) if MIDNIGHT_INDEX else None
+    if days is not None:
+        from_table = consumption_from_midnight_index(metrics, *days, label=label)
+        if from_table is not None:
+            return from_table
+    if BOUNDARY_QUERIES:
+        boundaries = db_query_boundaries(metrics, start_ts, end_ts)
+    else:
+        # Seuls le premier et le dernier point de chaque série sont conservés pendant la lecture
+        series = db_query_range_multi(metrics, start_ts, end_ts, step=step, reducer=FirstLastReducer)
+        boundaries = {metric: (first, last) for metric, (first, last, count) in series.items() if count >= 2}
     for metric in metrics:
-        values = vm_query_range(vm_host, vm_port, metric, start_ts, end_ts, step=step)
-        if not values or len(values) < 2:
-            print(f"⚠️ Données insuffisantes pour {metric} ({label})")
+        if metric not in boundaries:
+            logger.debug("⚠️ Données insuffisantes pour %s (%s)", metric, label)
             continue
         try:
-            first_val = float(values[0][1])
-            last_val = float(values[-1][1])
+            first_val = float(boundaries[metric][0])
+            last_val = float(boundaries[metric][1])
             consumption = max(0.0, last_val - first_val)
             total += consumption
-            print(f"📊 {metric}: {first_val:.2f} → {last_val:.2f} = {consumption:.2f} kWh")
+            logger.debug("📊 %s: %.2f → %.2f = %.2f kWh", metric, first_val, last_val, consumption)
         except Exception as e:
-            print(f"❌ Erreur lors du parsing pour {metric} ({label}): {e}")
+            logger.error("❌ Erreur lors du parsing pour %s (%s): %s", metric, label, e)
             continue
     return round(total, 2)
 
 
-def compute_daily_diffs(vm_host, vm_port, metric_name, days=7, step=60):
+def compute_daily_diffs(metric_name, days=7, step=60):
+    """
+    Retourne une liste [jour0, jour1, ...] avec jour0 = aujourd'hui (ou 0 si pas de données),
+    chaque valeur = last - first sur la journée.
+    step par défaut = 60s (comme dans le script original).
+    """
+    return compute_daily_diffs_multi([metric_name], days=days, step=step)[metric_name]
+
+
+def compute_daily_diffs_multi(metric_names, days=7, step=60):
+    """
+    Comme compute_daily_diffs mais pour plusieurs métriques à la fois.
+    Les jours clos sont lus dans le stockage local, seuls aujourd'hui et les jours manquants
+    sont demandés à la base: agrégats journaliers côté serveur (DAILY_ROLLUP) en un seul appel,
+    sinon une requête par jour pour toutes les métriques.
+    Retourne {metric: [jour0, jour1, ...]}.
+    """
+    bounds = paris_day_bounds(days)
+    now_ts = cycle_clock().now_ts
+    store = get_daily_store()
+    closed_days = [b[0] for b in bounds if is_closed_day(b, now_ts)]
+    # Clés du stockage propres au compteur en cours
+    store_keys = {active_meter().store_key(m): m for m in metric_names}
+    stored = {store_keys[k]: v for k, v in store.get_index_days(list(store_keys), closed_days).items()} if store else {}
+
+    to_query = [b for b in bounds if any(b[0] not in stored.get(m, {}) for m in metric_names)]
+    if not to_query:
+        fetched = {}
+    elif DAILY_ROLLUP:
+        fetched = db_query_daily_increase(metric_names, to_query)
+    else:
+        fetched = scan_daily_first_last(metric_names, to_query, step=step)
+
+    if store and fetched:
+        closed = {b[0] for b in to_query if is_closed_day(b, now_ts)}
+        store.put_index_days({
+            key: {day: v for day, v in fetched.get(metric, {}).items() if day in closed}
+            for key, metric in store_keys.items()
+        })
+
+    results = {}
+    for metric_name in metric_names:
+        per_day = dict(fetched.get(metric_name, {}))
+        per_day.update(stored.get(metric_name, {}))
+        results[metric_name] = [round(max(0.0, per_day[day][2]), 2) if day in per_day else 0.0 for day, _, _ in bounds]
+    return results
+
+
+def scan_spans(day_bounds, step):
+    """
+    Plages continues couvrant `day_bounds` (jours contigus fusionnés), découpées pour ne pas
+    dépasser SCAN_MAX_POINTS points par série: [(start_ts, end_ts), ...]
+    """
+    spans = []
+    for _, start_ts, end_ts in sorted(day_bounds, key=lambda b: b[1]):
+        if spans and start_ts <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], end_ts)
+        else:
+            spans.append([start_ts, end_ts])
+    width = (SCAN_MAX_POINTS - 1) * step
+    chunks = []
+    for start_ts, end_ts in spans:
+        while start_ts + width < end_ts:
+            chunks.append((start_ts, start_ts + width))
+            start_ts += width + step
+        if start_ts <= end_ts:
+            chunks.append((start_ts, end_ts))
+    return chunks
+
+
+_numpy = None
+_numpy_checked = False
+
+
+def load_numpy():
+    """NumPy, importé à la première utilisation (None s'il n'est pas installé: découpage en Python pur)"""
+    global _numpy, _numpy_checked
+    if not _numpy_checked:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = None
+        _numpy_checked = True
+    return _numpy
+
+
+def fetch_scan_series(metric_names, day_bounds, step=60):
+    """
+    Séries au pas `step` couvrant tous les jours demandés, en une requête par plage continue
+    (et non plus une par jour). Retourne {metric: (horodatages, valeurs)} triés par horodatage,
+    en tableaux NumPy si disponible.
+    """
+    chunks = parallel_map(lambda span: db_query_range_multi(metric_names, span[0], span[1], step=step),
+                          scan_spans(day_bounds, step))
+    np = load_numpy()
+    series = {}
+    for metric in metric_names:
+        parts = [chunk[metric] for chunk in chunks if metric in chunk]
+        if not parts:
+            continue
+        ts, values = array("d"), array("d")
+        for part_ts, part_values in parts:
+            ts.extend(part_ts)
+            values.extend(part_values)
+        if np is not None:
+            # Tableaux compacts du décodage en flux repris sans copie
+            ts, values = np.frombuffer(ts, dtype=np.float64), np.frombuffer(values, dtype=np.float64)
+        series[metric] = (ts, values)
+    return series
+
+
+def bucket_daily(ts, values, day_bounds):
+    """
+    Découpe une série triée selon les jours de `day_bounds`, bornes incluses (minuit compte
+    dans les deux jours, comme avec une requête par jour).
+    Retourne {jour: (first, last, max, horodatage du max)} pour les jours ayant des points.
+    """
+    np = load_numpy()
+    if np is None:
+        buckets = {}
+        for day, start_ts, end_ts in day_bounds:
+            lo = bisect.bisect_left(ts, start_ts)
+            hi = bisect.bisect_right(ts, end_ts)
+            if hi <= lo:
+                continue
+            segment = values[lo:hi]
+            best = max(range(len(segment)), key=segment.__getitem__)
+            buckets[day] = (segment[0], segment[-1], segment[best], int(ts[lo + best]))
+        return buckets
+
+    lo = np.searchsorted(ts, [b[1] for b in day_bounds], side="left")
+    hi = np.searchsorted(ts, [b[2] for b in day_bounds], side="right")
+    filled = hi > lo
+    if not filled.any():
+        return {}
+    days = [b[0] for b, f in zip(day_bounds, filled) if f]
+    lo, hi = lo[filled], hi[filled]
+    # Max de chaque segment [lo, hi) en un seul appel: indices entrelacés, un résultat sur deux
+    # (valeur sentinelle en fin de tableau pour un segment se terminant au dernier point)
+    maxima = np.maximum.reduceat(np.append(values, -np.inf), np.column_stack((lo, hi)).ravel())[::2]
+    argmax = [l + int(values[l:h].argmax()) for l, h in zip(lo, hi)]
+    return {
+        day: (float(first), float(last), float(peak), int(ts[i]))
+        for day, first, last, peak, i in zip(days, values[lo], values[hi - 1], maxima, argmax)
+    }
+
+
+def scan_daily_first_last(metric_names, day_bounds, step=60):
+    """
+    Sans agrégats côté serveur: séries minute par minute récupérées une fois pour tous les jours,
+    puis découpées localement. Retourne {metric: {jour: (first, last, diff)}}.
+    """
+    series = fetch_scan_series(metric_names, day_bounds, step)
+    results = {}
+    for metric in metric_names:
+        buckets = bucket_daily(*series[metric], day_bounds) if metric in series else {}
+        results[metric] = {day: (first, last, last - first) for day, (first, last, _, _) in buckets.items()}
+    return results
+
+
+def scan_daily_max(metric_name, day_bounds, step=60):
+    """Max journalier et son horodatage par le même scan: {jour: (max, ts)}"""
+    series = fetch_scan_series([metric_name], day_bounds, step)
+    if metric_name not in series:
+        return {}
+    return {day: (peak, peak_ts) for day, (_, _, peak, peak_ts) in bucket_daily(*series[metric_name], day_bounds).items()}
+
+
+def paris_day_bounds(days, now=None):
     """
-    Retourne une liste [jour0, jour1, ...] avec jour0 = aujourd'hui (ou 0 si pas de données),
-    chaque valeur = last - first sur la journée.
-    step par défaut = 60s (comme dans le script original).
+    Bornes des `days` derniers jours de Paris: [(jour, start_ts, end_ts), ...]
+    avec jour0 = aujourd'hui (terminé à maintenant, celui du cycle en cours par défaut).
     """
     tz = pytz.timezone("Europe/Paris")
-    now = datetime.now(tz)
+    now = now or cycle_clock().now
     today = now.date()
-    results = []
-
+    bounds = []
     for i in range(days):
         day = today - timedelta(days=i)
-        start_dt = datetime(year=day.year, month=day.month, day=day.day, hour=0, minute=0, second=0, tzinfo=tz)
-        end_dt = now if day == today else (start_dt + timedelta(days=1))
-        start_ts = int(start_dt.timestamp())
-        end_ts = int(end_dt.timestamp())
+        start_dt = tz.localize(datetime(day.year, day.month, day.day))
+        next_day = day + timedelta(days=1)
+        end_dt = now if day == today else tz.localize(datetime(next_day.year, next_day.month, next_day.day))
+        bounds.append((day, int(start_dt.timestamp()), int(end_dt.timestamp())))
+    return bounds
 
-        values = vm_query_range(vm_host, vm_port, metric_name, start_ts, end_ts, step=step, timeout=30)
-        if not values:
-            results.append(0.0)
-            continue
-        try:
-            first_val = float(values[0][1])
-            last_val = float(values[-1][1])
-            diff = last_val - first_val
-            if diff < 0:
-                diff = 0.0
-            results.append(round(diff, 2))
-        except Exception as e:
-            print(f"❌ Erreur compute_daily_diffs pour {metric_name} {day}: {e}")
-            results.append(0.0)
 
-    return results
+def paris_midnight(day):
+    """Minuit (heure de Paris) du jour `day`"""
+    return pytz.timezone("Europe/Paris").localize(datetime(day.year, day.month, day.day))
+
+
+def year_ago(dt):
+    """Même date et heure de Paris un an plus tôt (29/02 → 28/02)"""
+    naive = dt.replace(tzinfo=None)
+    try:
+        naive = naive.replace(year=naive.year - 1)
+    except ValueError:
+        naive = naive.replace(year=naive.year - 1, day=28)
+    return pytz.timezone("Europe/Paris").localize(naive)
 
 
 # =======================
-# Fonctions métier (équivalents aux versions longues)
+# Horloge du cycle
 # =======================
-def fetch_yearly_consumption_data(vm_host, vm_port, metric_names):
-    tz = pytz.timezone("Europe/Paris")
-    now = datetime.now(tz)
-    current_year = now.year
+_cycle_clock = contextvars.ContextVar("cycle_clock", default=None)
 
-    current_year_start = datetime(current_year, 1, 1, tzinfo=tz)
-    current_year_end = now
 
-    last_year = current_year - 1
-    last_year_start = datetime(last_year, 1, 1, tzinfo=tz)
-    try:
-        last_year_end = datetime(last_year, now.month, now.day, now.hour, now.minute, tzinfo=tz)
-    except ValueError:
-        # Cas 29/02
-        last_year_end = datetime(last_year, now.month, 28, now.hour, now.minute, tzinfo=tz)
+class CycleClock:
+    """
+    Instant de référence d'un cycle et bornes des périodes qui en découlent, calculées une fois.
+    Toutes les étapes d'un cycle voient le même "maintenant" (mêmes jours, mêmes fenêtres, donc mêmes
+    clés de cache et requêtes en vol partageables), même si le cycle chevauche minuit.
+    Les minuits sont localisés (paris_midnight): datetime(..., tzinfo=pytz) donnerait l'heure solaire de Paris (LMT).
+    """
+
+    def __init__(self, now=None):
+        tz = pytz.timezone("Europe/Paris")
+        self.now = now.astimezone(tz) if now is not None else datetime.now(tz)
+        self.now_ts = self.now.timestamp()
+        self.today = self.now.date()
+        self.midnight = paris_midnight(self.today)
+        year, month = self.today.year, self.today.month
+        # Même date et heure un an plus tôt, à la minute près
+        self.last_year_now = year_ago(self.now.replace(second=0, microsecond=0))
+
+        # Année en cours et année précédente
+        self.year_start = paris_midnight(date(year, 1, 1))
+        self.last_year_start = paris_midnight(date(year - 1, 1, 1))
+
+        # Mois en cours et même mois un an plus tôt
+        self.month_start = paris_midnight(date(year, month, 1))
+        self.last_year_month_start = paris_midnight(date(year - 1, month, 1))
+
+        # Mois précédent et même mois un an plus tôt: du 1er à minuit à la veille du mois suivant 23:59:59
+        last_month = (self.today.replace(day=1) - timedelta(days=1)).replace(day=1)
+        self.last_month_start = paris_midnight(last_month)
+        self.last_month_end = self.month_start - timedelta(seconds=1)
+        self.last_month_last_year_start = paris_midnight(last_month.replace(year=last_month.year - 1))
+        self.last_month_last_year_end = self.last_year_month_start - timedelta(seconds=1)
+
+        # Hier et avant-hier, jours complets
+        self.yesterday = self.today - timedelta(days=1)
+        self.day_before_yesterday = self.today - timedelta(days=2)
+        self.yesterday_start = paris_midnight(self.yesterday)
+        self.yesterday_end = self.midnight - timedelta(seconds=1)
+        self.day_before_start = paris_midnight(self.day_before_yesterday)
+        self.day_before_end = self.yesterday_start - timedelta(seconds=1)
+
+
+def cycle_clock(now=None):
+    """
+    Horloge du cycle en cours (RefreshScheduler), ou une horloge propre hors cycle.
+    now: instant explicite (ex. minuit pour un cumul arrêté à la veille), prioritaire.
+    """
+    if now is not None:
+        return CycleClock(now)
+    return _cycle_clock.get() or CycleClock()
+
+
+# =======================
+# Fonctions métier (adaptées)
+# =======================
+def fetch_yearly_consumption_data(metric_names, now=None):
+    """now: fin de la période (défaut l'horloge du cycle), ex. minuit pour un cumul arrêté à la veille"""
+    clock = cycle_clock(now)
 
-    current_year_consumption = compute_consumption_for_period(vm_host, vm_port, metric_names, current_year_start, current_year_end, step=3600, label="année en cours")
-    last_year_consumption = compute_consumption_for_period(vm_host, vm_port, metric_names, last_year_start, last_year_end, step=3600, label="année précédente")
+    current_year_start = clock.year_start
+    current_year_end = clock.now
+
+    last_year_start = clock.last_year_start
+    last_year_end = clock.last_year_now
+
+    def _compute(args):
+        start_dt, end_dt, label = args
+        return compute_consumption_for_period(metric_names, start_dt, end_dt, step=3600, label=label)
+
+    current_year_consumption, last_year_consumption = parallel_map(_compute, [
+        (current_year_start, current_year_end, "année en cours"),
+        (last_year_start, last_year_end, "année précédente"),
+    ])
 
     if last_year_consumption > 0:
         yearly_evolution = ((current_year_consumption - last_year_consumption) / last_year_consumption) * 100
@@ -1015,47 +2363,35 @@ def fetch_yearly_consumption_data(vm_host, vm_port, metric_names):
         yearly_evolution = 0.0
 
     yearly_evolution = round(yearly_evolution, 2)
-    print(f"📊 Consommation année en cours ({current_year_start.date()} → {current_year_end.date()}): {current_year_consumption} kWh")
-    print(f"📊 Consommation année précédente ({last_year_start.date()} → {last_year_end.date()}): {last_year_consumption} kWh")
-    print(f"📊 Évolution annuelle: {yearly_evolution}%")
+    logger.debug("📊 Consommation année en cours (%s → %s): %s kWh",
+                 current_year_start.date(), current_year_end.date(), current_year_consumption)
+    logger.debug("📊 Consommation année précédente (%s → %s): %s kWh",
+                 last_year_start.date(), last_year_end.date(), last_year_consumption)
+    logger.debug("📊 Évolution annuelle: %s%%", yearly_evolution)
 
     return current_year_consumption, last_year_consumption, yearly_evolution
 
 
-def fetch_monthly_consumption_data(vm_host, vm_port, metric_names):
-    tz = pytz.timezone("Europe/Paris")
-    now = datetime.now(tz)
+def fetch_monthly_consumption_data(metric_names):
+    clock = cycle_clock()
 
     # mois précédent
-    if now.month == 1:
-        last_month_year = now.year - 1
-        last_month_month = 12
-    else:
-        last_month_year = now.year
-        last_month_month = now.month - 1
-
-    last_month_start = datetime(last_month_year, last_month_month, 1, tzinfo=tz)
-    if last_month_month == 12:
-        next_month = datetime(last_month_year + 1, 1, 1, tzinfo=tz)
-    else:
-        next_month = datetime(last_month_year, last_month_month + 1, 1, tzinfo=tz)
-    last_month_end = next_month - timedelta(seconds=1)
+    last_month_start = clock.last_month_start
+    last_month_end = clock.last_month_end
 
     # même mois année précédente
-    last_year_month_year = last_month_year - 1
-    last_year_month_start = datetime(last_year_month_year, last_month_month, 1, tzinfo=tz)
-    if last_month_month == 12:
-        next_month_last_year = datetime(last_year_month_year + 1, 1, 1, tzinfo=tz)
-    else:
-        next_month_last_year = datetime(last_year_month_year, last_month_month + 1, 1, tzinfo=tz)
-    last_year_month_end = next_month_last_year - timedelta(seconds=1)
+    last_year_month_start = clock.last_month_last_year_start
+    last_year_month_end = clock.last_month_last_year_end
 
-    def _compute(start_dt, end_dt, label):
-        return compute_consumption_for_period(vm_host, vm_port, metric_names, start_dt, end_dt, step=3600, label=label)
+    def _compute(args):
+        start_dt, end_dt, label = args
+        return compute_consumption_for_period(metric_names, start_dt, end_dt, step=3600, label=label)
 
-    print("📅 Calcul mois précédent et même mois année précédente...")
-    last_month_consumption = _compute(last_month_start, last_month_end, f"mois précédent ({last_month_start.strftime('%B %Y')})")
-    last_month_last_year_consumption = _compute(last_year_month_start, last_year_month_end, f"même mois année précédente ({last_year_month_start.strftime('%B %Y')})")
+    logger.debug("📅 Calcul mois précédent et même mois année précédente...")
+    last_month_consumption, last_month_last_year_consumption = parallel_map(_compute, [
+        (last_month_start, last_month_end, f"mois précédent ({last_month_start.strftime('%B %Y')})"),
+        (last_year_month_start, last_year_month_end, f"même mois année précédente ({last_year_month_start.strftime('%B %Y')})"),
+    ])
 
     if last_month_last_year_consumption > 0:
         monthly_evolution = ((last_month_consumption - last_month_last_year_consumption) / last_month_last_year_consumption) * 100
@@ -1063,29 +2399,31 @@ def fetch_monthly_consumption_data(vm_host, vm_port, metric_names):
         monthly_evolution = 0.0
     monthly_evolution = round(monthly_evolution, 2)
 
-    print(f"📊 Consommation mois précédent: {last_month_consumption} kWh")
-    print(f"📊 Consommation même mois année précédente: {last_month_last_year_consumption} kWh")
-    print(f"📊 Évolution mensuelle: {monthly_evolution}%")
+    logger.debug("📊 Consommation mois précédent: %s kWh", last_month_consumption)
+    logger.debug("📊 Consommation même mois année précédente: %s kWh", last_month_last_year_consumption)
+    logger.debug("📊 Évolution mensuelle: %s%%", monthly_evolution)
 
     return last_month_consumption, last_month_last_year_consumption, monthly_evolution
 
 
-def fetch_current_month_consumption_data(vm_host, vm_port, metric_names):
-    tz = pytz.timezone("Europe/Paris")
-    now = datetime.now(tz)
+def fetch_current_month_consumption_data(metric_names, now=None):
+    """now: fin de la période (défaut l'horloge du cycle), ex. minuit pour un cumul arrêté à la veille"""
+    clock = cycle_clock(now)
 
-    current_month_start = datetime(now.year, now.month, 1, tzinfo=tz)
-    current_month_end = now
+    current_month_start = clock.month_start
+    current_month_end = clock.now
 
-    last_year = now.year - 1
-    last_year_month_start = datetime(last_year, now.month, 1, tzinfo=tz)
-    try:
-        last_year_month_end = datetime(last_year, now.month, now.day, now.hour, now.minute, tzinfo=tz)
-    except ValueError:
-        last_year_month_end = datetime(last_year, now.month, 28, now.hour, now.minute, tzinfo=tz)
+    last_year_month_start = clock.last_year_month_start
+    last_year_month_end = clock.last_year_now
+
+    def _compute(args):
+        start_dt, end_dt, label = args
+        return compute_consumption_for_period(metric_names, start_dt, end_dt, step=3600, label=label)
 
-    current_month_consumption = compute_consumption_for_period(vm_host, vm_port, metric_names, current_month_start, current_month_end, step=3600, label=f"mois en cours ({current_month_start.strftime('%B %Y')})")
-    current_month_last_year_consumption = compute_consumption_for_period(vm_host, vm_port, metric_names, last_year_month_start, last_year_month_end, step=3600, label=f"même période année précédente ({last_year_month_start.strftime('%B %Y')})")
+    current_month_consumption, current_month_last_year_consumption = parallel_map(_compute, [
+        (current_month_start, current_month_end, f"mois en cours ({current_month_start.strftime('%B %Y')})"),
+        (last_year_month_start, last_year_month_end, f"même période année précédente ({last_year_month_start.strftime('%B %Y')})"),
+    ])
 
     if current_month_last_year_consumption > 0:
         current_month_evolution = ((current_month_consumption - current_month_last_year_consumption) / current_month_last_year_consumption) * 100
@@ -1093,36 +2431,32 @@ def fetch_current_month_consumption_data(vm_host, vm_port, metric_names):
         current_month_evolution = 0.0
     current_month_evolution = round(current_month_evolution, 2)
 
-    print(f"📊 Consommation mois en cours: {current_month_consumption} kWh")
-    print(f"📊 Consommation même période année précédente: {current_month_last_year_consumption} kWh")
-    print(f"📊 Évolution mois en cours: {current_month_evolution}%")
+    logger.debug("📊 Consommation mois en cours: %s kWh", current_month_consumption)
+    logger.debug("📊 Consommation même période année précédente: %s kWh", current_month_last_year_consumption)
+    logger.debug("📊 Évolution mois en cours: %s%%", current_month_evolution)
 
     return current_month_consumption, current_month_last_year_consumption, current_month_evolution
 
 
-def fetch_daily_consumption_data(vm_host, vm_port, metric_names):
+def fetch_daily_consumption_data(metric_names):
     """
     Retourne: (yesterday, day_2, yesterday_evolution)
     où yesterday = conso hier (jour complet), day_2 = avant-hier (jour complet)
     """
-    tz = pytz.timezone("Europe/Paris")
-    now = datetime.now(tz)
-    today = now.date()
-
-    yesterday = today - timedelta(days=1)
-    yesterday_start = datetime(yesterday.year, yesterday.month, yesterday.day, tzinfo=tz)
-    yesterday_end = yesterday_start + timedelta(days=1) - timedelta(seconds=1)
+    clock = cycle_clock()
 
-    day_before_yesterday = today - timedelta(days=2)
-    day_before_start = datetime(day_before_yesterday.year, day_before_yesterday.month, day_before_yesterday.day, tzinfo=tz)
-    day_before_end = day_before_start + timedelta(days=1) - timedelta(seconds=1)
+    yesterday_start, yesterday_end = clock.yesterday_start, clock.yesterday_end
+    day_before_start, day_before_end = clock.day_before_start, clock.day_before_end
 
-    def _compute(start_dt, end_dt, label):
-        return compute_consumption_for_period(vm_host, vm_port, metric_names, start_dt, end_dt, step=3600, label=label)
+    def _compute(args):
+        start_dt, end_dt, label = args
+        return compute_consumption_for_period(metric_names, start_dt, end_dt, step=3600, label=label)
 
-    print("📅 Calcul consommation hier et avant-hier...")
-    yesterday_consumption = _compute(yesterday_start, yesterday_end, f"hier ({yesterday.strftime('%d/%m/%Y')})")
-    day_2_consumption = _compute(day_before_start, day_before_end, f"avant-hier ({day_before_yesterday.strftime('%d/%m/%Y')})")
+    logger.debug("📅 Calcul consommation hier et avant-hier...")
+    yesterday_consumption, day_2_consumption = parallel_map(_compute, [
+        (yesterday_start, yesterday_end, f"hier ({clock.yesterday.strftime('%d/%m/%Y')})"),
+        (day_before_start, day_before_end, f"avant-hier ({clock.day_before_yesterday.strftime('%d/%m/%Y')})"),
+    ])
 
     if day_2_consumption > 0:
         yesterday_evolution = ((yesterday_consumption - day_2_consumption) / day_2_consumption) * 100
@@ -1130,53 +2464,96 @@ def fetch_daily_consumption_data(vm_host, vm_port, metric_names):
         yesterday_evolution = 0.0
     yesterday_evolution = round(yesterday_evolution, 2)
 
-    print(f"📊 Consommation hier: {yesterday_consumption} kWh")
-    print(f"📊 Consommation avant-hier: {day_2_consumption} kWh")
-    print(f"📊 Évolution quotidienne: {yesterday_evolution}%")
+    logger.debug("📊 Consommation hier: %s kWh", yesterday_consumption)
+    logger.debug("📊 Consommation avant-hier: %s kWh", day_2_consumption)
+    logger.debug("📊 Évolution quotidienne: %s%%", yesterday_evolution)
 
     return yesterday_consumption, day_2_consumption, yesterday_evolution
 
 
-def fetch_tempo_tariffs_and_calculate_costs(vm_host, vm_port, dailyweek_HP, dailyweek_HC, dailyweek_Tempo):
-    tz = pytz.timezone("Europe/Paris")
-    now = datetime.now(tz)
-    today = now.date()
+def tempo_tariff_metrics():
+    """Noms des capteurs de tarif Tempo par couleur et par période (HP/HC)"""
+    # Adaptation des noms de métriques selon le type de DB
+    if active_meter().db_type == "influxdb":
+        return {
+            "BLUE": {"HP": "tarif_bleu_tempo_heures_pleines_ttc", "HC": "sensor.tarif_bleu_tempo_heures_creuses_ttc"},
+            "WHITE": {"HP": "tarif_blanc_tempo_heures_pleines_ttc", "HC": "sensor.tarif_blanc_tempo_heures_creuses_ttc"},
+            "RED": {"HP": "tarif_rouge_tempo_heures_pleines_ttc", "HC": "sensor.tarif_rouge_tempo_heures_creuses_ttc"},
+        }
+    else:
+        return {
+            "BLUE": {"HP": "sensor.tarif_bleu_tempo_heures_pleines_ttc_value", "HC": "sensor.tarif_bleu_tempo_heures_creuses_ttc_value"},
+            "WHITE": {"HP": "sensor.tarif_blanc_tempo_heures_pleines_ttc_value", "HC": "sensor.tarif_blanc_tempo_heures_creuses_ttc_value"},
+            "RED": {"HP": "sensor.tarif_rouge_tempo_heures_pleines_ttc_value", "HC": "sensor.tarif_rouge_tempo_heures_creuses_ttc_value"},
+        }
 
-    tariff_metrics = {
-        "BLUE": {"HP": "sensor.tarif_bleu_tempo_heures_pleines_ttc_value", "HC": "sensor.tarif_bleu_tempo_heures_creuses_ttc_value"},
-        "WHITE": {"HP": "sensor.tarif_blanc_tempo_heures_pleines_ttc_value", "HC": "sensor.tarif_blanc_tempo_heures_creuses_ttc_value"},
-        "RED": {"HP": "sensor.tarif_rouge_tempo_heures_pleines_ttc_value", "HC": "sensor.tarif_rouge_tempo_heures_creuses_ttc_value"},
-    }
 
-    def get_current_tariff(metric_name):
-        val = vm_query_instant(vm_host, vm_port, metric_name, timeout=10)
-        if val is None:
-            print(f"⚠️ Pas de données tarifaires pour {metric_name}")
-            return 0.0
-        try:
-            return float(val)
-        except Exception as e:
-            print(f"❌ Erreur parsing tarif {metric_name}: {e}")
-            return 0.0
+# Cache des tarifs: {(base, capteur): (valeur, horodatage de lecture)}, partagé par les compteurs d'une même base
+tariff_cache = {}
+_tariff_cache_lock = threading.Lock()
+
+
+def fetch_tempo_tariffs():
+    """
+    Tarifs Tempo courants: {couleur: {"HP": tarif, "HC": tarif}}.
+    Les capteurs absents du cache ou plus vieux que TARIFF_CACHE_TTL sont relus
+    en une seule requête instantanée; sinon aucun appel à la base.
+    Si un capteur ne répond pas, la dernière valeur connue est conservée (0.0 à défaut).
+    """
+    tariff_metrics = tempo_tariff_metrics()
+    metric_names = [name for periods in tariff_metrics.values() for name in periods.values()]
+    backend = active_meter().backend()
+    now_ts = cycle_clock().now_ts
+
+    with _tariff_cache_lock:
+        stale = [name for name in metric_names
+                 if (backend, name) not in tariff_cache or now_ts - tariff_cache[(backend, name)][1] >= TARIFF_CACHE_TTL]
+    if stale:
+        values = db_query_instant_multi(stale)
+        with _tariff_cache_lock:
+            for name in stale:
+                val = values.get(name)
+                if val is None:
+                    logger.warning("⚠️ Pas de données tarifaires pour %s", name)
+                    continue
+                try:
+                    tariff_cache[(backend, name)] = (float(val), now_ts)
+                except Exception as e:
+                    logger.error("❌ Erreur parsing tarif %s: %s", name, e)
+
+    with _tariff_cache_lock:
+        return {
+            color: {period: tariff_cache[(backend, name)][0] if (backend, name) in tariff_cache else 0.0
+                    for period, name in periods.items()}
+            for color, periods in tariff_metrics.items()
+        }
+
+
+def fetch_tempo_tariffs_and_calculate_costs(dailyweek_HP, dailyweek_HC, dailyweek_Tempo, tariffs=None):
+    today = cycle_clock().today
+
+    # Les tarifs peuvent être récupérés en amont, en parallèle des autres étapes du cycle
+    if tariffs is None:
+        tariffs = fetch_tempo_tariffs()
 
     dailyweek_cost = []
     dailyweek_costHP = []
     dailyweek_costHC = []
 
-    print("💰 Calcul des coûts journaliers avec tarifs Tempo...")
+    logger.debug("💰 Calcul des coûts journaliers avec tarifs Tempo...")
     for i in range(7):
         day = today - timedelta(days=i)
         color = dailyweek_Tempo[i] if i < len(dailyweek_Tempo) else "BLUE"
         hp_consumption = dailyweek_HP[i] if i < len(dailyweek_HP) else 0.0
         hc_consumption = dailyweek_HC[i] if i < len(dailyweek_HC) else 0.0
 
-        if color in tariff_metrics:
-            hp_tariff = get_current_tariff(tariff_metrics[color]["HP"])
-            hc_tariff = get_current_tariff(tariff_metrics[color]["HC"])
+        if color in tariffs:
+            hp_tariff = tariffs[color]["HP"]
+            hc_tariff = tariffs[color]["HC"]
         else:
-            print(f"⚠️ Couleur inconnue {color} pour le {day.strftime('%d/%m/%Y')}, utilisation tarif BLEU par défaut")
-            hp_tariff = get_current_tariff(tariff_metrics["BLUE"]["HP"])
-            hc_tariff = get_current_tariff(tariff_metrics["BLUE"]["HC"])
+            logger.warning("⚠️ Couleur inconnue %s pour le %s, utilisation tarif BLEU par défaut", color, day.strftime('%d/%m/%Y'))
+            hp_tariff = tariffs["BLUE"]["HP"]
+            hc_tariff = tariffs["BLUE"]["HC"]
 
         cost_hp = round(hp_consumption * hp_tariff, 2)
         cost_hc = round(hc_consumption * hc_tariff, 2)
@@ -1186,97 +2563,117 @@ def fetch_tempo_tariffs_and_calculate_costs(vm_host, vm_port, dailyweek_HP, dail
         dailyweek_costHC.append(cost_hc)
         dailyweek_cost.append(total_cost)
 
-        # Le script original affichait hp_tariff/100 pour format euro; on garde cette notation informative.
-        print(f"💰 {day.strftime('%d/%m/%Y')} ({color}): HP={hp_consumption}kWh×{hp_tariff/100:.4f}€ + HC={hc_consumption}kWh×{hc_tariff/100:.4f}€ = {total_cost}€")
+        logger.debug("💰 %s (%s): HP=%skWh×%.4f€ + HC=%skWh×%.4f€ = %s€", day.strftime('%d/%m/%Y'), color,
+                     hp_consumption, hp_tariff / 100, hc_consumption, hc_tariff / 100, total_cost)
 
-    print(f"💰 Coûts totaux journaliers: {dailyweek_cost}")
-    print(f"💰 Coûts HP journaliers: {dailyweek_costHP}")
-    print(f"💰 Coûts HC journaliers: {dailyweek_costHC}")
+    logger.debug("💰 Coûts totaux journaliers: %s", dailyweek_cost)
+    logger.debug("💰 Coûts HP journaliers: %s", dailyweek_costHP)
+    logger.debug("💰 Coûts HC journaliers: %s", dailyweek_costHC)
 
     return dailyweek_cost, dailyweek_costHP, dailyweek_costHC
 
 
-def fetch_daily_max_power(vm_host, vm_port, metric_name, days=7):
+def fetch_daily_max_power(metric_name, days=7):
     tz = pytz.timezone("Europe/Paris")
-    now = datetime.now(tz)
-    today = now.date()
+    bounds = paris_day_bounds(days)
+    now_ts = cycle_clock().now_ts
+
+    # Jours clos déjà connus
+    store = get_daily_store()
+    store_key = active_meter().store_key(metric_name)
+    stored = store.get_max_power(store_key, [b[0] for b in bounds if is_closed_day(b, now_ts)]) if store else {}
+
+    missing = [b for b in bounds if b[0] not in stored]
+    # Max et horodatage des jours manquants: calculés par la base, sinon scan minute par minute
+    daily_max = db_query_daily_max(metric_name, missing) if DAILY_ROLLUP else scan_daily_max(metric_name, missing)
+    fetched = {
+        day: (round(max_val / 1000.0, 2), datetime.fromtimestamp(max_ts, tz=tz).strftime("%Y-%m-%d %H:%M:%S"))
+        for day, (max_val, max_ts) in daily_max.items()
+    }
 
     max_values = []
     max_times = []
-
-    for i in range(days):
-        day = today - timedelta(days=i)
-        start_dt = datetime(year=day.year, month=day.month, day=day.day, tzinfo=tz)
-        end_dt = now if day == today else (start_dt + timedelta(days=1))
-
-        start_ts = int(start_dt.timestamp())
-        end_ts = int(end_dt.timestamp())
-
-        values = vm_query_range(vm_host, vm_port, metric_name, start_ts, end_ts, step=60, timeout=30)
-        if not values:
+    new_closed = {}
+    for bound in bounds:
+        day = bound[0]
+        result = stored.get(day) or fetched.get(day)
+        if result is None:
             max_values.append(0)
-            max_times.append(start_dt.strftime("%Y-%m-%d 00:00:00"))
+            max_times.append(day.strftime("%Y-%m-%d 00:00:00"))
             continue
+        max_values.append(result[0])
+        max_times.append(result[1])
+        if day not in stored and is_closed_day(bound, now_ts):
+            new_closed[day] = result
 
-        max_val = -1.0
-        max_ts = start_ts
-        for ts, val in values:
-            try:
-                v = float(val) / 1000.0  # conversion VA → kVA
-                tss = int(float(ts))
-                if v > max_val:
-                    max_val = v
-                    max_ts = tss
-            except Exception:
-                continue
-
-        if max_val < 0:
-            max_values.append(0)
-            max_times.append(start_dt.strftime("%Y-%m-%d 00:00:00"))
-        else:
-            max_values.append(round(max_val, 2))
-            max_times.append(datetime.fromtimestamp(max_ts, tz=tz).strftime("%Y-%m-%d %H:%M:%S"))
+    if store:
+        store.put_max_power(store_key, new_closed)
 
     return max_values, max_times
 
 
-def fetch_daily_tempo_colors(vm_host, vm_port, days=7):
-    tz = pytz.timezone("Europe/Paris")
-    now = datetime.now(tz)
-    today = now.date()
-    colors = []
-
-    tempo_metrics = {
-        "BLUE": ["sensor.linky_tempo_index_bbrhpjb_value", "sensor.linky_tempo_index_bbrhcjb_value"],
-        "WHITE": ["sensor.linky_tempo_index_bbrhpjw_value", "sensor.linky_tempo_index_bbrhcjw_value"],
-        "RED": ["sensor.linky_tempo_index_bbrhpjr_value", "sensor.linky_tempo_index_bbrhcjr_value"],
+def tempo_color_metrics(meter=None):
+    """Compteurs d'index (HP, HC) de chaque couleur Tempo (du compteur en cours par défaut)"""
+    m = (meter or active_meter()).metrics
+    return {
+        "BLUE": [m["hpjb"], m["hcjb"]],
+        "WHITE": [m["hpjw"], m["hcjw"]],
+        "RED": [m["hpjr"], m["hcjr"]],
     }
 
-    for i in range(days):
-        day = today - timedelta(days=i)
-        start_dt = datetime(year=day.year, month=day.month, day=day.day, hour=0, tzinfo=tz)
-        end_dt = start_dt + timedelta(days=1)
 
+def detect_tempo_colors(daily_diffs, tempo_metrics, days=7):
+    """
+    Couleur de chaque jour à partir des consommations journalières par compteur:
+    la couleur dont les index (HP + HC) ont le plus augmenté, UNKNOWN si aucun n'a bougé.
+    daily_diffs: {metric: [jour0, jour1, ...]} comme retourné par compute_daily_diffs_multi.
+    """
+    colors = []
+    for i in range(days):
         detected_color = "UNKNOWN"
+        best_increase = 0.0
         for color, metrics in tempo_metrics.items():
-            stop = False
-            for metric in metrics:
-                values = vm_query_range(vm_host, vm_port, metric, int(start_dt.timestamp()), int(end_dt.timestamp()), step=300, timeout=10)
-                if not values:
-                    continue
-                for _, v in values:
-                    try:
-                        if float(v) > 0:
-                            detected_color = color
-                            stop = True
-                            break
-                    except Exception:
-                        continue
-                if stop:
-                    break
-            if detected_color != "UNKNOWN":
-                break
+            increase = sum(daily_diffs[m][i] for m in metrics if i < len(daily_diffs.get(m, [])))
+            if increase > best_increase:
+                detected_color = color
+                best_increase = increase
+        colors.append(detected_color)
+    return colors
+
+
+def fetch_daily_tempo_colors(days=7, daily_diffs=None):
+    """
+    Couleurs Tempo des `days` derniers jours (jour0 = aujourd'hui).
+    daily_diffs: consommations journalières des 6 compteurs déjà calculées dans le cycle;
+    sans elles, un seul appel compute_daily_diffs_multi (agrégat journalier) couvre toute la fenêtre.
+    """
+    bounds = paris_day_bounds(days)
+    now_ts = cycle_clock().now_ts
+
+    # Jours clos déjà connus
+    store = get_daily_store()
+    sensor = active_meter().name
+    stored = store.get_colors(sensor, [b[0] for b in bounds if is_closed_day(b, now_ts)]) if store else {}
+
+    tempo_metrics = tempo_color_metrics()
+    detected = None
+    if any(b[0] not in stored for b in bounds):
+        if daily_diffs is None:
+            all_metrics = [metric for metrics in tempo_metrics.values() for metric in metrics]
+            daily_diffs = compute_daily_diffs_multi(all_metrics, days=days)
+        detected = detect_tempo_colors(daily_diffs, tempo_metrics, days)
+
+    colors = []
+    new_closed = {}
+    for i, bound in enumerate(bounds):
+        day = bound[0]
+        detected_color = stored.get(day) or detected[i]
         colors.append(detected_color)
+        if day not in stored and detected_color != "UNKNOWN" and is_closed_day(bound, now_ts):
+            new_closed[day] = detected_color
+
+    if store:
+        store.put_colors(sensor, new_closed)
 
     return colors
 
@@ -1289,9 +2686,9 @@ def compute_weekly_consumption(daily_14):
     last_week = sum(daily_14[7:14])
     current_week_evolution = ((current_week - last_week) / last_week * 100) if last_week else 0.0
 
-    print(f"🗓️ Current week: {current_week} kWh")
-    print(f"🗓️ Last week:    {last_week} kWh")
-    print(f"📊 Evolution:    {current_week_evolution:.2f} %")
+    logger.debug("🗓️ Current week: %s kWh", current_week)
+    logger.debug("🗓️ Last week:    %s kWh", last_week)
+    logger.debug("📊 Evolution:    %.2f %%", current_week_evolution)
 
     return current_week, last_week, round(current_week_evolution, 2)
 
@@ -1307,8 +2704,7 @@ def build_linky_payload_exact(dailyweek_HP=None, dailyweek_HC=None,
                               current_month=0, current_month_last_year=0, current_month_evolution=0,
                               yesterday=0, day_2=0, yesterday_evolution=0,
                               dailyweek_cost=None, dailyweek_costHP=None, dailyweek_costHC=None):
-    tz = pytz.timezone("Europe/Paris")
-    today = datetime.now(tz).date()
+    today = cycle_clock().today
 
     dailyweek_dates = [(today - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(7)]
     hp = dailyweek_HP if dailyweek_HP else [0.0]*7
@@ -1365,113 +2761,573 @@ def build_linky_payload_exact(dailyweek_HP=None, dailyweek_HC=None,
 
 
 # =======================
-# SCRIPT PRINCIPAL
+# Publication MQTT
 # =======================
-def main():
-    client = mqtt.Client(protocol=mqtt.MQTTv5)
-    evt = threading.Event()
+# Valeurs scalaires du payload publiées sur leur propre topic: champ -> (unité, device_class, icône)
+LINKY_SCALAR_FIELDS = {
+    "current_year": ("kWh", "energy", "mdi:counter"),
+    "current_year_last_year": ("kWh", "energy", "mdi:counter"),
+    "yearly_evolution": ("%", None, "mdi:percent"),
+    "last_month": ("kWh", "energy", "mdi:counter"),
+    "last_month_last_year": ("kWh", "energy", "mdi:counter"),
+    "monthly_evolution": ("%", None, "mdi:percent"),
+    "current_month": ("kWh", "energy", "mdi:counter"),
+    "current_month_last_year": ("kWh", "energy", "mdi:counter"),
+    "current_month_evolution": ("%", None, "mdi:percent"),
+    "current_week": ("kWh", "energy", "mdi:counter"),
+    "last_week": ("kWh", "energy", "mdi:counter"),
+    "current_week_evolution": ("%", None, "mdi:percent"),
+    "yesterday": ("kWh", "energy", "mdi:counter"),
+    "day_2": ("kWh", "energy", "mdi:counter"),
+    "yesterday_evolution": ("%", None, "mdi:percent"),
+    "yesterday_HP": ("kWh", "energy", "mdi:counter"),
+    "yesterday_HC": ("kWh", "energy", "mdi:counter"),
+    "daily_cost": ("EUR", "monetary", "mdi:currency-eur"),
+}
+
+# Champs horodatés, ignorés pour savoir si le payload a changé
+VOLATILE_PAYLOAD_FIELDS = ("lastUpdate", "timeLastCall")
+
+
+def linky_scalar_topic(sensor, field, kind="state"):
+    return f"homeassistant/sensor/{sensor}_{field}/{kind}"
+
+
+def payload_digest(payload):
+    """Empreinte du payload hors champs horodatés"""
+    stable = {k: v for k, v in payload.items() if k not in VOLATILE_PAYLOAD_FIELDS}
+    return hashlib.sha256(json.dumps(stable, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class LinkyPublisher:
+    """
+    Publie le payload Linky d'un compteur seulement s'il a changé depuis la dernière publication
+    (ou après PUBLISH_FORCE_INTERVAL secondes) et, si PUBLISH_SCALAR_TOPICS,
+    chaque valeur scalaire sur son topic retenu quand elle a bougé.
+    """
 
-    def on_connect(c, u, flags, rc, props=None):
-        if rc == 0:
-            print("✅ MQTT connecté")
-            evt.set()
-        else:
-            print(f"❌ MQTT échec (rc={rc})")
+    def __init__(self, client, meter):
+        self.client = client
+        self.meter = meter
+        self.last_digest = None
+        self.last_publish = 0.0
+        self.scalars = {}
+        self.skipped = 0
+
+    def _publish(self, topic, payload, retain=MQTT_RETAIN):
+        t0 = time.time()
+        result = self.client.publish(topic, payload, qos=1, retain=retain)
+        failed = getattr(result, "rc", 0) != 0
+        try:
+            result.wait_for_publish()
+        except Exception:
+            # selon implementation paho, wait_for_publish peut échouer sur certains clients; on ignore
+            failed = True
+        metrics.observe("linky_mqtt_publish_duration_seconds", time.time() - t0)
+        if failed:
+            metrics.inc("linky_mqtt_publish_failures_total")
+
+    def publish_discovery(self):
+        """Configs discovery (retenues) du sensor Linky et, si activés, des topics scalaires"""
+        sensor = self.meter.name
+        linky_discovery_payload = {
+            "name": sensor.replace("_", " ").title(),
+            "state_topic": self.meter.state_topic,
+            "value_template": "{{ value_json.current_year }}",
+            "json_attributes_topic": self.meter.state_topic,
+            "unit_of_measurement": "kWh",
+            "device_class": "energy",
+            "icon": "mdi:counter",
+            "unique_id": f"{sensor}_sensor",
+            "device": {
+                "identifiers": [sensor],
+                "name": f"Compteur {sensor.replace('_', ' ').title()}",
+                "manufacturer": "Enedis",
+                "model": "Linky"
+            }
+        }
+        self.client.publish(self.meter.discovery_topic, json.dumps(linky_discovery_payload), qos=1, retain=True)
+        if not PUBLISH_SCALAR_TOPICS:
+            return
+        device = {"identifiers": [sensor]}
+        for field, (unit, device_class, icon) in LINKY_SCALAR_FIELDS.items():
+            config = {
+                "name": f"{sensor.replace('_', ' ').title()} {field.replace('_', ' ')}",
+                "state_topic": linky_scalar_topic(sensor, field),
+                "unit_of_measurement": unit,
+                "icon": icon,
+                "unique_id": f"{sensor}_{field}",
+                "device": device,
+            }
+            if device_class:
+                config["device_class"] = device_class
+            self._publish(linky_scalar_topic(sensor, field, "config"), json.dumps(config), retain=True)
+        logger.info("📡 Discovery publiée pour %d topics scalaires (%s)", len(LINKY_SCALAR_FIELDS), sensor)
+
+    def publish(self, payload):
+        """Retourne True si le payload a été publié, False s'il était identique au précédent"""
+        now = time.time()
+        forced = PUBLISH_FORCE_INTERVAL <= 0 or now - self.last_publish >= PUBLISH_FORCE_INTERVAL
+        digest = payload_digest(payload)
+        if digest == self.last_digest and not forced:
+            self.skipped += 1
+            return False
+
+        self._publish(self.meter.state_topic, json.dumps(payload))
+        self.last_digest = digest
+        self.last_publish = now
+
+        if PUBLISH_SCALAR_TOPICS:
+            moved = 0
+            for field in LINKY_SCALAR_FIELDS:
+                if field not in payload:
+                    continue
+                value = payload[field]
+                if forced or self.scalars.get(field) != value:
+                    self._publish(linky_scalar_topic(self.meter.name, field), json.dumps(value))
+                    self.scalars[field] = value
+                    moved += 1
+            if moved:
+                logger.debug("📡 %d topics scalaires mis à jour (%s)", moved, self.meter.name)
+        return True
+
+
+def payload_snapshot_path(meter):
+    """Instantané du dernier payload publié d'un compteur, dans STATE_DIR"""
+    name = re.sub(r"[^\w.-]", "_", meter.name)
+    return os.path.join(STATE_DIR, f"linky_payload_{name}.json")
+
+
+def save_payload_snapshot(meter, payload):
+    """Écrit l'instantané dans un fichier temporaire puis le renomme: jamais de fichier tronqué"""
+    path = payload_snapshot_path(meter)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def load_payload_snapshot(meter):
+    """Dernier payload enregistré du compteur, None s'il n'existe pas ou est illisible"""
+    path = payload_snapshot_path(meter)
+    try:
+        with open(path, encoding="utf-8") as f:
+            payload = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("⚠️ [%s] Instantané du payload illisible (%s): %s", meter.name, path, e)
+        return None
+    return payload if isinstance(payload, dict) else None
 
-    client.on_connect = on_connect
-    if LOGIN and PASSWORD:
-        client.username_pw_set(LOGIN, PASSWORD)
 
-    client.loop_start()
-    try:
-        client.connect(MQTT_HOST, MQTT_PORT, 60)
-    except Exception as e:
-        print(f"❌ Connexion MQTT impossible: {e}")
-        sys.exit(1)
+# =======================
+# Réécriture des agrégats journaliers
+# =======================
+# Compteur d'index -> (période, couleur Tempo)
+ROLLUP_COUNTERS = {
+    "hpjb": ("HP", "BLUE"), "hcjb": ("HC", "BLUE"),
+    "hpjw": ("HP", "WHITE"), "hcjw": ("HC", "WHITE"),
+    "hpjr": ("HP", "RED"), "hcjr": ("HC", "RED"),
+}
 
-    if not evt.wait(timeout=10):
-        print("⛔ Timeout MQTT")
-        sys.exit(1)
 
-    # Discovery Linky
-    linky_discovery_payload = {
-        "name": SENSOR_NAME.replace("_", " ").title(),
-        "state_topic": LINKY_STATE_TOPIC,
-        "value_template": "{{ value_json.current_year }}",
-        "json_attributes_topic": LINKY_STATE_TOPIC,
-        "unit_of_measurement": "kWh",
-        "device_class": "energy",
-        "icon": "mdi:counter",
-        "unique_id": f"{SENSOR_NAME}_sensor",
-        "device": {
-            "identifiers": [SENSOR_NAME],
-            "name": f"Compteur {SENSOR_NAME.replace('_', ' ').title()}",
-            "manufacturer": "Enedis",
-            "model": "Linky"
-        }
+def rollup_points(meter, payload, daily_diffs, written, now_ts=None):
+    """
+    Agrégats des jours clos du payload pas encore écrits, horodatés à minuit (Paris):
+      - <préfixe>_energy_kwh{period, color}: conso du jour par compteur d'index
+      - <préfixe>_max_power_kva et <préfixe>_max_power_timestamp_seconds
+      - <préfixe>_cost_eur{period}: coûts HP, HC et total
+    Retourne (jours, [(nom, labels, ts, valeur)]).
+    """
+    days, points = [], []
+    for i, day_str in enumerate(payload["dailyweek"]):
+        day = datetime.strptime(day_str, "%Y-%m-%d").date()
+        start_ts = int(paris_midnight(day).timestamp())
+        end_ts = int(paris_midnight(day + timedelta(days=1)).timestamp())
+        if day in written or not is_closed_day((day, start_ts, end_ts), now_ts):
+            continue
+        days.append(day)
+        labels = {"meter": meter.name}
+        for key, (period, color) in ROLLUP_COUNTERS.items():
+            points.append((f"{ROLLUP_METRIC_PREFIX}_energy_kwh", {**labels, "period": period, "color": color},
+                           start_ts, daily_diffs[meter.metrics[key]][i]))
+        points.append((f"{ROLLUP_METRIC_PREFIX}_max_power_kva", labels, start_ts, payload["dailyweek_MP"][i]))
+        max_power_at = pytz.timezone("Europe/Paris").localize(
+            datetime.strptime(payload["dailyweek_MP_time"][i], "%Y-%m-%d %H:%M:%S"))
+        points.append((f"{ROLLUP_METRIC_PREFIX}_max_power_timestamp_seconds", labels, start_ts,
+                       int(max_power_at.timestamp())))
+        for period, field in (("HP", "dailyweek_costHP"), ("HC", "dailyweek_costHC"), ("total", "dailyweek_cost")):
+            points.append((f"{ROLLUP_METRIC_PREFIX}_cost_eur", {**labels, "period": period},
+                           start_ts, payload[field][i]))
+    return days, points
+
+
+# =======================
+# Mode flux (trames TIC via MQTT)
+# =======================
+TELEINFO_POWER_LABELS = ("PAPP", "SINSTS")  # puissance apparente (VA), mode historique / standard
+TEMPO_PERIOD_COLORS = {"B": "BLUE", "W": "WHITE", "R": "RED"}
+
+
+def teleinfo_index_labels(meter):
+    """Étiquette TIC de chaque compteur d'index Tempo"""
+    m = meter.metrics
+    return {
+        "BBRHPJB": m["hpjb"],
+        "BBRHCJB": m["hcjb"],
+        "BBRHPJW": m["hpjw"],
+        "BBRHCJW": m["hcjw"],
+        "BBRHPJR": m["hpjr"],
+        "BBRHCJR": m["hcjr"],
     }
-    client.publish(LINKY_DISCOVERY_TOPIC, json.dumps(linky_discovery_payload), qos=1, retain=True)
 
-    print("\n--- Boucle MQTT démarrée ---")
-    current_day = datetime.now(pytz.timezone("Europe/Paris")).date()
 
-    tempo_metrics = [METRIC_NAMEhpjb, METRIC_NAMEhcjb, METRIC_NAMEhpjw,
-                     METRIC_NAMEhcjw, METRIC_NAMEhpjr, METRIC_NAMEhcjr]
+# Réveil de la boucle principale à l'arrivée d'une trame, tous compteurs confondus
+live_wake = threading.Event()
 
-    while True:
-        now_dt = datetime.now(pytz.timezone("Europe/Paris"))
-        today = now_dt.date()
-        if today != current_day:
-            print("🔄 Changement de jour détecté, rafraîchissement complet")
-            current_day = today
-
-        # HP / HC pour 14 derniers jours (chaque metric séparément)
-        hpjb_14 = compute_daily_diffs(VM_HOST, VM_PORT, METRIC_NAMEhpjb, days=14)
-        hpjw_14 = compute_daily_diffs(VM_HOST, VM_PORT, METRIC_NAMEhpjw, days=14)
-        hpjr_14 = compute_daily_diffs(VM_HOST, VM_PORT, METRIC_NAMEhpjr, days=14)
-        hcjb_14 = compute_daily_diffs(VM_HOST, VM_PORT, METRIC_NAMEhcjb, days=14)
-        hcjw_14 = compute_daily_diffs(VM_HOST, VM_PORT, METRIC_NAMEhcjw, days=14)
-        hcjr_14 = compute_daily_diffs(VM_HOST, VM_PORT, METRIC_NAMEhcjr, days=14)
 
-        daily_14 = [round(hpjb_14[i] + hpjw_14[i] + hpjr_14[i] + hcjb_14[i] + hcjw_14[i] + hcjr_14[i], 2) for i in range(14)]
+def parse_teleinfo_message(topic, payload):
+    """
+    Étiquettes TIC d'un message MQTT, {étiquette: valeur}.
+    Accepte une trame JSON ({"BBRHPJB": 123, ...} ou {"BBRHPJB": {"raw": "...", "value": 123}, ...})
+    ou une valeur seule publiée sur <topic>/<ÉTIQUETTE>.
+    """
+    text = payload.decode("utf-8", "replace").strip()
+    try:
+        data = json.loads(text)
+    except ValueError:
+        data = text
+    if not isinstance(data, dict):
+        data = {topic.rsplit("/", 1)[-1]: data}
+
+    fields = {}
+    for label, value in data.items():
+        if isinstance(value, dict):
+            value = value.get("value", value.get("raw"))
+        fields[str(label).upper()] = value
+    return fields
+
+
+def evolution_percent(current, previous):
+    return round((current - previous) / previous * 100, 2) if previous > 0 else 0.0
+
+
+class LiveDayState:
+    """
+    Chiffres du jour en cours tenus en mémoire à partir des trames TIC.
+    La conso du jour d'un compteur = conso calculée par la base au dernier cycle (`ref`)
+    + progression de l'index reçu depuis (`last` - `base`); sans cycle sur le jour,
+    `base` est le dernier index de la veille (ou la première trame reçue).
+    """
+
+    def __init__(self, meter):
+        self.tz = pytz.timezone("Europe/Paris")
+        self.meter = meter
+        self.lock = threading.Lock()
+        self.updated = threading.Event()
+        self.labels = teleinfo_index_labels(meter)
+        self.color_by_metric = {m: color for color, metrics in tempo_color_metrics(meter).items() for m in metrics}
+        self.day = None
+        self.ref = {}
+        self.base = {}
+        self.last = {}
+        self.max_power = None  # (VA, timestamp)
+        self.active_color = None
+        self.frames = 0
+
+    def _roll(self, day):
+        self.day = day
+        self.ref = {}
+        self.base = dict(self.last)
+        self.max_power = None
+
+    def ingest(self, fields, ts=None):
+        """Intègre les étiquettes d'une trame; retourne True si un chiffre suivi a été mis à jour"""
+        ts = ts or time.time()
+        day = datetime.fromtimestamp(ts, tz=self.tz).date()
+        changed = False
+        with self.lock:
+            if self.day is None or day > self.day:
+                self._roll(day)
+            for label, value in fields.items():
+                try:
+                    if label in self.labels:
+                        metric = self.labels[label]
+                        index = float(value) * TELEINFO_INDEX_SCALE
+                        self.base.setdefault(metric, index)
+                        if metric in self.last and index > self.last[metric]:
+                            self.active_color = self.color_by_metric[metric]
+                        self.last[metric] = index
+                        changed = True
+                    elif label in TELEINFO_POWER_LABELS:
+                        power = float(value)
+                        if self.max_power is None or power > self.max_power[0]:
+                            self.max_power = (power, ts)
+                        changed = True
+                    elif label == "PTEC":
+                        # Période tarifaire en cours, ex. "HPJB" → BLUE
+                        color = TEMPO_PERIOD_COLORS.get(str(value).strip().rstrip(".")[-1:])
+                        if color:
+                            self.active_color = color
+                except (TypeError, ValueError):
+                    continue
+            if changed:
+                self.frames += 1
+        if changed:
+            self.updated.set()
+            live_wake.set()
+        return changed
+
+    def on_message(self, client, userdata, msg):
+        try:
+            self.ingest(parse_teleinfo_message(msg.topic, msg.payload))
+        except Exception as e:
+            logger.warning("⚠️ Trame TIC ignorée (%s): %s", msg.topic, e)
+
+    def anchor(self, day, today_diffs):
+        """Recale les consos du jour sur celles calculées par la base au cycle qui vient de se terminer"""
+        with self.lock:
+            if self.day is not None and self.day > day:
+                return
+            if self.day != day:
+                self._roll(day)
+            self.ref = dict(today_diffs)
+            self.base = dict(self.last)
+
+    def apply(self, payload, tariffs):
+        """
+        Remplace les chiffres du jour (jour0) du payload par ceux du flux et met à jour
+        les cumuls semaine / mois / année, coûts calculés avec `tariffs` (ceux du dernier cycle:
+        aucune requête vers la base). Retourne False si le flux est déjà sur un autre jour
+        que le payload (nouveau cycle complet nécessaire).
+        """
+        with self.lock:
+            if self.day is None:
+                return True
+            if payload["dailyweek"][0] != self.day.strftime("%Y-%m-%d"):
+                return False
+            diffs = {}
+            for metric in self.labels.values():
+                progress = self.last[metric] - self.base[metric] if metric in self.last and metric in self.base else 0.0
+                diffs[metric] = max(0.0, self.ref.get(metric, 0.0) + progress)
+            max_power = self.max_power
+            active_color = self.active_color
+
+        m = self.meter.metrics
+        hp = round(diffs[m["hpjb"]] + diffs[m["hpjw"]] + diffs[m["hpjr"]], 2)
+        hc = round(diffs[m["hcjb"]] + diffs[m["hcjw"]] + diffs[m["hcjr"]], 2)
+        delta = round(hp + hc, 2) - payload["daily"][0]
+        payload["dailyweek_HP"][0] = hp
+        payload["dailyweek_HC"][0] = hc
+        payload["daily"][0] = round(hp + hc, 2)
+        for key in ("current_week", "current_month", "current_year"):
+            payload[key] = round(payload[key] + delta, 2)
+        payload["current_week_evolution"] = evolution_percent(payload["current_week"], payload["last_week"])
+        payload["current_month_evolution"] = evolution_percent(payload["current_month"], payload["current_month_last_year"])
+        payload["yearly_evolution"] = evolution_percent(payload["current_year"], payload["current_year_last_year"])
+
+        color = detect_tempo_colors({metric: [d] for metric, d in diffs.items()}, tempo_color_metrics(self.meter), 1)[0]
+        if color == "UNKNOWN" and active_color:
+            color = active_color
+        payload["dailyweek_Tempo"][0] = color
+
+        day_tariffs = tariffs.get(color, tariffs["BLUE"])
+        cost_hp = round(hp * day_tariffs["HP"], 2)
+        cost_hc = round(hc * day_tariffs["HC"], 2)
+        payload["dailyweek_costHP"][0] = cost_hp
+        payload["dailyweek_costHC"][0] = cost_hc
+        payload["dailyweek_cost"][0] = round(cost_hp + cost_hc, 2)
+        payload["daily_cost"] = payload["dailyweek_cost"][0]
+
+        if max_power is not None:
+            kva = round(max_power[0] / 1000.0, 2)  # conversion VA → kVA
+            if kva > payload["dailyweek_MP"][0]:
+                payload["dailyweek_MP"][0] = kva
+                payload["dailyweek_MP_time"][0] = datetime.fromtimestamp(max_power[1], tz=self.tz).strftime("%Y-%m-%d %H:%M:%S")
+                payload["dailyweek_MP_over"][0] = kva > 7
+        return True
+
+
+# =======================
+# Cycle de calcul
+# =======================
+# Résultats de l'étage "history"; délai avant un nouvel essai d'un étage dont une requête a échoué
+HISTORY_RESULTS = ("yearly", "current_month", "monthly", "daily")
+STAGE_RETRY_DELAY = min(TODAY_REFRESH_INTERVAL, 60)
 
-        # Calcul des semaines
-        current_week, last_week, current_week_evolution = compute_weekly_consumption(daily_14)
 
-        # Calcul des données annuelles
-        print("\n📊 Calcul des données annuelles...")
-        current_year, current_year_last_year, yearly_evolution = fetch_yearly_consumption_data(VM_HOST, VM_PORT, tempo_metrics)
+class RefreshScheduler:
+    """
+    Rafraîchissement par étage, chacun avec sa propre échéance:
+      - "history": cumuls arrêtés à minuit (année, mois en cours et mêmes périodes un an plus tôt),
+        mois précédent, hier / avant-hier. À chaque minuit de Paris, puis une seconde fois
+        STORE_SETTLE_LAG s après pour intégrer les dernières mesures de la veille.
+      - "today": conso des 14 derniers jours (jours clos servis par le stockage local),
+        puissance max, couleurs, et tranche du jour un an plus tôt; toutes les TODAY_REFRESH_INTERVAL s.
+      - "tariffs": tarifs Tempo toutes les TARIFF_REFRESH_INTERVAL s.
+    Les échéances sont des multiples de l'intervalle (calées sur l'horloge, sans dérive liée à la
+    durée du calcul) et "today" est toujours recalculé à minuit. `stagger` décale toutes les
+    échéances du compteur pour que plusieurs compteurs n'interrogent pas la base à la même seconde.
+    Un étage dont une requête a échoué reste échu et est recalculé STAGE_RETRY_DELAY s plus tard.
+    """
 
-        # Calcul des données mensuelles
-        print("\n📊 Calcul des données mensuelles...")
-        last_month, last_month_last_year, monthly_evolution = fetch_monthly_consumption_data(VM_HOST, VM_PORT, tempo_metrics)
+    def __init__(self, meter, stagger=0.0):
+        self.tz = pytz.timezone("Europe/Paris")
+        self.meter = meter
+        self.tempo_metrics = meter.tempo_metrics()
+        self.stagger = stagger
+        self.results = {}
+        self.next_due = {"history": 0.0, "today": 0.0, "tariffs": 0.0}
+        self.last_cycle = {}
+
+    def _deadline(self, stage, now_ts):
+        today = datetime.fromtimestamp(now_ts - self.stagger, tz=self.tz).date()
+        next_midnight = paris_midnight(today + timedelta(days=1)).timestamp() + self.stagger
+        if stage == "history":
+            settled = paris_midnight(today).timestamp() + STORE_SETTLE_LAG + self.stagger
+            return settled if settled > now_ts and self.results.get("history_day") == today else next_midnight
+        interval = TODAY_REFRESH_INTERVAL if stage == "today" else TARIFF_REFRESH_INTERVAL
+        return min(((now_ts - self.stagger) // interval + 1) * interval + self.stagger, next_midnight)
+
+    def next_deadline(self):
+        return min(self.next_due.values())
+
+    def refresh_now(self, now_ts=None):
+        """Rend l'historique et le jour en cours échus (recalcul complet au prochain passage de la boucle)"""
+        now_ts = now_ts or time.time()
+        for stage in ("history", "today"):
+            self.next_due[stage] = min(self.next_due[stage], now_ts)
+
+    def postpone(self, delay):
+        """Reporte les étages échus (après un échec) pour ne pas reboucler immédiatement"""
+        now_ts = time.time()
+        for stage, deadline in self.next_due.items():
+            if deadline <= now_ts:
+                self.next_due[stage] = now_ts + delay
+
+    def run(self, executor, live=None, now_ts=None):
+        """Recalcule les étages arrivés à échéance et retourne le payload Linky complet"""
+        return run_for_meter(self.meter, self._run, executor, live, now_ts)
+
+    def _run(self, executor, live, now_ts):
+        now_ts = now_ts or time.time()
+        t0 = time.time()
+        # Un seul "maintenant" pour toutes les étapes du cycle (contexte propre à run_for_meter)
+        clock = CycleClock(datetime.fromtimestamp(now_ts, tz=self.tz))
+        _cycle_clock.set(clock)
+        now, midnight = clock.now, clock.midnight
+        due = [stage for stage, deadline in self.next_due.items() if now_ts >= deadline]
+        if "history" in due:
+            # L'historique sert de base au jour en cours: les deux sont recalculés ensemble
+            if "today" not in due:
+                due.append("today")
+            if self.results.get("history_day") not in (None, now.date()):
+                logger.info("🔄 Changement de jour détecté, rafraîchissement de l'historique")
+        logger.log(CYCLE_LOG_LEVEL, "🚀 [%s] Étages à rafraîchir: %s (%d workers, %d requêtes max en vol)",
+                   self.meter.name, ", ".join(due), CYCLE_WORKERS, MAX_IN_FLIGHT)
+
+        def submit(func, *args):
+            # Durée de chaque étape dans linky_stage_duration_seconds{stage=<fonction>};
+            # résultat accompagné de l'indicateur "une requête vers la base a échoué"
+            return submit_in_context(executor, run_tracking_failures, timed_stage, func.__name__, func, *args)
+
+        futures = {}
+        if "history" in due:
+            futures.update({
+                "yearly": submit(fetch_yearly_consumption_data, self.tempo_metrics, midnight),
+                "current_month": submit(fetch_current_month_consumption_data, self.tempo_metrics, midnight),
+                "monthly": submit(fetch_monthly_consumption_data, self.tempo_metrics),
+                "daily": submit(fetch_daily_consumption_data, self.tempo_metrics),
+            })
+        if "today" in due:
+            futures.update({
+                # HP / HC pour 14 derniers jours (les 6 compteurs ensemble)
+                "daily_diffs": submit(compute_daily_diffs_multi, self.tempo_metrics, 14),
+                "max_power": submit(fetch_daily_max_power, self.meter.metrics["pcons"], 7),
+                # Tranche minuit → maintenant du même jour un an plus tôt
+                "today_last_year": submit(compute_consumption_for_period, self.tempo_metrics,
+                                          year_ago(midnight), year_ago(now), 3600, "jour en cours année précédente"),
+            })
+        if "tariffs" in due:
+            futures["tariffs"] = submit(fetch_tempo_tariffs)
+
+        # Les fonctions métier absorbent les erreurs de la base (0 ou {}): un étage dont une requête a échoué
+        # est publié tel quel mais reste échu, sinon l'historique resterait faux jusqu'au minuit suivant
+        failed_stages = set()
+        for name, future in futures.items():
+            self.results[name], failed = future.result()
+            if failed:
+                failed_stages.add("history" if name in HISTORY_RESULTS else "tariffs" if name == "tariffs" else "today")
+        if "history" in due and "history" not in failed_stages:
+            self.results["history_day"] = now.date()
+        for stage in due:
+            if stage in failed_stages:
+                self.next_due[stage] = now_ts + STAGE_RETRY_DELAY
+                logger.warning("⚠️ [%s] Étage %s incomplet (requête en échec), nouvel essai dans %ds",
+                               self.meter.name, stage, STAGE_RETRY_DELAY)
+            else:
+                self.next_due[stage] = self._deadline(stage, now_ts)
+        if live is not None and "today" in due:
+            diffs_14 = self.results["daily_diffs"]
+            live.anchor(now.date(), {m: diffs_14[m][0] for m in self.tempo_metrics})
+
+        payload = timed_stage("build_payload", self._build_payload)
+        elapsed = time.time() - t0
+        metrics.observe("linky_stage_duration_seconds", elapsed, {"stage": "cycle"})
+        self.last_cycle = {"stages": due, "duration_s": round(elapsed, 3)}
+        stats = http_client_stats()
+        logger.log(CYCLE_LOG_LEVEL, "⏱️ [%s] Cycle calculé en %.2fs (HTTP: %d requêtes, %d connexions ouvertes, "
+                   "%d réutilisées, %d nouvelles tentatives)", self.meter.name, elapsed, stats["requests"],
+                   stats["connections_opened"], stats["connections_reused"], stats["retries"])
+        if live is not None:
+            live.apply(payload, self.results["tariffs"])
+        return payload
+
+    def _build_payload(self):
+        r = self.results
+        m = self.meter.metrics
+        diffs_14 = r["daily_diffs"]
+        hpjb_14 = diffs_14[m["hpjb"]]
+        hpjw_14 = diffs_14[m["hpjw"]]
+        hpjr_14 = diffs_14[m["hpjr"]]
+        hcjb_14 = diffs_14[m["hcjb"]]
+        hcjw_14 = diffs_14[m["hcjw"]]
+        hcjr_14 = diffs_14[m["hcjr"]]
 
-        # Calcul des données du mois en cours
-        print("\n📊 Calcul des données du mois en cours...")
-        current_month, current_month_last_year, current_month_evolution = fetch_current_month_consumption_data(VM_HOST, VM_PORT, tempo_metrics)
+        daily_14 = [round(hpjb_14[i] + hpjw_14[i] + hpjr_14[i] + hcjb_14[i] + hcjw_14[i] + hcjr_14[i], 2) for i in range(14)]
 
-        # Calcul des données quotidiennes
-        print("\n📊 Calcul des données quotidiennes...")
-        yesterday, day_2, yesterday_evolution = fetch_daily_consumption_data(VM_HOST, VM_PORT, tempo_metrics)
+        # Calcul des semaines
+        current_week, last_week, current_week_evolution = compute_weekly_consumption(daily_14)
 
         # HP / HC pour les 7 derniers jours
         dailyweek_HP = [round(hpjb_14[i] + hpjw_14[i] + hpjr_14[i], 2) for i in range(7)]
         dailyweek_HC = [round(hcjb_14[i] + hcjw_14[i] + hcjr_14[i], 2) for i in range(7)]
 
-        # Puissance max
-        dailyweek_MP, dailyweek_MP_time = fetch_daily_max_power(VM_HOST, VM_PORT, METRIC_NAMEpcons, days=7)
-
-        # Couleurs tempo
-        dailyweek_Tempo = fetch_daily_tempo_colors(VM_HOST, VM_PORT, days=7)
+        # Couleurs tempo, déduites des mêmes consommations journalières (aucune requête supplémentaire)
+        dailyweek_Tempo = fetch_daily_tempo_colors(7, daily_diffs=diffs_14)
 
-        # Calcul des coûts avec les tarifs Tempo
-        print("\n💰 Calcul des coûts journaliers...")
+        # Calcul des coûts avec les tarifs Tempo (attend HP/HC, couleurs et tarifs)
         dailyweek_cost, dailyweek_costHP, dailyweek_costHC = fetch_tempo_tariffs_and_calculate_costs(
-            VM_HOST, VM_PORT, dailyweek_HP, dailyweek_HC, dailyweek_Tempo
+            dailyweek_HP, dailyweek_HC, dailyweek_Tempo, tariffs=r["tariffs"]
         )
 
+        # Cumuls = historique arrêté à minuit + jour en cours
+        year_base, year_base_last_year, _ = r["yearly"]
+        month_base, month_base_last_year, _ = r["current_month"]
+        current_year = round(year_base + daily_14[0], 2)
+        current_year_last_year = round(year_base_last_year + r["today_last_year"], 2)
+        current_month = round(month_base + daily_14[0], 2)
+        current_month_last_year = round(month_base_last_year + r["today_last_year"], 2)
+        yearly_evolution = evolution_percent(current_year, current_year_last_year)
+        current_month_evolution = evolution_percent(current_month, current_month_last_year)
+
+        last_month, last_month_last_year, monthly_evolution = r["monthly"]
+        yesterday, day_2, yesterday_evolution = r["daily"]
+        dailyweek_MP, dailyweek_MP_time = r["max_power"]
+
         # JSON
-        linky_payload = build_linky_payload_exact(
+        return build_linky_payload_exact(
             dailyweek_HP, dailyweek_HC, dailyweek_MP, dailyweek_MP_time, dailyweek_Tempo,
             current_week, last_week, current_week_evolution,
             current_year, current_year_last_year, yearly_evolution,
@@ -1480,52 +3336,434 @@ def main():
             yesterday, day_2, yesterday_evolution,
             dailyweek_cost, dailyweek_costHP, dailyweek_costHC
         )
-        now_iso = now_dt.isoformat()
-        linky_payload["lastUpdate"] = now_iso
-        linky_payload["timeLastCall"] = now_iso
-
-        # === LOG DES VARIABLES CALCULEES ===
-        print("\n📑 Variables calculées pour ce cycle:")
-        print(f"  Dates:          {linky_payload['dailyweek']}")
-        print(f"  HP (7j):        {dailyweek_HP}")
-        print(f"  HC (7j):        {dailyweek_HC}")
-        print(f"  Daily (HP+HC):  {linky_payload['daily']}")
-        print(f"  MP (7j):        {dailyweek_MP}")
-        print(f"  MP times:       {dailyweek_MP_time}")
-        print(f"  Tempo couleurs: {dailyweek_Tempo}")
-        print(f"  Yesterday HP:   {linky_payload['yesterday_HP']}")
-        print(f"  Yesterday HC:   {linky_payload['yesterday_HC']}")
-        print(f"  Current week:   {linky_payload['current_week']} kWh")
-        print(f"  Last week:      {linky_payload['last_week']} kWh")
-        print(f"  Week evolution: {linky_payload['current_week_evolution']}%")
-        print(f"  Current year:   {linky_payload['current_year']} kWh")
-        print(f"  Last year:      {linky_payload['current_year_last_year']} kWh")
-        print(f"  Year evolution: {linky_payload['yearly_evolution']}%")
-        print(f"  Last month:     {linky_payload['last_month']} kWh")
-        print(f"  Last month LY:  {linky_payload['last_month_last_year']} kWh")
-        print(f"  Month evolution: {linky_payload['monthly_evolution']}%")
-        print(f"  Current month:  {linky_payload['current_month']} kWh")
-        print(f"  Current month LY: {linky_payload['current_month_last_year']} kWh")
-        print(f"  Current month evo: {linky_payload['current_month_evolution']}%")
-        print(f"  Yesterday:      {linky_payload['yesterday']} kWh")
-        print(f"  Day before:     {linky_payload['day_2']} kWh")
-        print(f"  Daily evolution: {linky_payload['yesterday_evolution']}%")
-        print(f"  Coûts journaliers: {linky_payload['dailyweek_cost']}")
-        print(f"  Coûts HP:       {linky_payload['dailyweek_costHP']}")
-        print(f"  Coûts HC:       {linky_payload['dailyweek_costHC']}")
-        print(f"  Last update:    {linky_payload['lastUpdate']}")
-
-        # Publication
-        result = client.publish(LINKY_STATE_TOPIC, json.dumps(linky_payload), qos=1, retain=MQTT_RETAIN)
+
+
+def compute_linky_cycle(executor, live=None, meter=None):
+    """
+    Un cycle de calcul complet (tous les étages) pour `meter` (le premier compteur par défaut).
+    Les étapes indépendantes tournent en parallèle sur `executor`, seul le calcul des coûts
+    attend ses entrées (HP/HC, couleurs et tarifs).
+    live: état du flux TIC (mode flux), recalé sur ce cycle puis appliqué au jour en cours.
+    Retourne le payload Linky.
+    """
+    return RefreshScheduler(meter or get_meters()[0]).run(executor, live)
+
+
+class MeterRuntime:
+    """Un compteur servi: planification de ses étages, flux TIC, publication et dernier payload"""
+
+    def __init__(self, meter, client, stagger=0.0):
+        self.meter = meter
+        self.scheduler = RefreshScheduler(meter, stagger)
+        self.live = LiveDayState(meter) if STREAM_MODE else None
+        self.publisher = LinkyPublisher(client, meter)
+        self.payload = None
+        self.last_live_publish = 0.0
+        self.live_day_requested = None
+        # Jours clos dont les agrégats sont déjà dans la base (ROLLUP_WRITEBACK), relus du stockage local
+        # à la première écriture; la clé suit la base cible et le préfixe des métriques écrites
+        self.rollups_written = None
+        self.rollup_key = meter.store_key(f"{ROLLUP_METRIC_PREFIX}[{meter.name}]")
+        self.snapshot_failed = False
+        self.cycles = 0
+
+    def refresh(self, executor):
+        """Recalcule les étages échus puis publie; un cycle sur PROFILE_EVERY est profilé (le premier compris)"""
+        self.cycles += 1
+        if PROFILE_EVERY and (self.cycles - 1) % PROFILE_EVERY == 0:
+            CycleProfile(self.meter, self.cycles).run(self._refresh, executor)
+        else:
+            self._refresh(executor)
+
+    def _refresh(self, executor):
+        """Un échec n'affecte pas les autres compteurs"""
         try:
-            result.wait_for_publish()
-        except Exception:
-            # selon implementation paho, wait_for_publish peut échouer sur certains clients; on ignore
-            pass
-        print(f"📡 JSON complet publié sur {LINKY_STATE_TOPIC}")
+            now_dt = datetime.now(pytz.timezone("Europe/Paris"))
+            payload = self.scheduler.run(executor, self.live, now_dt.timestamp())
+            now_iso = now_dt.isoformat()
+            payload["lastUpdate"] = now_iso
+            payload["timeLastCall"] = now_iso
+            self.payload = payload
+            log_linky_payload(self.meter, payload)
+
+            # Publication
+            published = timed_stage("publish", self.publisher.publish, payload)
+            if published:
+                logger.log(CYCLE_LOG_LEVEL, "📡 JSON complet publié sur %s", self.meter.state_topic)
+                if PAYLOAD_SNAPSHOT:
+                    self.save_snapshot(payload)
+            else:
+                logger.log(CYCLE_LOG_LEVEL, "⏸️ Payload inchangé, publication ignorée (%d depuis le démarrage)",
+                           self.publisher.skipped)
+            if LOG_CYCLE_JSON:
+                log_cycle_summary(self.meter, self.scheduler.last_cycle, payload, published)
+            if ROLLUP_WRITEBACK and "today" in self.scheduler.last_cycle["stages"]:
+                timed_stage("write_rollups", self.write_rollups, payload)
+            metrics.set("linky_last_successful_cycle_timestamp_seconds", time.time(), {"meter": self.meter.name})
+        except Exception as e:
+            logger.error("❌ [%s] Échec du cycle: %s", self.meter.name, e)
+            metrics.inc("linky_cycle_failures_total", {"meter": self.meter.name})
+            self.scheduler.postpone(STAGE_RETRY_DELAY)
+
+    def save_snapshot(self, payload):
+        try:
+            save_payload_snapshot(self.meter, payload)
+            self.snapshot_failed = False
+        except OSError as e:
+            # Signalé une fois: le calcul et la publication n'en dépendent pas
+            if not self.snapshot_failed:
+                logger.warning("⚠️ [%s] Instantané du payload non enregistré: %s", self.meter.name, e)
+            self.snapshot_failed = True
+
+    def publish_snapshot(self):
+        """Republie le dernier payload enregistré, sans attendre le premier recalcul; retourne True s'il existait"""
+        payload = load_payload_snapshot(self.meter)
+        if payload is None:
+            return False
+        self.publisher.publish(payload)
+        # Le premier recalcul est publié même s'il est identique, avec son propre lastUpdate
+        self.publisher.last_digest = None
+        logger.info("📦 [%s] Dernier payload republié (calculé le %s)", self.meter.name, payload.get("lastUpdate"))
+        return True
+
+    def write_rollups(self, payload):
+        """
+        Écrit dans la base, en une requête, les agrégats des jours clos pas encore écrits.
+        Les jours écrits sont conservés dans le stockage local: pas de réécriture après un redémarrage.
+        """
+        store = get_daily_store()
+        if self.rollups_written is None:
+            days = [datetime.strptime(day, "%Y-%m-%d").date() for day in payload["dailyweek"]]
+            self.rollups_written = store.get_rollup_days(self.rollup_key, days) if store else set()
+        days, points = rollup_points(self.meter, payload, self.scheduler.results["daily_diffs"],
+                                     self.rollups_written)
+        if not points:
+            return
+        try:
+            run_for_meter(self.meter, db_write_points, points)
+        except Exception as e:
+            # Jours non marqués: nouvelle tentative au prochain rafraîchissement du jour en cours
+            logger.error("❌ [%s] Écriture des agrégats journaliers impossible: %s", self.meter.name, e)
+            return
+        self.rollups_written.update(days)
+        if store:
+            store.put_rollup_days(self.rollup_key, days)
+        logger.info("🗄️ [%s] Agrégats de %d jour(s) clos écrits (%d points)", self.meter.name, len(days), len(points))
+
+    def stream_ready_at(self):
+        """Instant où le jour en cours peut être republié depuis le flux TIC (None si rien de nouveau)"""
+        if self.live is None or self.payload is None or not self.live.updated.is_set():
+            return None
+        return self.last_live_publish + STREAM_PUBLISH_INTERVAL
+
+    def stream_update(self):
+        """
+        Applique les dernières trames TIC au payload et le republie s'il a changé.
+        Une trame d'un nouveau jour rend le compteur échu: la boucle principale cesse d'attendre
+        et recalcule tout (demandé une fois par jour: après un cycle en échec, les nouveaux essais
+        suivent STAGE_RETRY_DELAY).
+        """
+        self.live.updated.clear()
+        payload = self.payload
+        if not self.live.apply(payload, self.scheduler.results["tariffs"]):
+            if self.live_day_requested != self.live.day:
+                self.live_day_requested = self.live.day
+                logger.info("🔄 [%s] Changement de jour dans le flux TIC, recalcul complet", self.meter.name)
+                self.scheduler.refresh_now()
+                live_wake.set()
+            return
+        payload["lastUpdate"] = datetime.now(pytz.timezone("Europe/Paris")).isoformat()
+        self.last_live_publish = time.time()
+        if self.publisher.publish(payload):
+            logger.debug("📡 [%s] Flux TIC: jour mis à jour (HP=%s kWh, HC=%s kWh, MP=%s kVA, %s)", self.meter.name,
+                         payload['dailyweek_HP'][0], payload['dailyweek_HC'][0], payload['dailyweek_MP'][0],
+                         payload['dailyweek_Tempo'][0])
+
+
+def wait_for_deadline(runtimes, deadline):
+    """
+    Attend `deadline`. En mode flux, republie entre-temps le jour en cours des compteurs
+    ayant reçu des trames TIC (au plus une fois par STREAM_PUBLISH_INTERVAL et par compteur),
+    et s'arrête plus tôt si une trame a avancé l'échéance d'un compteur (changement de jour).
+    """
+    if not STREAM_MODE:
+        time.sleep(max(0.0, deadline - time.time()))
+        return
+    while True:
+        live_wake.clear()
+        now = time.time()
+        deadline = min([deadline] + [runtime.scheduler.next_deadline() for runtime in runtimes])
+        if now >= deadline:
+            return
+        wake_at = deadline
+        for runtime in runtimes:
+            ready_at = runtime.stream_ready_at()
+            if ready_at is None:
+                continue
+            if ready_at <= now:
+                runtime.stream_update()
+            else:
+                wake_at = min(wake_at, ready_at)
+        live_wake.wait(max(0.0, wake_at - time.time()))
+
+
+def log_linky_payload(meter, linky_payload):
+    """Détail des variables calculées (DEBUG), en un seul enregistrement"""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    p = linky_payload
+    lines = [
+        f"📑 Variables calculées pour ce cycle ({meter.name}):",
+        f"  Base de données: {meter.db_type.upper()}",
+        f"  Dates:          {p['dailyweek']}",
+        f"  HP (7j):        {p['dailyweek_HP']}",
+        f"  HC (7j):        {p['dailyweek_HC']}",
+        f"  Daily (HP+HC):  {p['daily']}",
+        f"  MP (7j):        {p['dailyweek_MP']}",
+        f"  MP times:       {p['dailyweek_MP_time']}",
+        f"  Tempo couleurs: {p['dailyweek_Tempo']}",
+        f"  Yesterday HP:   {p['yesterday_HP']}",
+        f"  Yesterday HC:   {p['yesterday_HC']}",
+        f"  Current week:   {p['current_week']} kWh",
+        f"  Last week:      {p['last_week']} kWh",
+        f"  Week evolution: {p['current_week_evolution']}%",
+        f"  Current year:   {p['current_year']} kWh",
+        f"  Last year:      {p['current_year_last_year']} kWh",
+        f"  Year evolution: {p['yearly_evolution']}%",
+        f"  Last month:     {p['last_month']} kWh",
+        f"  Last month LY:  {p['last_month_last_year']} kWh",
+        f"  Month evolution: {p['monthly_evolution']}%",
+        f"  Current month:  {p['current_month']} kWh",
+        f"  Current month LY: {p['current_month_last_year']} kWh",
+        f"  Current month evo: {p['current_month_evolution']}%",
+        f"  Yesterday:      {p['yesterday']} kWh",
+        f"  Day before:     {p['day_2']} kWh",
+        f"  Daily evolution: {p['yesterday_evolution']}%",
+        f"  Coûts journaliers: {p['dailyweek_cost']}",
+        f"  Coûts HP:       {p['dailyweek_costHP']}",
+        f"  Coûts HC:       {p['dailyweek_costHC']}",
+        f"  Last update:    {p['lastUpdate']}",
+    ]
+    logger.debug("\n".join(lines))
+
+
+def log_cycle_summary(meter, cycle, payload, published):
+    """Résumé du cycle en une ligne JSON (LOG_CYCLE_JSON), à la place des lignes de suivi"""
+    stats = http_client_stats()
+    summary = {
+        "event": "cycle",
+        "meter": meter.name,
+        **cycle,
+        "published": published,
+        "today_hp": payload["dailyweek_HP"][0],
+        "today_hc": payload["dailyweek_HC"][0],
+        "today_mp": payload["dailyweek_MP"][0],
+        "tempo": payload["dailyweek_Tempo"][0],
+        "current_month": payload["current_month"],
+        "current_year": payload["current_year"],
+        "http_requests_total": stats["requests"],
+        "http_retries_total": stats["retries"],
+    }
+    cache = get_query_cache()
+    if cache is not None:
+        cache_stats = cache.stats()
+        summary["query_cache_hits_total"] = cache_stats["hits"]
+        summary["query_cache_misses_total"] = cache_stats["misses"]
+    logger.info(json.dumps(summary, ensure_ascii=False, separators=(",", ":")))
+
+
+# =======================
+# Profilage d'un cycle sur N
+# =======================
+# tracemalloc est global au process: un seul cycle tracé à la fois
+_tracemalloc_lock = threading.Lock()
+
+
+class CycleProfile:
+    """
+    Profil d'un cycle échantillonné (PROFILE_EVERY): durée, requêtes, points et octets par étape
+    (timed_stage), et en option cProfile et tracemalloc sur tout le cycle.
+    cProfile ne voit que le thread où il est activé: chaque thread du cycle (étapes, parallel_map)
+    a son propre profileur (profiled_call), fusionnés à la fin.
+    """
+
+    def __init__(self, meter, cycle):
+        self.meter = meter
+        self.cycle = cycle
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.stats = None
+        self.local = threading.local()
+
+    def call(self, func, *args):
+        if not PROFILE_CPROFILE or getattr(self.local, "active", False):
+            return func(*args)
+        profiler = cProfile.Profile()
+        self.local.active = True
+        try:
+            return profiler.runcall(func, *args)
+        finally:
+            self.local.active = False
+            with self.lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profiler)
+                else:
+                    self.stats.add(profiler)
+
+    def add_stage(self, stage, duration, queries):
+        with self.lock:
+            self.stages[stage] = {
+                "duration_s": round(duration, 4),
+                "queries": len(queries),
+                "failed_queries": sum(1 for q in queries if not q[3]),
+                "query_time_s": round(sum(q[0] for q in queries), 4),
+                "points": sum(q[1] for q in queries),
+                "bytes": sum(q[2] for q in queries),
+            }
+
+    def run(self, func, *args):
+        """Exécute le cycle func(*args) profilé, puis journalise le profil et écrit les rapports"""
+        tracing = PROFILE_TRACEMALLOC and _tracemalloc_lock.acquire(blocking=False)
+        if tracing:
+            tracemalloc.start()
+        ctx = contextvars.copy_context()
+        ctx.run(_cycle_profile.set, self)
+        t0 = time.time()
+        try:
+            return ctx.run(self.call, func, *args)
+        finally:
+            elapsed = time.time() - t0
+            snapshot = peak = None
+            if tracing:
+                snapshot = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                _tracemalloc_lock.release()
+            self.report(elapsed, snapshot, peak)
+
+    def report(self, elapsed, snapshot=None, peak=None):
+        stages = sorted(self.stages.items(), key=lambda item: -item[1]["duration_s"])
+        if LOG_CYCLE_JSON:
+            logger.info(json.dumps({"event": "profile", "meter": self.meter.name, "cycle": self.cycle,
+                                    "duration_s": round(elapsed, 3), "stages": dict(stages)},
+                                   ensure_ascii=False, separators=(",", ":")))
+        else:
+            lines = [f"🔬 [{self.meter.name}] Profil du cycle #{self.cycle}: {elapsed:.3f}s, "
+                     f"{sum(s['queries'] for _, s in stages)} requêtes"]
+            lines += [f"   {stage:40s} {s['duration_s']:8.3f}s {s['queries']:4d} req {s['query_time_s']:8.3f}s en base "
+                      f"{s['points']:9d} pts {s['bytes'] / 1024:8.0f} Ko" for stage, s in stages]
+            logger.info("\n".join(lines))
+        if self.stats is None and snapshot is None:
+            return
+        name = re.sub(r"[^\w.-]", "_", self.meter.name)
+        base = os.path.join(PROFILE_DIR, f"{name}_{time.strftime('%Y%m%d-%H%M%S')}_cycle{self.cycle}")
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            if self.stats is not None:
+                self.stats.dump_stats(f"{base}.pstats")
+            if snapshot is not None:
+                with open(f"{base}_tracemalloc.txt", "w", encoding="utf-8") as f:
+                    f.write(f"Pic mémoire tracé pendant le cycle: {peak / 1024 / 1024:.1f} Mo\n\n")
+                    for stat in snapshot.statistics("lineno")[:PROFILE_TOP]:
+                        f.write(f"{stat}\n")
+            logger.info("🔬 [%s] Rapports de profilage écrits: %s.*", self.meter.name, base)
+        except OSError as e:
+            logger.warning("⚠️ [%s] Rapports de profilage non écrits (%s): %s", self.meter.name, PROFILE_DIR, e)
+
+
+# =======================
+# SCRIPT PRINCIPAL
+# =======================
+def main():
+    setup_logging()
+    logger.info("--- Début de l'exécution du script Linky multi-DB ---")
+    logger.info("Version Python: %s", sys.version)
+    served = get_meters()
+    if METERS_CONFIG:
+        logger.info("📋 %d compteurs chargés depuis %s", len(served), METERS_CONFIG)
+    for meter in served:
+        if meter.db_type == "influxdb":
+            try:
+                get_influx_client()
+            except Exception as e:
+                logger.error("❌ [%s] InfluxDB indisponible: %s", meter.name, e)
+                sys.exit(1)
+            logger.info("📊 [%s] InfluxDB - URL: %s, ORG: %s, BUCKET: %s", meter.name, INFLUXDB_URL, INFLUXDB_ORG, meter.influx_bucket)
+        else:
+            logger.info("📊 [%s] VictoriaMetrics - Host: %s:%s%s", meter.name, meter.vm_host, meter.vm_port,
+                        f", filtre: {{{meter.label_filter}}}" if meter.label_filter else "")
+
+    # Un seul client MQTT, un seul pool HTTP et une seule limite de requêtes pour tous les compteurs
+    client = mqtt.Client(protocol=mqtt.MQTTv5)
+    evt = threading.Event()
+    # Échéances décalées: les compteurs se répartissent sur l'intervalle du jour en cours
+    runtimes = [MeterRuntime(meter, client, stagger=i * TODAY_REFRESH_INTERVAL / len(served))
+                for i, meter in enumerate(served)]
+
+    def on_connect(c, u, flags, rc, props=None):
+        if rc == 0:
+            logger.info("✅ MQTT connecté")
+            if STREAM_MODE:
+                # (ré)abonnement à chaque connexion
+                for runtime in runtimes:
+                    for topic in runtime.meter.teleinfo_topics:
+                        c.subscribe(topic, qos=0)
+                logger.info("📥 Mode flux: abonné aux trames TIC de %d compteur(s)", len(runtimes))
+            evt.set()
+        else:
+            logger.error("❌ MQTT échec (rc=%s)", rc)
+
+    client.on_connect = on_connect
+    if STREAM_MODE:
+        # Chaque compteur reçoit les trames de ses propres topics
+        for runtime in runtimes:
+            for topic in runtime.meter.teleinfo_topics:
+                client.message_callback_add(topic, runtime.live.on_message)
+    if LOGIN and PASSWORD:
+        client.username_pw_set(LOGIN, PASSWORD)
+
+    client.loop_start()
+    try:
+        client.connect(MQTT_HOST, MQTT_PORT, 60)
+    except Exception as e:
+        logger.error("❌ Connexion MQTT impossible: %s", e)
+        sys.exit(1)
+
+    if not evt.wait(timeout=10):
+        logger.error("⛔ Timeout MQTT")
+        sys.exit(1)
 
-        # Pause
-        time.sleep(PUBLISH_INTERVAL)
+    # Discovery Linky
+    for runtime in runtimes:
+        runtime.publisher.publish_discovery()
+    # Dernières valeurs connues republiées tout de suite: le premier recalcul peut prendre du temps
+    if PAYLOAD_SNAPSHOT:
+        for runtime in runtimes:
+            runtime.publish_snapshot()
+
+    logger.info("--- Boucle MQTT démarrée ---")
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+
+    # Pool des étapes du cycle, réutilisé d'un cycle à l'autre et partagé par les compteurs
+    executor = ThreadPoolExecutor(max_workers=CYCLE_WORKERS, thread_name_prefix="cycle")
+    # Compteurs échus recalculés en parallèle (pool distinct: un compteur attend ses étapes sans bloquer le pool des étapes)
+    meter_executor = ThreadPoolExecutor(max_workers=METER_WORKERS, thread_name_prefix="meter")
+
+    while True:
+        now = time.time()
+        due = [runtime for runtime in runtimes if runtime.scheduler.next_deadline() <= now]
+        list(meter_executor.map(lambda runtime: runtime.refresh(executor), due))
+
+        # Attente de la prochaine échéance (en mode flux: republication du jour en cours à chaque trame TIC)
+        deadline = min(runtime.scheduler.next_deadline() for runtime in runtimes)
+        logger.log(CYCLE_LOG_LEVEL, "⏳ Prochain rafraîchissement à %s",
+                   datetime.fromtimestamp(deadline, tz=pytz.timezone('Europe/Paris')).strftime('%H:%M:%S'))
+        wait_for_deadline(runtimes, deadline)
+
+    # Nettoyage InfluxDB
+    if influx_client:
+        influx_client.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Banc de mesure du calcul Linky sur un VictoriaMetrics simulé (bench/fake_vm.py).
+
+Génère un historique synthétique au pas d'une minute (index Tempo HP/HC par couleur et
+puissance), le sert en local, puis exécute un cycle complet (le corps de la boucle de main(),
+sans publication MQTT), un rafraîchissement du seul jour en cours et chaque fonction fetch_*.
+Pour chaque cas: durée, nombre de requêtes, points et octets transférés, pic de RSS.
+
+    python bench/bench.py [--years 2] [--latency 0.005] [--cold] [--output resultats.json]
+    python bench/bench.py --compare avant.json apres.json
+
+Sans --output, le résultat est écrit dans bench/results/<commit>.json.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_vm import FakeVictoriaMetrics, SyntheticLinky  # noqa: E402
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def reset_peak_rss():
+    """Remet à zéro le pic de RSS du processus (Linux), pour une mesure par cas"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss: pic depuis le démarrage du processus (Ko sous Linux, octets sous macOS)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def import_app(port, state_dir, cold):
+    """Importe app/main.py configuré sur le serveur simulé (la configuration est lue à l'import)"""
+    os.environ.update({
+        "DB_TYPE": "victoriametrics",
+        "VM_HOST": "127.0.0.1",
+        "VM_PORT": str(port),
+        "STATE_DIR": state_dir,
+        "METERS_CONFIG": "",
+        "METRICS_PORT": "0",
+        "STREAM_MODE": "false",
+    })
+    if cold:
+        os.environ.update({"DAILY_STORE": "false", "TARIFF_CACHE_TTL": "0", "QUERY_CACHE": "false"})
+    sys.path.insert(0, os.path.join(REPO_DIR, "app"))
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main
+    return main
+
+
+def bench_cases(app, executor):
+    meter = app.get_meters()[0]
+    tempo = meter.tempo_metrics()
+    # Planificateur amorcé par un premier cycle complet, hors mesure
+    scheduler = app.RefreshScheduler(meter)
+    with contextlib.redirect_stdout(io.StringIO()):
+        scheduler.run(executor)
+
+    def cycle_today():
+        # Échéance suivante du seul étage "today", comme dans la boucle principale
+        return scheduler.run(executor, now_ts=scheduler.next_due["today"])
+
+    def in_meter(func, *args):
+        return lambda: app.run_for_meter(meter, func, *args)
+
+    return [
+        ("cycle", lambda: app.compute_linky_cycle(executor, meter=meter)),
+        ("cycle_today", cycle_today),
+        ("fetch_yearly_consumption_data", in_meter(app.fetch_yearly_consumption_data, tempo)),
+        ("fetch_monthly_consumption_data", in_meter(app.fetch_monthly_consumption_data, tempo)),
+        ("fetch_current_month_consumption_data", in_meter(app.fetch_current_month_consumption_data, tempo)),
+        ("fetch_daily_consumption_data", in_meter(app.fetch_daily_consumption_data, tempo)),
+        ("compute_daily_diffs_multi", in_meter(app.compute_daily_diffs_multi, tempo, 14)),
+        ("fetch_daily_max_power", in_meter(app.fetch_daily_max_power, meter.metrics["pcons"], 7)),
+        ("fetch_daily_tempo_colors", in_meter(app.fetch_daily_tempo_colors, 7)),
+        ("fetch_tempo_tariffs", in_meter(app.fetch_tempo_tariffs)),
+    ]
+
+
+def run_case(func, server, repeat):
+    walls = []
+    for _ in range(repeat):
+        server.reset_stats()
+        reset_peak_rss()
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        walls.append(time.perf_counter() - t0)
+    stats = server.snapshot()
+    return {
+        "wall_s": round(statistics.median(walls), 4),
+        "wall_min_s": round(min(walls), 4),
+        "queries": stats["range"] + stats["instant"],
+        "range_queries": stats["range"],
+        "instant_queries": stats["instant"],
+        "points": stats["points"],
+        "bytes": stats["bytes"],
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def run(args):
+    t0 = time.perf_counter()
+    history = SyntheticLinky(years=args.years, seed=args.seed)
+    generation_s = time.perf_counter() - t0
+    print(f"📈 Historique synthétique: {history.points} points ({args.years} ans) en {generation_s:.1f}s")
+
+    server = FakeVictoriaMetrics(history, latency=args.latency).start()
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="linky-bench-") as state_dir:
+        app = import_app(server.port, state_dir, args.cold)
+        with ThreadPoolExecutor(max_workers=app.CYCLE_WORKERS) as executor:
+            for name, func in bench_cases(app, executor):
+                if args.cases and name not in args.cases:
+                    continue
+                results[name] = run_case(func, server, args.repeat)
+                r = results[name]
+                print(f"  {name:40s} {r['wall_s']:8.3f}s {r['queries']:5d} req {r['points']:9d} pts "
+                      f"{r['bytes'] / 1024:9.0f} Ko {r['peak_rss_mb']:7.1f} Mo")
+    server.stop()
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "years": args.years,
+            "seed": args.seed,
+            "latency_s": args.latency,
+            "repeat": args.repeat,
+            "cold": args.cold,
+            "history_points": history.points,
+            "generation_s": round(generation_s, 2),
+        },
+        "cases": results,
+    }
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{'cas':40s} {'durée (s)':>22s} {'requêtes':>14s} {'points':>22s}")
+    print(f"{'':40s} {old['meta']['commit']:>10s} → {new['meta']['commit']:<10s}")
+    for name, after in new["cases"].items():
+        before = old["cases"].get(name)
+        if before is None:
+            print(f"{name:40s} (nouveau)")
+            continue
+        change = (after["wall_s"] / before["wall_s"] - 1) * 100 if before["wall_s"] else 0.0
+        print(f"{name:40s} {before['wall_s']:7.3f} → {after['wall_s']:7.3f} ({change:+4.0f}%) "
+              f"{before['queries']:5d} → {after['queries']:<5d} "
+              f"{before['points']:9d} → {after['points']:<9d}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Banc de mesure du calcul Linky (VictoriaMetrics simulé)")
+    parser.add_argument("--years", type=float, default=2.0, help="profondeur de l'historique généré")
+    parser.add_argument("--seed", type=int, default=42, help="graine du générateur")
+    parser.add_argument("--latency", type=float, default=0.0, help="latence ajoutée à chaque requête (s)")
+    parser.add_argument("--repeat", type=int, default=1, help="répétitions par cas (durée médiane)")
+    parser.add_argument("--cold", action="store_true",
+                        help="sans stockage local des jours clos ni cache des tarifs et des requêtes")
+    parser.add_argument("--cases", nargs="*", help="restreindre à ces cas")
+    parser.add_argument("--output", help="fichier JSON de résultat")
+    parser.add_argument("--compare", nargs=2, metavar=("AVANT", "APRES"), help="comparer deux résultats")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+    report = run(args)
+    output = args.output or os.path.join(BENCH_DIR, "results", f"{report['meta']['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"💾 Résultats: {output}")
@@ -0,0 +1,246 @@
+"""
+Serveur VictoriaMetrics de test, en processus, sur un historique Linky synthétique.
+
+Implémente le sous-ensemble de /api/v1/query et /api/v1/query_range utilisé par app/main.py:
+  - nom de métrique seul ou sélecteur {__name__=~"a|b"} (les autres labels sont ignorés)
+  - first_over_time / last_over_time / max_over_time / tmax_over_time (...[Ns]) keep_metric_names
+  - lookback de 5 minutes pour les valeurs instantanées, comme VictoriaMetrics
+"""
+import json
+import math
+import random
+import re
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytz
+
+TZ = pytz.timezone("Europe/Paris")
+STEP = 60
+LOOKBACK = 300
+
+INDEX_METRICS = {
+    ("HP", "BLUE"): "sensor.linky_tempo_index_bbrhpjb_value",
+    ("HC", "BLUE"): "sensor.linky_tempo_index_bbrhcjb_value",
+    ("HP", "WHITE"): "sensor.linky_tempo_index_bbrhpjw_value",
+    ("HC", "WHITE"): "sensor.linky_tempo_index_bbrhcjw_value",
+    ("HP", "RED"): "sensor.linky_tempo_index_bbrhpjr_value",
+    ("HC", "RED"): "sensor.linky_tempo_index_bbrhcjr_value",
+}
+POWER_METRIC = "sensor.linky_puissance_consommee_value"
+TARIFF_METRICS = {
+    "sensor.tarif_bleu_tempo_heures_pleines_ttc_value": 0.1609,
+    "sensor.tarif_bleu_tempo_heures_creuses_ttc_value": 0.1296,
+    "sensor.tarif_blanc_tempo_heures_pleines_ttc_value": 0.1894,
+    "sensor.tarif_blanc_tempo_heures_creuses_ttc_value": 0.1486,
+    "sensor.tarif_rouge_tempo_heures_pleines_ttc_value": 0.7562,
+    "sensor.tarif_rouge_tempo_heures_creuses_ttc_value": 0.1568,
+}
+
+
+def tempo_calendar(first_day, last_day, rng):
+    """
+    Couleur de chaque jour Tempo: par saison (1er septembre → 31 août), 22 jours rouges
+    en semaine de décembre à février et 43 jours blancs hors dimanche de novembre à mars.
+    """
+    colors = {}
+    day = first_day
+    while day <= last_day:
+        colors[day] = "BLUE"
+        day += timedelta(days=1)
+    for season in range(first_day.year - 1, last_day.year + 1):
+        winter = [datetime(season, 11, 1).date() + timedelta(days=i) for i in range(151)]
+        red_pool = [d for d in winter if d.month in (12, 1, 2) and d.weekday() < 5]
+        red = set(rng.sample(red_pool, 22))
+        white_pool = [d for d in winter if d not in red and d.weekday() != 6]
+        white = set(rng.sample(white_pool, 43))
+        for d in red:
+            if d in colors:
+                colors[d] = "RED"
+        for d in white:
+            if d in colors:
+                colors[d] = "WHITE"
+    return colors
+
+
+class SyntheticLinky:
+    """
+    Historique au pas d'une minute: 6 index Tempo cumulatifs (kWh) et puissance apparente (VA).
+    Profil: talon, chauffage hivernal, pointes du matin et du soir (réduites les jours rouges),
+    appareils ponctuels; heures creuses de 22h à 6h, jour Tempo de 6h à 6h.
+    """
+
+    def __init__(self, years=2.0, end_ts=None, seed=42):
+        rng = random.Random(seed)
+        end = int(end_ts or time.time())
+        self.end = end - end % 3600 + 3600
+        self.start = self.end - int(years * 365 * 86400)
+        self.start -= self.start % 3600
+        self.series = {name: array("d") for name in list(INDEX_METRICS.values()) + [POWER_METRIC]}
+
+        first = datetime.fromtimestamp(self.start, TZ).date() - timedelta(days=1)
+        last = datetime.fromtimestamp(self.end, TZ).date()
+        colors = tempo_calendar(first, last, rng)
+
+        index = {key: 10000.0 + 1000.0 * i for i, key in enumerate(INDEX_METRICS)}
+        power = self.series[POWER_METRIC]
+        for hour_ts in range(self.start, self.end, 3600):
+            dt = datetime.fromtimestamp(hour_ts, TZ)
+            hour = dt.hour
+            color = colors[(dt - timedelta(hours=6)).date()]
+            period = "HC" if hour >= 22 or hour < 6 else "HP"
+            winter = max(0.0, math.cos(2 * math.pi * (dt.timetuple().tm_yday - 15) / 365))
+            watts = 250.0 + 2200.0 * winter * (1.2 if hour < 8 else 0.8)
+            if 7 <= hour < 9:
+                watts += 1200.0
+            elif 18 <= hour < 22:
+                watts += 1800.0
+            if color == "RED" and period == "HP":
+                watts *= 0.6
+            key = (period, color)
+            for _ in range(60):
+                w = max(80.0, watts + rng.uniform(-150.0, 150.0))
+                if rng.random() < 0.01:
+                    w += 3000.0
+                index[key] += w / 60000.0
+                for k, name in INDEX_METRICS.items():
+                    self.series[name].append(round(index[k], 3))
+                power.append(round(w / 0.9))
+
+    @property
+    def points(self):
+        return sum(len(values) for values in self.series.values())
+
+    def _bounds(self, t, window):
+        """Indices [lo, hi) des échantillons dans ]t - window, t]"""
+        hi = min(len(self.series[POWER_METRIC]), (int(t) - self.start) // STEP + 1)
+        lo = max(0, (int(t) - int(window) - self.start) // STEP + 1)
+        return lo, hi
+
+    def value_at(self, name, t):
+        if name in TARIFF_METRICS:
+            return TARIFF_METRICS[name]
+        lo, hi = self._bounds(t, LOOKBACK)
+        return self.series[name][hi - 1] if hi > lo else None
+
+    def rollup(self, func, name, t, window):
+        lo, hi = self._bounds(t, window)
+        if hi <= lo:
+            return None
+        values = self.series[name]
+        if func == "first_over_time":
+            return values[lo]
+        if func == "last_over_time":
+            return values[hi - 1]
+        chunk = values[lo:hi]
+        best = max(range(len(chunk)), key=chunk.__getitem__)
+        return chunk[best] if func == "max_over_time" else self.start + (lo + best) * STEP
+
+    def names(self, selector):
+        match = re.fullmatch(r'\{__name__=~"(.*?)"(,.*)?\}', selector)
+        if match:
+            pattern = re.compile(match.group(1).replace("\\\\", "\\"))
+            return [n for n in list(self.series) + list(TARIFF_METRICS) if pattern.fullmatch(n)]
+        return [selector.split("{", 1)[0]]
+
+    def evaluate(self, query, t):
+        """{métrique: valeur} de la requête à l'instant t"""
+        results = {}
+        match = re.fullmatch(r"(\w+_over_time)\((.*)\[(\d+)s\]\)( keep_metric_names)?", query)
+        if match:
+            func, selector, window = match.group(1), match.group(2), int(match.group(3))
+            for name in self.names(selector):
+                if name in self.series:
+                    value = self.rollup(func, name, t, window)
+                    if value is not None:
+                        results[name] = value
+            return results
+        for name in self.names(query):
+            if name in self.series or name in TARIFF_METRICS:
+                value = self.value_at(name, t)
+                if value is not None:
+                    results[name] = value
+        return results
+
+
+class FakeVictoriaMetrics:
+    """Serveur HTTP (thread de fond) répondant sur l'historique; compte requêtes, points et octets"""
+
+    def __init__(self, history, port=0, latency=0.0):
+        self.history = history
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.reset_stats()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake.handle(self)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {"range": 0, "instant": 0, "points": 0, "bytes": 0}
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-vm", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, request):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(request.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        query = params.get("query", "")
+        if url.path == "/api/v1/query_range":
+            kind = "range"
+            start, end, step = (int(float(params[k])) for k in ("start", "end", "step"))
+            series = {}
+            for t in range(start, end + 1, max(1, step)):
+                for name, value in self.history.evaluate(query, t).items():
+                    series.setdefault(name, []).append([t, str(value)])
+            result = [{"metric": {"__name__": name}, "values": values} for name, values in series.items()]
+            points = sum(len(values) for values in series.values())
+            result_type = "matrix"
+        elif url.path == "/api/v1/query":
+            kind = "instant"
+            t = int(float(params.get("time", time.time())))
+            result = [{"metric": {"__name__": name}, "value": [t, str(value)]}
+                      for name, value in self.history.evaluate(query, t).items()]
+            points = len(result)
+            result_type = "vector"
+        else:
+            request.send_error(404)
+            return
+
+        body = json.dumps({"status": "success", "data": {"resultType": result_type, "result": result}}).encode()
+        with self.lock:
+            self.stats[kind] += 1
+            self.stats["points"] += points
+            self.stats["bytes"] += len(body)
+        request.send_response(200)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
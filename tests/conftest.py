@@ -0,0 +1,93 @@
+"""
+Tests de app/main.py sur le VictoriaMetrics simulé du banc (bench/fake_vm.py).
+
+L'historique synthétique se termine le 5 novembre 2024 et couvre les deux changements d'heure
+de 2024 (31 mars et 27 octobre). La configuration de l'application est lue à l'import:
+le module n'est importé qu'une fois, sur le serveur simulé, sans cache des requêtes ni
+stockage local (les tests qui en ont besoin créent leurs propres instances).
+
+    python -m pytest tests
+"""
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "bench"))
+sys.path.insert(0, os.path.join(REPO_DIR, "app"))
+
+from fake_vm import TZ, FakeVictoriaMetrics, SyntheticLinky  # noqa: E402
+
+HISTORY_END = TZ.localize(datetime(2024, 11, 5, 12, 0))
+# "Maintenant" des cycles de test, peu avant la fin de l'historique
+NOW = HISTORY_END - timedelta(minutes=23)
+
+
+class FakeMqttClient:
+    """Client MQTT qui enregistre les messages publiés: [(topic, payload, retain)]"""
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.messages.append((topic, payload, retain))
+        return SimpleNamespace(rc=0, wait_for_publish=lambda: None)
+
+
+@pytest.fixture(scope="session")
+def history():
+    return SyntheticLinky(years=0.7, end_ts=HISTORY_END.timestamp())
+
+
+@pytest.fixture(scope="session")
+def vm(history):
+    server = FakeVictoriaMetrics(history).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(scope="session")
+def app(vm, tmp_path_factory):
+    os.environ.update({
+        "DB_TYPE": "victoriametrics",
+        "VM_HOST": "127.0.0.1",
+        "VM_PORT": str(vm.port),
+        "VM_MAX_RETRIES": "0",
+        "STATE_DIR": str(tmp_path_factory.mktemp("state")),
+        "METERS_CONFIG": "",
+        "METRICS_PORT": "0",
+        "STREAM_MODE": "false",
+        "DAILY_STORE": "false",
+        "QUERY_CACHE": "false",
+    })
+    import main
+    return main
+
+
+@pytest.fixture
+def meter(app):
+    return app.get_meters()[0]
+
+
+@pytest.fixture
+def in_meter(app, meter):
+    """in_meter(func, *args): func(*args) avec le compteur de test comme compteur en cours"""
+    return lambda func, *args: app.run_for_meter(meter, func, *args)
+
+
+@pytest.fixture(scope="session")
+def executor(app):
+    with ThreadPoolExecutor(max_workers=app.CYCLE_WORKERS, thread_name_prefix="cycle") as pool:
+        yield pool
+
+
+@pytest.fixture
+def cycle(app, meter, executor):
+    """(planificateur, payload) du compteur de test après un cycle complet à NOW"""
+    scheduler = app.RefreshScheduler(meter)
+    return scheduler, scheduler.run(executor, None, NOW.timestamp())
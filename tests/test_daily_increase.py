@@ -0,0 +1,83 @@
+"""Consommation par jour aux bornes de minuit, changements d'heure compris, sur les deux bases"""
+import re
+from datetime import date, datetime, timedelta
+
+import pytest
+import pytz
+
+from conftest import HISTORY_END
+from fake_vm import INDEX_METRICS, STEP, TZ
+
+METRICS = list(INDEX_METRICS.values())
+NOW = HISTORY_END - timedelta(minutes=23)
+DST_DAYS = (date(2024, 3, 31), date(2024, 10, 27))
+
+
+@pytest.fixture
+def bounds(app):
+    return app.paris_day_bounds(230, NOW)
+
+
+def expected_increase(history, day_bound):
+    """Index au minuit suivant (ou maintenant) moins index à minuit, avec le lookback de VictoriaMetrics"""
+    _, start_ts, end_ts = day_bound
+    return {m: history.value_at(m, end_ts) - history.value_at(m, start_ts) for m in METRICS}
+
+
+def influx_rows(app, history):
+    """
+    Lignes de la requête Flux de influx_query_daily_increase, calculées sur l'historique:
+    first() / last() de chaque fenêtre ]minuit, minuit suivant] dans range(start, stop).
+    """
+    def rows(query, kind="range"):
+        start, stop = (datetime.fromisoformat(v).timestamp()
+                       for v in re.search(r"range\(start: (\S+), stop: (\S+)\)", query).groups())
+        size = len(history.series[METRICS[0]])
+        day = datetime.fromtimestamp(start, TZ).date()
+        while app.paris_midnight(day).timestamp() < stop:
+            lo = app.paris_midnight(day).timestamp()
+            hi = app.paris_midnight(day + timedelta(days=1)).timestamp()
+            # Échantillons de ]lo, hi] compris dans [start, stop[
+            first = max(0, int(max(lo, start - 1) - history.start) // STEP + 1)
+            last = min(size, int(min(hi, stop - 1) - history.start) // STEP + 1) - 1
+            if last >= first:
+                window = datetime.fromtimestamp(lo, pytz.UTC).strftime("%Y-%m-%dT%H:%M:%SZ")
+                for fn, i in (("first", first), ("last", last)):
+                    yield {"_time": window, "_fn": fn, **{m: str(history.series[m][i]) for m in METRICS}}
+            day += timedelta(days=1)
+    return rows
+
+
+def test_day_bounds_follow_dst(bounds):
+    lengths = {day: end_ts - start_ts for day, start_ts, end_ts in bounds}
+    assert lengths[DST_DAYS[0]] == 23 * 3600
+    assert lengths[DST_DAYS[1]] == 25 * 3600
+    assert lengths[date(2024, 6, 1)] == 24 * 3600
+
+
+def test_vm_daily_increase_at_midnights(app, history, bounds, in_meter):
+    results = in_meter(app.db_query_daily_increase, METRICS, bounds)
+    for bound in bounds:
+        expected = expected_increase(history, bound)
+        for metric in METRICS:
+            first, last, diff = results[metric][bound[0]]
+            assert diff == pytest.approx(expected[metric], abs=1e-6), (metric, bound[0])
+            assert last - first == pytest.approx(diff)
+
+
+def test_vm_daily_increase_dst_days(app, history, in_meter):
+    day_bounds = [b for b in app.paris_day_bounds(230, NOW) if b[0] in DST_DAYS]
+    results = in_meter(app.vm_query_daily_increase, "127.0.0.1", app.VM_PORT, METRICS, day_bounds)
+    for bound in day_bounds:
+        total = sum(results[m][bound[0]][2] for m in METRICS)
+        assert total == pytest.approx(sum(expected_increase(history, bound).values()), abs=1e-6)
+
+
+def test_influx_daily_increase_matches_vm(app, history, bounds, in_meter, monkeypatch):
+    vm = in_meter(app.vm_query_daily_increase, "127.0.0.1", app.VM_PORT, METRICS, bounds)
+    monkeypatch.setattr(app, "influx_query_rows", influx_rows(app, history))
+    influx = in_meter(app.influx_query_daily_increase, METRICS, bounds)
+    for metric in METRICS:
+        assert influx[metric].keys() == vm[metric].keys()
+        for day, (first, last, diff) in vm[metric].items():
+            assert influx[metric][day] == pytest.approx((first, last, diff), abs=1e-6), (metric, day)
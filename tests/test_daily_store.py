@@ -0,0 +1,84 @@
+"""Stockage local des jours clos: servis sans interroger la base, jour en cours toujours relu"""
+from datetime import timedelta
+
+import pytest
+
+from conftest import NOW
+from fake_vm import INDEX_METRICS
+
+METRICS = list(INDEX_METRICS.values())
+
+
+@pytest.fixture
+def store(app, tmp_path, monkeypatch):
+    store = app.DailySummaryStore(str(tmp_path / "linky_daily.db"))
+    monkeypatch.setattr(app, "get_daily_store", lambda: store)
+    return store
+
+
+@pytest.fixture
+def queried(app, monkeypatch):
+    """Jours demandés à la base, par lot: consommations (index) et puissance max (power)"""
+    asked = {"index": [], "power": []}
+
+    def recording(kind, func):
+        def query(metrics, bounds, *args, **kwargs):
+            asked[kind].append([b[0] for b in bounds])
+            return func(metrics, bounds, *args, **kwargs)
+        return query
+
+    for name in ("db_query_daily_increase", "scan_daily_first_last"):
+        monkeypatch.setattr(app, name, recording("index", getattr(app, name)))
+    for name in ("db_query_daily_max", "scan_daily_max"):
+        monkeypatch.setattr(app, name, recording("power", getattr(app, name)))
+    return asked
+
+
+@pytest.fixture
+def at_now(app, meter):
+    """at_now(func, *args): func(*args) pour le compteur de test, dans un cycle dont l'horloge est NOW"""
+    def call(func, *args):
+        def run():
+            app._cycle_clock.set(app.CycleClock(NOW))
+            return func(*args)
+        return app.run_for_meter(meter, run)
+    return call
+
+
+def test_closed_days_served_from_store(app, store, queried, at_now):
+    first = at_now(app.compute_daily_diffs_multi, METRICS, 14)
+    assert queried["index"] == [[NOW.date() - timedelta(days=i) for i in range(14)]]
+    again = at_now(app.compute_daily_diffs_multi, METRICS, 14)
+    # Seul le jour en cours est relu
+    assert queried["index"][1:] == [[NOW.date()]]
+    assert again == first
+
+
+def test_today_not_stored(app, meter, store, at_now):
+    at_now(app.compute_daily_diffs_multi, METRICS, 3)
+    keys = [meter.store_key(m) for m in METRICS]
+    stored = store.get_index_days(keys, [NOW.date() - timedelta(days=i) for i in range(3)])
+    assert all(sorted(days) == [NOW.date() - timedelta(days=2), NOW.date() - timedelta(days=1)]
+               for days in stored.values())
+
+
+def test_stored_value_wins_over_base(app, meter, store, at_now):
+    yesterday = NOW.date() - timedelta(days=1)
+    store.put_index_days({meter.store_key(METRICS[0]): {yesterday: (10.0, 52.5, 42.5)}})
+    # Conservé à la réouverture du fichier
+    reopened = app.DailySummaryStore(store.path)
+    assert reopened.get_index_days([meter.store_key(METRICS[0])], [yesterday]) == {
+        meter.store_key(METRICS[0]): {yesterday: (10.0, 52.5, 42.5)}}
+    assert at_now(app.compute_daily_diffs_multi, METRICS, 2)[METRICS[0]][1] == 42.5
+
+
+def test_max_power_and_colors_stored(app, meter, store, queried, at_now):
+    first = at_now(app.fetch_daily_max_power, meter.metrics["pcons"], 7)
+    again = at_now(app.fetch_daily_max_power, meter.metrics["pcons"], 7)
+    assert queried["power"][1:] == [[NOW.date()]]
+    assert again == first
+
+    colors = at_now(app.fetch_daily_tempo_colors, 7)
+    closed = [NOW.date() - timedelta(days=i) for i in range(1, 7)]
+    stored = store.get_colors(meter.name, closed)
+    assert [stored.get(day, "UNKNOWN") for day in closed] == colors[1:]
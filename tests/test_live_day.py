@@ -0,0 +1,81 @@
+"""Mode flux: jour en cours tenu à jour par les trames TIC entre deux cycles"""
+import copy
+import time
+
+import pytest
+
+from conftest import NOW, FakeMqttClient
+
+INDEXES = {"BBRHPJB": 1000000, "BBRHCJB": 2000000, "BBRHPJW": 300000, "BBRHCJW": 400000,
+           "BBRHPJR": 50000, "BBRHCJR": 60000}
+TARIFFS = {color: {"HP": 1.0, "HC": 0.5} for color in ("BLUE", "WHITE", "RED")}
+
+
+@pytest.fixture
+def no_tariff_query(app, monkeypatch):
+    """Le flux ne relit jamais les tarifs: il utilise ceux du dernier cycle"""
+    def fetch():
+        raise AssertionError("tarifs relus depuis le flux TIC")
+    monkeypatch.setattr(app, "fetch_tempo_tariffs", fetch)
+
+
+@pytest.fixture
+def live(app, meter, cycle):
+    """État du flux recalé sur le cycle, dernière trame reçue une minute avant NOW"""
+    scheduler, _ = cycle
+    live = app.LiveDayState(meter)
+    live.ingest(INDEXES, ts=NOW.timestamp() - 60)
+    live.anchor(NOW.date(), {m: scheduler.results["daily_diffs"][m][0] for m in scheduler.tempo_metrics})
+    return live
+
+
+def test_frames_update_today_with_cycle_tariffs(app, cycle, live, no_tariff_query):
+    _, payload = cycle
+    before = copy.deepcopy(payload)
+    # +1,5 kWh en heures pleines depuis le cycle
+    live.ingest({"BBRHPJB": INDEXES["BBRHPJB"] + 1500}, ts=NOW.timestamp())
+    assert live.apply(payload, TARIFFS)
+
+    hp, hc = payload["dailyweek_HP"][0], payload["dailyweek_HC"][0]
+    assert hp == pytest.approx(before["dailyweek_HP"][0] + 1.5, abs=0.011)
+    assert hc == before["dailyweek_HC"][0]
+    assert payload["daily"][0] == pytest.approx(before["daily"][0] + 1.5, abs=0.011)
+    for key in ("current_week", "current_month", "current_year"):
+        assert payload[key] == pytest.approx(before[key] + 1.5, abs=0.011)
+    assert payload["dailyweek_costHP"][0] == round(hp * 1.0, 2)
+    assert payload["dailyweek_costHC"][0] == round(hc * 0.5, 2)
+    assert payload["daily_cost"] == payload["dailyweek_cost"][0]
+    # Jours clos inchangés
+    assert payload["dailyweek_HP"][1:] == before["dailyweek_HP"][1:]
+
+
+def test_frame_of_next_day_not_applied(app, cycle, live, no_tariff_query):
+    _, payload = cycle
+    before = copy.deepcopy(payload)
+    live.ingest(INDEXES, ts=NOW.timestamp() + 86400)
+    assert not live.apply(payload, TARIFFS)
+    assert payload == before
+
+
+def test_new_day_frame_ends_wait_and_refreshes(app, meter, cycle, no_tariff_query, monkeypatch):
+    monkeypatch.setattr(app, "STREAM_MODE", True)
+    client = FakeMqttClient()
+    runtime = app.MeterRuntime(meter, client)
+    runtime.scheduler, runtime.payload = cycle
+    later = time.time() + 3600
+    runtime.scheduler.next_due = dict.fromkeys(runtime.scheduler.next_due, later)
+
+    # Trame du jour réel, postérieur au jour du payload
+    runtime.live.ingest(INDEXES)
+    t0 = time.time()
+    app.wait_for_deadline([runtime], t0 + 3)
+    assert time.time() - t0 < 2
+    assert runtime.scheduler.next_due["history"] <= time.time()
+    assert runtime.scheduler.next_due["today"] <= time.time()
+    assert client.messages == []
+
+    # Demandé une seule fois par jour: un cycle en échec suit ensuite STAGE_RETRY_DELAY
+    runtime.scheduler.next_due = dict.fromkeys(runtime.scheduler.next_due, later)
+    runtime.live.ingest({"BBRHPJB": INDEXES["BBRHPJB"] + 10})
+    runtime.stream_update()
+    assert runtime.scheduler.next_deadline() == later
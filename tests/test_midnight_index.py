@@ -0,0 +1,166 @@
+"""Table des index à minuit: remplissage initial, réutilisation, extension et conservation, sur les deux bases"""
+import re
+from datetime import date, datetime, timedelta
+
+import pytest
+import pytz
+
+from conftest import HISTORY_END
+from fake_vm import INDEX_METRICS, STEP
+
+METRICS = list(INDEX_METRICS.values())
+NOW_TS = (HISTORY_END - timedelta(minutes=23)).timestamp()
+TODAY = HISTORY_END.date()
+DAYS = [TODAY - timedelta(days=i) for i in range(1, 11)]
+
+
+def requests_sent(vm):
+    stats = vm.snapshot()
+    return stats["range"] + stats["instant"]
+
+
+@pytest.fixture
+def store(app, tmp_path, monkeypatch):
+    store = app.DailySummaryStore(str(tmp_path / "linky_daily.db"))
+    monkeypatch.setattr(app, "get_daily_store", lambda: store)
+    return store
+
+
+@pytest.fixture
+def spans(app, monkeypatch):
+    """Plages lues dans la base par fetch_midnight_indexes"""
+    fetched = []
+    real = app.fetch_midnight_indexes
+
+    def recording(metric_names, first_day, last_day):
+        fetched.append((first_day, last_day))
+        return real(metric_names, first_day, last_day)
+
+    monkeypatch.setattr(app, "fetch_midnight_indexes", recording)
+    return fetched
+
+
+def expected(app, history, day):
+    return history.value_at(METRICS[0], app.paris_midnight(day).timestamp())
+
+
+def test_backfill_then_reuse(app, vm, history, store, spans, in_meter):
+    table = app.MidnightIndexTable()
+    results = in_meter(table.lookup, METRICS, DAYS, NOW_TS)
+    # Un seul remplissage, depuis le 1er janvier de l'année précédente
+    assert spans == [(date(TODAY.year - 1, 1, 1), DAYS[0])]
+    for day in DAYS:
+        assert results[METRICS[0]][day] == pytest.approx(expected(app, history, day))
+
+    vm.reset_stats()
+    again = in_meter(table.lookup, METRICS, DAYS + [date(2024, 3, 31), date(2024, 10, 27)], NOW_TS)
+    assert requests_sent(vm) == 0
+    assert len(spans) == 1
+    for day in (date(2024, 3, 31), date(2024, 10, 27)):
+        assert again[METRICS[0]][day] == pytest.approx(expected(app, history, day))
+    # Avant le début de l'historique: pas de donnée
+    assert in_meter(table.lookup, METRICS, [date(TODAY.year - 1, 6, 1)], NOW_TS)[METRICS[0]] == {
+        date(TODAY.year - 1, 6, 1): None}
+    assert len(spans) == 1
+
+
+def test_extended_by_new_days_only(app, store, spans, in_meter):
+    table = app.MidnightIndexTable()
+    earlier = NOW_TS - 3 * 86400
+    in_meter(table.lookup, METRICS, [d - timedelta(days=3) for d in DAYS], earlier)
+    in_meter(table.lookup, METRICS, DAYS, NOW_TS)
+    assert spans[1] == (DAYS[0] - timedelta(days=2), DAYS[0])
+
+
+def test_reloaded_from_store(app, vm, store, spans, in_meter):
+    first = in_meter(app.MidnightIndexTable().lookup, METRICS, DAYS, NOW_TS)
+    vm.reset_stats()
+    reloaded = in_meter(app.MidnightIndexTable().lookup, METRICS, DAYS, NOW_TS)
+    assert requests_sent(vm) == 0
+    assert len(spans) == 1
+    assert reloaded == first
+
+
+def test_failed_backfill_retried(app, store, in_meter, monkeypatch):
+    real = app.fetch_midnight_indexes
+
+    def failing(metric_names, first_day, last_day):
+        app.record_query("victoriametrics", "range", 0.0, 0, ok=False)
+        return {metric: {} for metric in metric_names}
+
+    table = app.MidnightIndexTable()
+    monkeypatch.setattr(app, "fetch_midnight_indexes", failing)
+    assert in_meter(table.lookup, METRICS, DAYS, NOW_TS)[METRICS[0]][DAYS[0]] is None
+    assert store.get_midnight_index([METRICS[0]]) == {}
+    monkeypatch.setattr(app, "fetch_midnight_indexes", real)
+    assert in_meter(table.lookup, METRICS, DAYS, NOW_TS)[METRICS[0]][DAYS[0]] is not None
+
+
+def test_unsettled_midnight_not_kept(app, history, store, spans, in_meter):
+    table = app.MidnightIndexTable()
+    just_after = app.paris_midnight(TODAY).timestamp() + 60
+    for _ in range(2):
+        result = in_meter(table.lookup, METRICS, [TODAY], just_after)
+        assert result[METRICS[0]][TODAY] == pytest.approx(expected(app, history, TODAY))
+    assert spans == [(TODAY, TODAY), (TODAY, TODAY)]
+
+
+def influx_hourly_rows(app, history, until=None):
+    """
+    Lignes de la requête Flux pivotée de influx_query_range_multi au pas horaire, calculées sur l'historique:
+    last() de chaque fenêtre [h, h+1h[ de range(start, stop), horodatée à sa fin (timeSrc: "_stop").
+    until: les échantillons à partir de cet instant ne sont pas encore arrivés dans la base.
+    """
+    def rows(query, kind="range"):
+        start, stop = (datetime.fromisoformat(v).timestamp()
+                       for v in re.search(r"range\(start: (\S+), stop: (\S+)\)", query).groups())
+        size = len(history.series[METRICS[0]])
+        window = start - start % 3600
+        while window < stop:
+            lo, hi = max(window, start), min(window + 3600, stop)
+            # Dernier échantillon de [lo, hi[ (et avant until)
+            first = max(0, -int(-(lo - history.start) // STEP))
+            last = min(size, -int(-(min(hi, until or hi) - history.start) // STEP)) - 1
+            if last >= first:
+                yield {"_time": datetime.fromtimestamp(hi, pytz.UTC).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                       **{m: str(history.series[m][last]) for m in METRICS}}
+            window += 3600
+    return rows
+
+
+@pytest.fixture
+def influx_meter(app, meter):
+    return app.MeterConfig("linky_influx", metrics=meter.metrics, db_type="influxdb")
+
+
+def influx_expected(app, history, day):
+    """Dernier échantillon avant minuit: la fenêtre horodatée à minuit s'arrête juste avant"""
+    return history.value_at(METRICS[0], app.paris_midnight(day).timestamp() - 1)
+
+
+def test_influx_midnights_include_first_day(app, history, influx_meter, monkeypatch):
+    monkeypatch.setattr(app, "influx_query_rows", influx_hourly_rows(app, history))
+    for first_day in (DAYS[-1], DAYS[0]):
+        results = app.run_for_meter(influx_meter, app.fetch_midnight_indexes, METRICS, first_day, DAYS[0])
+        days = [day for day in DAYS if day >= first_day]
+        assert sorted(results[METRICS[0]]) == sorted(days)
+        for day in days:
+            assert results[METRICS[0]][day] == pytest.approx(influx_expected(app, history, day))
+
+
+def test_influx_missing_midnight_read_again(app, history, store, spans, influx_meter, monkeypatch):
+    """Minuit absent de la base au remplissage (passerelle en retard): relu à la demande suivante"""
+    table = app.MidnightIndexTable()
+    late = app.paris_midnight(DAYS[0]).timestamp() - 2 * 3600
+    monkeypatch.setattr(app, "influx_query_rows", influx_hourly_rows(app, history, until=late))
+    first = app.run_for_meter(influx_meter, table.lookup, METRICS, DAYS, NOW_TS)
+    assert first[METRICS[0]][DAYS[0]] is None
+    assert first[METRICS[0]][DAYS[1]] == pytest.approx(influx_expected(app, history, DAYS[1]))
+
+    monkeypatch.setattr(app, "influx_query_rows", influx_hourly_rows(app, history))
+    again = app.run_for_meter(influx_meter, table.lookup, METRICS, DAYS, NOW_TS)
+    assert spans[1:] == [(DAYS[0], DAYS[0])]
+    assert again[METRICS[0]][DAYS[0]] == pytest.approx(influx_expected(app, history, DAYS[0]))
+    reloaded = app.run_for_meter(influx_meter, app.MidnightIndexTable().lookup, METRICS, DAYS, NOW_TS)
+    assert reloaded == again
+    assert len(spans) == 2
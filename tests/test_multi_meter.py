@@ -0,0 +1,87 @@
+"""Deux compteurs sur deux bases, mêmes noms de métriques: stockage local et index à minuit distincts"""
+from datetime import timedelta
+
+import pytest
+
+from conftest import HISTORY_END
+from fake_vm import INDEX_METRICS, FakeVictoriaMetrics, SyntheticLinky
+
+METRICS = list(INDEX_METRICS.values())
+NOW = HISTORY_END - timedelta(minutes=23)
+
+
+@pytest.fixture(scope="module")
+def other_history():
+    return SyntheticLinky(years=0.1, end_ts=HISTORY_END.timestamp(), seed=7)
+
+
+@pytest.fixture(scope="module")
+def other_vm(other_history):
+    server = FakeVictoriaMetrics(other_history).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def meters(app, vm, other_vm):
+    return [app.MeterConfig("linky_a", vm_host="127.0.0.1", vm_port=vm.port),
+            app.MeterConfig("linky_b", vm_host="127.0.0.1", vm_port=other_vm.port)]
+
+
+@pytest.fixture
+def store(app, tmp_path, monkeypatch):
+    store = app.DailySummaryStore(str(tmp_path / "linky_daily.db"))
+    monkeypatch.setattr(app, "get_daily_store", lambda: store)
+    return store
+
+
+def in_cycle(app, meter, func, *args):
+    """func(*args) pour `meter`, dans un cycle dont l'horloge est NOW"""
+    def run():
+        app._cycle_clock.set(app.CycleClock(NOW))
+        return func(*args)
+    return app.run_for_meter(meter, run)
+
+
+def expected_diffs(app, history, days):
+    bounds = app.paris_day_bounds(days, NOW)
+    return {m: [round(history.value_at(m, end) - history.value_at(m, start), 2) for _, start, end in bounds]
+            for m in METRICS}
+
+
+def test_store_keys_distinct_per_backend(meters):
+    a, b = meters
+    assert a.metrics == b.metrics
+    assert {a.store_key(m) for m in METRICS}.isdisjoint(b.store_key(m) for m in METRICS)
+
+
+def test_closed_days_not_shared(app, history, other_history, meters, store):
+    a, b = meters
+    for _ in range(2):
+        # Second passage: jours clos servis par le stockage local, chacun les siens
+        assert in_cycle(app, a, app.compute_daily_diffs_multi, METRICS, 14) == expected_diffs(app, history, 14)
+        assert in_cycle(app, b, app.compute_daily_diffs_multi, METRICS, 14) == expected_diffs(app, other_history, 14)
+
+
+def test_midnight_indexes_not_shared(app, history, other_history, meters, store):
+    a, b = meters
+    table = app.MidnightIndexTable()
+    days = [NOW.date() - timedelta(days=i) for i in range(1, 8)]
+    for meter, source in ((a, history), (b, other_history), (a, history)):
+        results = in_cycle(app, meter, table.lookup, METRICS, days, NOW.timestamp())
+        for day in days:
+            midnight = app.paris_midnight(day).timestamp()
+            assert results[METRICS[0]][day] == pytest.approx(source.value_at(METRICS[0], midnight))
+
+
+def test_old_keys_dropped_on_upgrade(app, tmp_path):
+    path = str(tmp_path / "linky_daily.db")
+    store = app.DailySummaryStore(path)
+    day = NOW.date() - timedelta(days=2)
+    store.put_index_days({METRICS[0]: {day: (1.0, 2.0, 1.0)}, "victoriametrics://h:1/" + METRICS[0]: {day: (1.0, 3.0, 2.0)}})
+    store.conn.execute("PRAGMA user_version = 2")
+    store.conn.commit()
+    reopened = app.DailySummaryStore(path)
+    assert reopened.get_index_days([METRICS[0]], [day]) == {METRICS[0]: {}}
+    assert reopened.get_index_days(["victoriametrics://h:1/" + METRICS[0]], [day])[
+        "victoriametrics://h:1/" + METRICS[0]] == {day: (1.0, 3.0, 2.0)}
@@ -0,0 +1,72 @@
+"""Publication MQTT: payload identique ignoré, republication forcée, topics scalaires"""
+import copy
+import json
+
+import pytest
+
+from conftest import FakeMqttClient
+
+
+@pytest.fixture
+def publisher(app, meter):
+    return app.LinkyPublisher(FakeMqttClient(), meter)
+
+
+@pytest.fixture
+def payload(cycle):
+    _, payload = cycle
+    return {**copy.deepcopy(payload), "lastUpdate": "2024-11-05T11:37:00+01:00",
+            "timeLastCall": "2024-11-05T11:37:00+01:00"}
+
+
+def state_messages(publisher):
+    return [json.loads(p) for topic, p, _ in publisher.client.messages if topic == publisher.meter.state_topic]
+
+
+def test_identical_payload_skipped(app, publisher, payload):
+    assert publisher.publish(payload)
+    # Seuls les champs horodatés ont changé
+    assert not publisher.publish({**payload, "lastUpdate": "2024-11-05T11:47:00+01:00",
+                                  "timeLastCall": "2024-11-05T11:47:00+01:00"})
+    assert publisher.skipped == 1
+    assert state_messages(publisher) == [payload]
+    assert all(retain for _, _, retain in publisher.client.messages)
+
+
+def test_changed_payload_published(app, publisher, payload):
+    publisher.publish(payload)
+    changed = {**payload, "current_year": payload["current_year"] + 0.5}
+    assert publisher.publish(changed)
+    assert state_messages(publisher) == [payload, changed]
+    assert publisher.skipped == 0
+
+
+def test_identical_payload_forced_after_interval(app, publisher, payload, monkeypatch):
+    publisher.publish(payload)
+    publisher.last_publish -= app.PUBLISH_FORCE_INTERVAL
+    assert publisher.publish(payload)
+    monkeypatch.setattr(app, "PUBLISH_FORCE_INTERVAL", 0)
+    assert publisher.publish(payload)
+    assert len(state_messages(publisher)) == 3
+
+
+def test_scalar_topics_only_when_moved(app, publisher, payload, monkeypatch):
+    monkeypatch.setattr(app, "PUBLISH_SCALAR_TOPICS", True)
+
+    def scalars():
+        messages = {topic: json.loads(p) for topic, p, _ in publisher.client.messages
+                    if topic != publisher.meter.state_topic}
+        publisher.client.messages.clear()
+        return messages
+
+    publisher.publish(payload)
+    assert scalars() == {app.linky_scalar_topic(publisher.meter.name, field): payload[field]
+                         for field in app.LINKY_SCALAR_FIELDS}
+
+    publisher.publish({**payload, "current_year": payload["current_year"] + 0.5})
+    assert scalars() == {app.linky_scalar_topic(publisher.meter.name, "current_year"): payload["current_year"] + 0.5}
+
+    # Republication forcée: tous les topics, même inchangés
+    publisher.last_publish -= app.PUBLISH_FORCE_INTERVAL
+    publisher.publish({**payload, "current_year": payload["current_year"] + 0.5})
+    assert len(scalars()) == len(app.LINKY_SCALAR_FIELDS)
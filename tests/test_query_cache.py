@@ -0,0 +1,118 @@
+"""Cache des requêtes: fenêtres closes gardées, fenêtres récentes rafraîchies, échecs jamais gardés"""
+from array import array
+
+import pytest
+
+NOW = 1_730_800_000.0
+
+
+def key(kind="range", window=(0, 3600)):
+    return (("victoriametrics", "127.0.0.1", 8428), "", kind, ("sensor.index",), window)
+
+
+class Counter:
+    """Requête simulée: compte ses appels, retourne un résultat différent à chaque appel"""
+
+    def __init__(self, app=None, fail=False):
+        self.app = app
+        self.fail = fail
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.fail:
+            self.app.record_query("victoriametrics", "range", 0.0, 0, ok=False)
+        return {"sensor.index": (array("d", [0.0]), array("d", [float(self.calls)]))}
+
+
+@pytest.fixture
+def clock(app, monkeypatch):
+    now = [NOW]
+    monkeypatch.setattr(app.time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def cache(app):
+    return app.QueryCache(1024 * 1024)
+
+
+def test_settled_window_kept_indefinitely(app, cache, clock):
+    query = Counter()
+    end_ts = NOW - app.QUERY_CACHE_SETTLE_LAG - 1
+    first = cache.get_or_query(key(), end_ts, query)
+    clock[0] += 30 * 86400
+    assert cache.get_or_query(key(), end_ts, query) is first
+    assert query.calls == 1
+
+
+def test_recent_window_refreshed_after_ttl(app, cache, clock, monkeypatch):
+    monkeypatch.setattr(app, "QUERY_CACHE_RECENT_TTL", 30)
+    query = Counter()
+    cache.get_or_query(key(), NOW, query)
+    clock[0] += 29
+    cache.get_or_query(key(), NOW, query)
+    assert query.calls == 1
+    clock[0] += 2
+    cache.get_or_query(key(), NOW, query)
+    assert query.calls == 2
+    # Requête instantanée (fenêtre "maintenant"): même règle
+    cache.get_or_query(key("instant", ()), None, query)
+    cache.get_or_query(key("instant", ()), None, query)
+    assert query.calls == 3
+
+
+def test_recent_window_not_kept_without_ttl(app, cache, clock, monkeypatch):
+    monkeypatch.setattr(app, "QUERY_CACHE_RECENT_TTL", 0)
+    query = Counter()
+    cache.get_or_query(key(), NOW, query)
+    cache.get_or_query(key(), NOW, query)
+    assert query.calls == 2
+
+
+def test_failed_query_not_kept(app, cache, clock):
+    query = Counter(app, fail=True)
+    end_ts = NOW - app.QUERY_CACHE_SETTLE_LAG - 1
+    cache.get_or_query(key(), end_ts, query)
+    cache.get_or_query(key(), end_ts, query)
+    assert query.calls == 2
+    assert cache.stats()["entries"] == 0
+
+
+def test_retried_attempt_does_not_prevent_caching(app, cache, clock):
+    def query():
+        app.record_query("victoriametrics", "range", 0.0, 0, ok=False, retried=True)
+        return Counter()()
+
+    end_ts = NOW - app.QUERY_CACHE_SETTLE_LAG - 1
+    cache.get_or_query(key(), end_ts, query)
+    assert cache.stats()["entries"] == 1
+
+
+def test_least_recently_used_evicted(app, clock):
+    value = Counter()()
+    cache = app.QueryCache(int(app.result_size(value) * 2.5))
+    end_ts = NOW - app.QUERY_CACHE_SETTLE_LAG - 1
+    for window in ((0, 1), (1, 2)):
+        cache.get_or_query(key(window=window), end_ts, Counter())
+    cache.get_or_query(key(window=(0, 1)), end_ts, Counter())
+    cache.get_or_query(key(window=(2, 3)), end_ts, Counter())
+    stored = [k[4] for k in cache.entries]
+    assert stored == [(0, 1), (2, 3)]
+    assert cache.size <= cache.max_bytes
+
+
+def test_settled_results_persisted(app, clock, tmp_path):
+    path = str(tmp_path / "linky_query_cache.db")
+    end_ts = NOW - app.QUERY_CACHE_SETTLE_LAG - 1
+    cache = app.QueryCache(1024 * 1024, path)
+    settled = cache.get_or_query(key(window=(0, 1)), end_ts, Counter())
+    cache.get_or_query(key(window=(1, 2)), NOW, Counter())
+
+    reopened = app.QueryCache(1024 * 1024, path)
+    query = Counter()
+    value = reopened.get_or_query(key(window=(0, 1)), end_ts, query)
+    assert query.calls == 0
+    assert list(value["sensor.index"][1]) == list(settled["sensor.index"][1])
+    reopened.get_or_query(key(window=(1, 2)), NOW, query)
+    assert query.calls == 1
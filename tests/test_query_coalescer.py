@@ -0,0 +1,104 @@
+"""Regroupement des requêtes identiques en vol"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+KEY = (("victoriametrics", "127.0.0.1", 8428), "", "range", ("sensor.index",), (0, 3600))
+
+
+def run_together(coalescer, keys, query):
+    """Lance coalescer.run(key, query) pour chaque clé en parallèle, la requête bloquée jusqu'à ce que tous attendent"""
+    release = threading.Event()
+
+    def blocked():
+        release.wait(5)
+        return query()
+
+    with ThreadPoolExecutor(len(keys)) as executor:
+        futures = [executor.submit(coalescer.run, k, blocked) for k in keys]
+        # Tous les appelants sont en vol (lancés ou en attente du premier) avant de libérer la requête
+        while coalescer.shared + len(coalescer.inflight) < len(keys):
+            threading.Event().wait(0.001)
+        release.set()
+        return [f.exception() or f.result() for f in futures]
+
+
+def test_identical_queries_share_one_call(app):
+    coalescer = app.QueryCoalescer()
+    calls = []
+    results = run_together(coalescer, [KEY] * 6, lambda: calls.append(1) or {"value": len(calls)})
+    assert len(calls) == 1
+    assert all(r is results[0] for r in results)
+    assert coalescer.shared == 5
+    assert coalescer.inflight == {}
+
+
+def test_distinct_queries_not_shared(app):
+    coalescer = app.QueryCoalescer()
+    calls = []
+    keys = [KEY[:4] + ((i, i + 1),) for i in range(3)]
+    run_together(coalescer, keys, lambda: calls.append(1))
+    assert len(calls) == 3
+    assert coalescer.shared == 0
+
+
+def test_error_reaches_every_caller(app):
+    coalescer = app.QueryCoalescer()
+
+    def boom():
+        raise ValueError("base indisponible")
+
+    results = run_together(coalescer, [KEY] * 3, boom)
+    assert all(isinstance(r, ValueError) for r in results)
+    assert coalescer.inflight == {}
+
+
+def test_failed_query_flags_every_caller(app):
+    coalescer = app.QueryCoalescer()
+
+    def partial():
+        app.record_query("victoriametrics", "range", 0.0, 0, ok=False)
+        return {}
+
+    release = threading.Event()
+    flags = []
+
+    def caller():
+        def query():
+            release.wait(5)
+            return partial()
+        flags.append(app.run_tracking_failures(coalescer.run, KEY, query)[1])
+
+    threads = [threading.Thread(target=caller) for _ in range(3)]
+    for t in threads:
+        t.start()
+    while coalescer.shared < 2:
+        threading.Event().wait(0.001)
+    release.set()
+    for t in threads:
+        t.join()
+    assert flags == [True, True, True]
+
+
+def test_parallel_identical_requests_reach_the_base_once(app, vm, meter, history):
+    metrics = [meter.metrics["hpjb"], meter.metrics["hcjb"]]
+    end_ts = history.end - 86400
+
+    def boundaries(_):
+        return app.run_for_meter(meter, app.db_query_boundaries, metrics, end_ts - 86400, end_ts)
+
+    vm.reset_stats()
+    single = boundaries(None)
+    requests_per_call = vm.snapshot()["range"] + vm.snapshot()["instant"]
+
+    # Latence du serveur: les 8 appels sont en vol en même temps
+    vm.reset_stats()
+    vm.latency = 0.2
+    try:
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(boundaries, range(8)))
+    finally:
+        vm.latency = 0.0
+    stats = vm.snapshot()
+    assert stats["range"] + stats["instant"] == requests_per_call
+    assert all(r == single for r in results)
@@ -0,0 +1,98 @@
+"""Écriture des agrégats des jours clos dans la base (ROLLUP_WRITEBACK), une seule fois par jour"""
+import contextvars
+from datetime import datetime
+
+import pytest
+
+from conftest import NOW, FakeMqttClient
+
+POINTS_PER_DAY = 6 + 2 + 3  # énergie par compteur, puissance max et son heure, coûts HP / HC / total
+
+
+@pytest.fixture
+def store(app, tmp_path, monkeypatch):
+    store = app.DailySummaryStore(str(tmp_path / "linky_daily.db"))
+    monkeypatch.setattr(app, "get_daily_store", lambda: store)
+    return store
+
+
+@pytest.fixture
+def writes(app, monkeypatch):
+    """Lots de points écrits dans la base; writes.failing = True fait échouer l'écriture"""
+    class Writes(list):
+        failing = False
+
+    written = Writes()
+
+    def write(points):
+        if written.failing:
+            raise ConnectionError("base indisponible")
+        written.append(points)
+
+    monkeypatch.setattr(app, "db_write_points", write)
+    return written
+
+
+def runtime_after_cycle(app, meter, cycle):
+    runtime = app.MeterRuntime(meter, FakeMqttClient())
+    runtime.scheduler, runtime.payload = cycle
+    return runtime
+
+
+def closed_days(payload):
+    return {datetime.strptime(day, "%Y-%m-%d").date() for day in payload["dailyweek"][1:]}
+
+
+def write_rollups(app, runtime):
+    """write_rollups à NOW (horloge du cycle)"""
+    def run():
+        app._cycle_clock.set(app.CycleClock(NOW))
+        runtime.write_rollups(runtime.payload)
+    contextvars.copy_context().run(run)
+
+
+def test_points_of_closed_days(app, meter, cycle):
+    scheduler, payload = cycle
+    diffs = scheduler.results["daily_diffs"]
+    days, points = app.rollup_points(meter, payload, diffs, set(), NOW.timestamp())
+    # Le jour en cours n'est pas clos
+    assert [d.isoformat() for d in days] == payload["dailyweek"][1:]
+    assert len(points) == len(days) * POINTS_PER_DAY
+    # Jour d'indice 3 du payload (days commence à l'indice 1)
+    i = 3
+    midnight = int(app.paris_midnight(days[i - 1]).timestamp())
+    energy = {(labels["period"], labels["color"]): value for name, labels, ts, value in points
+              if name.endswith("_energy_kwh") and ts == midnight}
+    assert energy[("HP", "BLUE")] == diffs[meter.metrics["hpjb"]][i]
+    assert energy[("HC", "RED")] == diffs[meter.metrics["hcjr"]][i]
+    assert (f"{app.ROLLUP_METRIC_PREFIX}_cost_eur", {"meter": meter.name, "period": "total"}, midnight,
+            payload["dailyweek_cost"][i]) in points
+
+    written = set(days[:2])
+    again, points = app.rollup_points(meter, payload, diffs, written, NOW.timestamp())
+    assert again == days[2:]
+    assert len(points) == len(again) * POINTS_PER_DAY
+
+
+def test_written_once_across_restarts(app, meter, cycle, store, writes):
+    runtime = runtime_after_cycle(app, meter, cycle)
+    write_rollups(app, runtime)
+    write_rollups(app, runtime)
+    assert len(writes) == 1
+    assert len(writes[0]) == 6 * POINTS_PER_DAY
+
+    # Redémarrage: les jours écrits sont relus du stockage local
+    write_rollups(app, runtime_after_cycle(app, meter, cycle))
+    assert len(writes) == 1
+    closed = closed_days(cycle[1])
+    assert store.get_rollup_days(runtime.rollup_key, closed | {NOW.date()}) == closed
+
+
+def test_failed_write_retried(app, meter, cycle, store, writes):
+    runtime = runtime_after_cycle(app, meter, cycle)
+    writes.failing = True
+    write_rollups(app, runtime)
+    assert store.get_rollup_days(runtime.rollup_key, closed_days(cycle[1])) == set()
+    writes.failing = False
+    write_rollups(app, runtime_after_cycle(app, meter, cycle))
+    assert len(writes) == 1 and len(writes[0]) == 6 * POINTS_PER_DAY
@@ -0,0 +1,82 @@
+"""Échéances par étage du planificateur: intervalles calés sur l'horloge, minuit, nouvel essai après échec"""
+from datetime import timedelta
+
+import pytest
+
+from conftest import NOW
+
+
+def next_multiple(ts, interval, stagger=0.0):
+    return ((ts - stagger) // interval + 1) * interval + stagger
+
+
+def run(scheduler, executor, ts):
+    return scheduler.run(executor, None, ts)
+
+
+@pytest.fixture
+def tomorrow_midnight(app):
+    return app.paris_midnight(NOW.date() + timedelta(days=1)).timestamp()
+
+
+def test_first_cycle_runs_every_stage(app, cycle, tomorrow_midnight):
+    scheduler, _ = cycle
+    now_ts = NOW.timestamp()
+    assert sorted(scheduler.last_cycle["stages"]) == ["history", "tariffs", "today"]
+    assert scheduler.results["history_day"] == NOW.date()
+    assert scheduler.next_due == {
+        "history": tomorrow_midnight,
+        "today": min(next_multiple(now_ts, app.TODAY_REFRESH_INTERVAL), tomorrow_midnight),
+        "tariffs": min(next_multiple(now_ts, app.TARIFF_REFRESH_INTERVAL), tomorrow_midnight),
+    }
+
+
+def test_only_due_stages_recomputed(app, cycle, executor):
+    scheduler, payload = cycle
+    yearly = scheduler.results["yearly"]
+    again = run(scheduler, executor, scheduler.next_due["today"])
+    assert scheduler.last_cycle["stages"] == ["today"]
+    assert scheduler.results["yearly"] is yearly
+    assert again["dailyweek"] == payload["dailyweek"]
+
+
+def test_stagger_shifts_deadlines(app, meter, executor, tomorrow_midnight):
+    stagger = 37.0
+    scheduler = app.RefreshScheduler(meter, stagger=stagger)
+    now_ts = NOW.timestamp()
+    run(scheduler, executor, now_ts)
+    assert scheduler.next_due["today"] == next_multiple(now_ts, app.TODAY_REFRESH_INTERVAL, stagger)
+    assert scheduler.next_due["history"] == tomorrow_midnight + stagger
+
+
+def test_history_recomputed_after_settle_lag(app, meter, executor, tomorrow_midnight):
+    scheduler = app.RefreshScheduler(meter)
+    midnight = app.paris_midnight(NOW.date()).timestamp()
+    run(scheduler, executor, midnight + 10)
+    # Minuit: l'historique est recalculé une seconde fois, une fois les dernières mesures de la veille arrivées
+    assert scheduler.next_due["history"] == midnight + app.STORE_SETTLE_LAG
+    run(scheduler, executor, scheduler.next_due["history"])
+    assert sorted(scheduler.last_cycle["stages"]) == ["history", "today"]
+    assert scheduler.next_due["history"] == tomorrow_midnight
+
+
+def test_failed_stage_retried(app, meter, executor, monkeypatch, tomorrow_midnight):
+    real = app.fetch_monthly_consumption_data
+
+    def failing(*args):
+        app.record_query("victoriametrics", "range", 0.0, 0, ok=False)
+        return real(*args)
+
+    scheduler = app.RefreshScheduler(meter)
+    now_ts = NOW.timestamp()
+    monkeypatch.setattr(app, "fetch_monthly_consumption_data", failing)
+    run(scheduler, executor, now_ts)
+    assert scheduler.next_due["history"] == now_ts + app.STAGE_RETRY_DELAY
+    assert "history_day" not in scheduler.results
+    assert scheduler.next_due["today"] == next_multiple(now_ts, app.TODAY_REFRESH_INTERVAL)
+
+    monkeypatch.setattr(app, "fetch_monthly_consumption_data", real)
+    run(scheduler, executor, scheduler.next_due["history"])
+    assert "history" in scheduler.last_cycle["stages"] and "today" in scheduler.last_cycle["stages"]
+    assert scheduler.results["history_day"] == NOW.date()
+    assert scheduler.next_due["history"] == tomorrow_midnight
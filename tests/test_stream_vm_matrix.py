@@ -0,0 +1,93 @@
+"""Décodage en flux des réponses query_range, comparé à json.loads quel que soit le découpage en blocs"""
+import json
+
+import pytest
+import requests
+
+CHUNK_SIZES = (1, 2, 3, 7, 16, 64, 1000, 65536)
+
+
+def chunked(body, size):
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+def decode_json(body):
+    """Référence: [(labels, [(ts, valeur), ...]), ...] via json.loads"""
+    result = json.loads(body)["data"]["result"]
+    return [(s["metric"], [(float(ts), float(v)) for ts, v in s["values"]]) for s in result]
+
+
+def decode_stream(app, chunks):
+    series, points, size = app.stream_vm_matrix(chunks, app.SeriesReducer)
+    decoded = [(labels, list(zip(*result)) if result else []) for labels, result in series]
+    return decoded, points, size
+
+
+def matrix_body(series, **dumps):
+    return json.dumps({"status": "success", "data": {"resultType": "matrix", "result": [
+        {"metric": labels, "values": values} for labels, values in series]}}, **dumps).encode()
+
+
+@pytest.fixture(scope="module")
+def vm_body(app, vm, history):
+    """Vraie réponse du serveur simulé: 6 index, deux jours au pas horaire"""
+    end_ts = history.end - 3600
+    response = requests.get(f"http://127.0.0.1:{vm.port}/api/v1/query_range", params={
+        "query": '{__name__=~"sensor.linky_tempo_index_.*"}', "start": end_ts - 2 * 86400,
+        "end": end_ts, "step": 3600})
+    response.raise_for_status()
+    return response.content
+
+
+BODIES = {
+    "compact": matrix_body([({"__name__": "a"}, [[1700000000, "1.5"], [1700003600, "2"]])], separators=(",", ":")),
+    "indented": matrix_body([({"__name__": "a", "meter": "x"}, [[1700000000.5, "1e3"], [1700003600, "-0.25"]]),
+                             ({"__name__": "b"}, [[1700000000, "7"]])], indent=2),
+    "tricky_labels": matrix_body([({"__name__": "a", "note": 'a "quoted" {brace} ] , value'},
+                                   [[1700000000, "1"], [1700000060, "2"], [1700000120, "3"]]),
+                                  ({"__name__": "b", "path": "C:\\\\data"}, [[1700000000, "4"]])]),
+    "empty_values": matrix_body([({"__name__": "a"}, []), ({"__name__": "b"}, [[1700000000, "4"]])]),
+    "no_series": matrix_body([]),
+}
+
+
+@pytest.mark.parametrize("name", sorted(BODIES))
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+def test_matches_json_loads(app, name, size):
+    body = BODIES[name]
+    decoded, points, read = decode_stream(app, chunked(body, size))
+    assert decoded == decode_json(body)
+    assert points == sum(len(values) for _, values in decoded)
+    assert read == len(body)
+
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+def test_matches_json_loads_on_server_response(app, vm_body, size):
+    decoded, points, _ = decode_stream(app, chunked(vm_body, size))
+    reference = decode_json(vm_body)
+    assert len(reference) == 6
+    assert decoded == reference
+    assert points == 6 * 49
+
+
+@pytest.mark.parametrize("size", (1, 5, 64))
+def test_first_last_reducer(app, vm_body, size):
+    series, _, _ = app.stream_vm_matrix(chunked(vm_body, size), app.FirstLastReducer)
+    for (labels, (first, last, count)), (ref_labels, values) in zip(series, decode_json(vm_body)):
+        assert labels == ref_labels
+        assert (first, last, count) == (values[0][1], values[-1][1], len(values))
+
+
+def test_truncated_response_rejected(app, vm_body):
+    with pytest.raises(ValueError):
+        app.stream_vm_matrix(chunked(vm_body[:len(vm_body) // 2], 64), app.SeriesReducer)
+
+
+@pytest.mark.parametrize("name", sorted(BODIES))
+def test_every_truncation_rejected(app, name):
+    """Un corps coupé n'importe où, y compris entre deux séries, n'est jamais pris pour une réponse complète"""
+    body = BODIES[name]
+    end = body.rstrip().rindex(b"]") + 1
+    for cut in range(end):
+        with pytest.raises(app.TruncatedResponseError):
+            app.stream_vm_matrix(chunked(body[:cut], 7), app.SeriesReducer)
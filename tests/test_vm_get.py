@@ -0,0 +1,85 @@
+"""vm_get: réponses toujours fermées, coupures en cours de lecture retentées"""
+import json
+
+import pytest
+import requests
+
+BODY = json.dumps({"status": "success", "data": {"resultType": "matrix", "result": [
+    {"metric": {"__name__": "a"}, "values": [[1700000000, "1"], [1700003600, "2"]]}]}}).encode()
+
+
+class FakeResponse:
+    def __init__(self, status=200, body=BODY, error=None):
+        self.status_code = status
+        self.body = body
+        self.error = error
+        self.closed = False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"HTTP {self.status_code}")
+
+    def iter_content(self, size):
+        for i in range(0, len(self.body), 16):
+            yield self.body[i:i + 16]
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def responses(app, monkeypatch):
+    """Réponses servies dans l'ordre par la session partagée"""
+    queue, served = [], []
+
+    def get(url, **kwargs):
+        served.append(queue.pop(0))
+        return served[-1]
+
+    monkeypatch.setattr(app.get_http_session(), "get", get)
+    monkeypatch.setattr(app, "VM_MAX_RETRIES", 2)
+    monkeypatch.setattr(app, "VM_RETRY_BACKOFF", 0.0)
+    return queue, served
+
+
+def query_range(app):
+    return app.vm_get("http://vm/api/v1/query_range", {}, 1, reducer=app.SeriesReducer)
+
+
+def test_streamed_response_closed(app, responses):
+    queue, served = responses
+    queue.append(FakeResponse())
+    series = query_range(app)
+    assert list(series[0][1][1]) == [1.0, 2.0]
+    assert served[0].closed
+
+
+def test_client_error_closed_and_not_retried(app, responses):
+    queue, served = responses
+    queue.extend([FakeResponse(status=400), FakeResponse()])
+    with pytest.raises(requests.HTTPError):
+        query_range(app)
+    assert len(served) == 1 and served[0].closed
+
+
+@pytest.mark.parametrize("broken", [
+    FakeResponse(body=BODY[:len(BODY) // 2]),
+    FakeResponse(body=BODY[:40], error=requests.exceptions.ChunkedEncodingError("connexion coupée")),
+], ids=["truncated", "chunked_encoding_error"])
+def test_cut_during_body_retried(app, responses, broken):
+    queue, served = responses
+    queue.extend([broken, FakeResponse()])
+    series, failed = app.run_tracking_failures(query_range, app)
+    assert list(series[0][1][1]) == [1.0, 2.0]
+    assert not failed
+    assert len(served) == 2 and all(r.closed for r in served)
+
+
+def test_unreadable_body_closed_and_not_retried(app, responses):
+    queue, served = responses
+    queue.extend([FakeResponse(body=b'{"data":{"result":[{"metric":{oops},"values":[[1,"1"]]}]}}'), FakeResponse()])
+    with pytest.raises(ValueError):
+        query_range(app)
+    assert len(served) == 1 and served[0].closed